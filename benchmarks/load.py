@@ -0,0 +1,159 @@
+import csv
+import time
+import zlib
+import random
+import asyncio
+import datetime
+
+from typing import Any, Dict, List, Optional
+
+from httpx import AsyncClient, Limits
+
+
+TRANSACTION_TYPES = ["buy", "gift", "redeem"]
+
+
+#Rows of a member data csv in the perk app request format, rows with empty fields are left out like the streamer does
+def csv_transactions(path: str, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    rows = []
+    with open(path, "r", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            if any(value == "" for value in row.values()):
+                continue
+            rows.append({
+                "memberId": row["memberId"],
+                "lastTransactionUtcTs": row["lastTransactionUtcTs"],
+                "lastTransactionType": row["lastTransactionType"],
+                "lastTransactionPointsBought": float(row["lastTransactionPointsBought"]),
+                "lastTransactionRevenueUsd": float(row["lastTransactionRevenueUSD"])
+            })
+            if limit is not None and len(rows) == limit:
+                break
+    return rows
+
+
+#Reproducible synthetic transactions of `members` members, timestamps increase by a minute per transaction
+def synthetic_transactions(count: int, members: int, seed: int = 0) -> List[Dict[str, Any]]:
+    rng = random.Random(seed)
+    start = datetime.datetime(2024, 1, 1)
+    rows = []
+    for i in range(count):
+        transaction_type = rng.choice(TRANSACTION_TYPES)
+        points = rng.choice([100, 500, 1000, 5000, 10000]) * (-1 if transaction_type == "redeem" else 1)
+        rows.append({
+            "memberId": f"M{rng.randrange(members):07d}",
+            "lastTransactionUtcTs": (start + datetime.timedelta(minutes=i)).strftime("%Y-%m-%d %H:%M:%S"),
+            "lastTransactionType": transaction_type,
+            "lastTransactionPointsBought": float(points),
+            "lastTransactionRevenueUsd": 0.0 if transaction_type == "redeem" else round(points * rng.uniform(0.001, 0.02), 2)
+        })
+    return rows
+
+
+#Nearest-rank percentile of already sorted values
+def percentile(sorted_values: List[float], p: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, max(0, int(round(p / 100 * len(sorted_values))) - 1))]
+
+
+def latency_summary(latencies: List[float]) -> Dict[str, Optional[float]]:
+    values = sorted(latencies)
+    return {
+        "p50": ms(percentile(values, 50)),
+        "p95": ms(percentile(values, 95)),
+        "p99": ms(percentile(values, 99)),
+        "max": ms(values[-1] if values else None),
+        "mean": ms(sum(values) / len(values) if values else None)
+    }
+
+
+def ms(seconds: Optional[float]) -> Optional[float]:
+    return round(seconds * 1000, 3) if seconds is not None else None
+
+
+#Replays transactions against the perk app and records the latency of every request.
+#closed mode: `concurrency` workers each send their next request once the previous one is answered. Transactions are
+#partitioned on memberId like the async streamer, so a member's transactions are sent in order.
+#open mode: requests start at a fixed rate whatever the response times, and latency is measured from the scheduled
+#start, so a slow server is not hidden by a load generator that waits for it (coordinated omission)
+class LoadGenerator:
+
+    def __init__(self, url: str, transactions: List[Dict[str, Any]], mode: str = "closed", concurrency: int = 32,
+                 qps: float = 100, max_in_flight: int = 1000, transport=None):
+        self.url = url
+        self.transactions = transactions
+        self.mode = mode
+        self.concurrency = concurrency
+        self.qps = qps
+        self.max_in_flight = max_in_flight
+        self.transport = transport
+        self.latencies: List[float] = []
+        self.ok = 0
+        self.errors = 0
+        self.statuses: Dict[str, int] = {}
+
+    async def run(self) -> Dict[str, Any]:
+        connections = self.concurrency if self.mode == "closed" else self.max_in_flight
+        limits = Limits(max_connections=connections, max_keepalive_connections=connections)
+        async with AsyncClient(limits=limits, timeout=30, transport=self.transport) as client:
+            start = time.perf_counter()
+            if self.mode == "closed":
+                await self.run_closed(client)
+            else:
+                await self.run_open(client)
+            duration = time.perf_counter() - start
+
+        return {
+            "sent": self.ok + self.errors,
+            "ok": self.ok,
+            "errors": self.errors,
+            "statuses": self.statuses,
+            "duration_s": round(duration, 3),
+            "throughput_rps": round(self.ok / duration, 2) if duration else None,
+            "latency_ms": latency_summary(self.latencies)
+        }
+
+    async def run_closed(self, client: AsyncClient):
+        partitions: List[List[Dict[str, Any]]] = [[] for _ in range(self.concurrency)]
+        for transaction in self.transactions:
+            partitions[zlib.crc32(transaction["memberId"].encode()) % self.concurrency].append(transaction)
+
+        async def worker(transactions):
+            for transaction in transactions:
+                await self.send(client, transaction, time.perf_counter())
+
+        await asyncio.gather(*(worker(p) for p in partitions if p))
+
+    async def run_open(self, client: AsyncClient):
+        in_flight = asyncio.Semaphore(self.max_in_flight)
+        tasks = []
+        start = time.perf_counter()
+
+        async def scheduled(transaction, scheduled_at):
+            async with in_flight:
+                await self.send(client, transaction, scheduled_at)
+
+        for i, transaction in enumerate(self.transactions):
+            scheduled_at = start + i / self.qps
+            delay = scheduled_at - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(scheduled(transaction, scheduled_at)))
+        await asyncio.gather(*tasks)
+
+    async def send(self, client: AsyncClient, transaction: Dict[str, Any], started_at: float):
+        try:
+            response = await client.post(self.url, json=transaction)
+            status = str(response.status_code)
+            ok = 200 <= response.status_code < 300
+        except Exception as e:
+            status = type(e).__name__
+            ok = False
+        self.latencies.append(time.perf_counter() - started_at)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        if ok:
+            self.ok += 1
+        else:
+            self.errors += 1
+
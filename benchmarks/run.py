@@ -0,0 +1,335 @@
+import os
+import re
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import threading
+import subprocess
+
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import httpx
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from benchmarks.load import LoadGenerator, csv_transactions, synthetic_transactions, ms
+from src.observability.metrics import Histogram
+
+
+SERVICES = ["member_data", "prediction", "offer_engine"]
+SAMPLE_LABELS = re.compile(r'(\w+)="([^"]*)"')
+
+
+#Parses one histogram out of a Prometheus text scrape, keyed on its label values without le, in label order
+def parse_histogram(text: str, name: str) -> Dict[tuple, Histogram]:
+    buckets: Dict[tuple, Dict[float, int]] = {}
+    sums: Dict[tuple, float] = {}
+    for line in text.splitlines():
+        if not line.startswith(name + "_"):
+            continue
+        sample, value = line.rsplit(" ", 1)
+        labels = dict(SAMPLE_LABELS.findall(sample))
+        le = labels.pop("le", None)
+        key = tuple(labels.values())
+        if sample.startswith(name + "_bucket"):
+            buckets.setdefault(key, {})[float(le)] = int(float(value))
+        elif sample.startswith(name + "_sum"):
+            sums[key] = float(value)
+
+    histograms = {}
+    for key, cumulative in buckets.items():
+        bounds = sorted(cumulative)
+        histogram = Histogram(buckets=tuple(b for b in bounds if b != float("inf")))
+        previous = 0
+        for i, bound in enumerate(bounds):
+            histogram.counts[i] = cumulative[bound] - previous
+            previous = cumulative[bound]
+        histogram.count = previous
+        histogram.sum = sums.get(key, 0.0)
+        histograms[key] = histogram
+    return histograms
+
+
+#Observations made between two scrapes of the same histogram
+def histogram_delta(after: Histogram, before: Optional[Histogram]) -> Histogram:
+    delta = Histogram(buckets=after.buckets)
+    delta.counts = [a - (before.counts[i] if before else 0) for i, a in enumerate(after.counts)]
+    delta.count = after.count - (before.count if before else 0)
+    delta.sum = after.sum - (before.sum if before else 0.0)
+    return delta
+
+
+def histogram_summary(histogram: Histogram) -> dict:
+    return {
+        "count": histogram.count,
+        "p50": ms(histogram.quantile(0.5)),
+        "p95": ms(histogram.quantile(0.95)),
+        "p99": ms(histogram.quantile(0.99)),
+        "mean": ms(histogram.sum / histogram.count) if histogram.count else None
+    }
+
+
+#Summary of each label combination, keyed on the label values joined with spaces, e.g. "member_data GET 2xx"
+def histogram_report(before: str, after: str, name: str) -> dict:
+    previous = parse_histogram(before, name)
+    return {
+        " ".join(key): histogram_summary(histogram_delta(histogram, previous.get(key)))
+        for key, histogram in parse_histogram(after, name).items()
+    }
+
+
+#CPU seconds and RSS of a process and its children (uvicorn workers), read from /proc. None where /proc is missing
+def process_tree(pid: int) -> List[int]:
+    pids = [pid]
+    try:
+        for entry in os.listdir("/proc"):
+            if entry.isdigit():
+                try:
+                    with open(f"/proc/{entry}/stat") as f:
+                        if int(f.read().rsplit(")", 1)[1].split()[1]) in pids:
+                            pids.append(int(entry))
+                except (OSError, IndexError, ValueError):
+                    pass
+    except OSError:
+        pass
+    return pids
+
+
+def cpu_seconds(pids: List[int]) -> Optional[float]:
+    total = 0.0
+    try:
+        for pid in pids:
+            try:
+                with open(f"/proc/{pid}/stat") as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+                total += (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+            except FileNotFoundError:
+                pass
+    except (OSError, ValueError):
+        return None
+    return total
+
+
+def rss_mb(pids: List[int]) -> Optional[float]:
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+        except FileNotFoundError:
+            pass
+        except OSError:
+            return None
+    return round(total / 1024, 1)
+
+
+#Samples the RSS of every server every interval seconds and keeps the peak
+class ResourceSampler(threading.Thread):
+
+    def __init__(self, processes: Dict[str, subprocess.Popen], interval: float = 0.5):
+        super().__init__(daemon=True)
+        self.processes = processes
+        self.interval = interval
+        self.peak_rss: Dict[str, float] = {}
+        self.cpu_start: Dict[str, Optional[float]] = {}
+        self.stopped = threading.Event()
+
+    def trees(self) -> Dict[str, List[int]]:
+        return {name: process_tree(process.pid) for name, process in self.processes.items()}
+
+    def run(self):
+        self.cpu_start = {name: cpu_seconds(pids) for name, pids in self.trees().items()}
+        self.wall_start = time.perf_counter()
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        for name, pids in self.trees().items():
+            rss = rss_mb(pids)
+            if rss is not None:
+                self.peak_rss[name] = max(self.peak_rss.get(name, 0.0), rss)
+
+    def stop(self) -> dict:
+        self.stopped.set()
+        self.join()
+        self.sample()
+        wall = time.perf_counter() - self.wall_start
+        report = {}
+        for name, pids in self.trees().items():
+            start, end = self.cpu_start.get(name), cpu_seconds(pids)
+            used = end - start if start is not None and end is not None else None
+            report[name] = {
+                "cpu_seconds": round(used, 3) if used is not None else None,
+                "cpu_percent": round(100 * used / wall, 1) if used is not None and wall else None,
+                "peak_rss_mb": self.peak_rss.get(name)
+            }
+        return report
+
+
+#Key=value pairs per service, e.g. "prediction=5" gives {"prediction": 5.0}. A bare value applies to all services
+def per_service(values: List[str]) -> Dict[str, float]:
+    settings = {}
+    for value in values or []:
+        if "=" in value:
+            service, number = value.split("=", 1)
+            if service not in SERVICES:
+                raise ValueError(f"Unknown service {service}, expected one of {SERVICES}")
+            settings[service] = float(number)
+        else:
+            settings.update({service: float(value) for service in SERVICES})
+    return settings
+
+
+def uvicorn_command(target: str, port: int, workers: int, factory: bool = False) -> List[str]:
+    command = [sys.executable, "-m", "uvicorn", target, "--host", "127.0.0.1", "--port", str(port),
+               "--workers", str(workers), "--no-access-log", "--log-level", "warning"]
+    return command + ["--factory"] if factory else command
+
+
+#Server output goes to <name>.log in the work directory, tracebacks of injected failures would drown the report
+def server_output(workdir: str, name: str) -> dict:
+    log = open(os.path.join(workdir, f"{name}.log"), "wb")
+    return {"stdout": log, "stderr": subprocess.STDOUT}
+
+
+def wait_until_ready(url: str, process: subprocess.Popen, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{url} exited with code {process.returncode}")
+        try:
+            if httpx.get(url, timeout=1).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError(f"{url} was not ready after {timeout} seconds")
+
+
+#Starts the stand-ins and the perk app under uvicorn without reload, in workdir so their logs stay out of the repo
+def start_servers(args, workdir: str) -> Dict[str, subprocess.Popen]:
+    base_env = dict(os.environ, PYTHONPATH=str(ROOT))
+    for setting in args.env or []:
+        key, value = setting.split("=", 1)
+        base_env[key] = value
+    latency, jitter, errors = per_service(args.latency_ms), per_service(args.jitter_ms), per_service(args.error_rate)
+
+    processes = {}
+    urls = {}
+    try:
+        if args.transport == "http":
+            for i, service in enumerate(SERVICES):
+                port = args.base_port + 1 + i
+                env = dict(base_env, STANDIN_SERVICE=service, STANDIN_LATENCY_MS=str(latency.get(service, 0)),
+                           STANDIN_JITTER_MS=str(jitter.get(service, 0)), STANDIN_ERROR_RATE=str(errors.get(service, 0)),
+                           STANDIN_SEED=str(args.seed + i))
+                processes[service] = subprocess.Popen(uvicorn_command("benchmarks.standins:create_app", port, 1, factory=True),
+                                                      env=env, cwd=workdir, **server_output(workdir, service))
+                urls[service] = f"http://127.0.0.1:{port}"
+                wait_until_ready(f"{urls[service]}/health", processes[service])
+
+        env = dict(base_env, PERK_TRANSPORT=args.transport, MEMBER_DATA_URL=urls.get("member_data", ""),
+                   ML_SERVICE_URL=urls.get("prediction", ""), OFFER_SERVICE_URL=urls.get("offer_engine", ""))
+        processes["perk_app"] = subprocess.Popen(uvicorn_command("myapp.perk_app:app", args.base_port, args.perk_workers),
+                                                 env=env, cwd=workdir, **server_output(workdir, "perk_app"))
+        wait_until_ready(f"http://127.0.0.1:{args.base_port}/metrics", processes["perk_app"])
+    except Exception:
+        stop_servers(processes)
+        raise
+    return processes
+
+
+def stop_servers(processes: Dict[str, subprocess.Popen]):
+    for process in processes.values():
+        process.terminate()
+    for process in processes.values():
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_transactions(args) -> list:
+    if args.source == "synthetic":
+        return synthetic_transactions(args.warmup + args.requests, args.members, args.seed)
+    rows = csv_transactions(args.file)
+    #The file is replayed as many times as needed, later passes only add history to the same members
+    needed = args.warmup + args.requests
+    return [rows[i % len(rows)] for i in range(needed)]
+
+
+def benchmark(args) -> dict:
+    transactions = load_transactions(args)
+    warmup, measured = transactions[:args.warmup], transactions[args.warmup:]
+    url = f"http://127.0.0.1:{args.base_port}/api/requests/v1"
+    metrics_url = f"http://127.0.0.1:{args.base_port}/metrics"
+
+    with tempfile.TemporaryDirectory(prefix="perk-bench-") as workdir:
+        processes = start_servers(args, workdir)
+        try:
+            if warmup:
+                asyncio.run(LoadGenerator(url, warmup, "closed", args.concurrency).run())
+            before = httpx.get(metrics_url).text
+            sampler = ResourceSampler(processes)
+            sampler.start()
+            load = asyncio.run(LoadGenerator(url, measured, args.mode, args.concurrency, args.qps, args.max_in_flight).run())
+            resources = sampler.stop()
+            after = httpx.get(metrics_url).text
+        finally:
+            stop_servers(processes)
+
+    return {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        **load,
+        #Stage and downstream latencies are scraped from the perk app, from one worker only when there are several
+        "stages_ms": histogram_report(before, after, "perk_stage_latency_seconds"),
+        "downstream_ms": histogram_report(before, after, "perk_downstream_request_duration_seconds"),
+        "processes": resources
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks the perk app pipeline and prints a JSON report")
+    parser.add_argument("--source", choices=["csv", "synthetic"], default="csv")
+    parser.add_argument("--file", default=str(ROOT / "data" / "member_data.csv"))
+    parser.add_argument("--members", type=int, default=1000, help="synthetic source: number of distinct members")
+    parser.add_argument("--requests", type=int, default=2000, help="measured requests")
+    parser.add_argument("--warmup", type=int, default=200, help="requests sent before measuring")
+    parser.add_argument("--mode", choices=["closed", "open"], default="closed")
+    parser.add_argument("--concurrency", type=int, default=32, help="closed mode: concurrent clients")
+    parser.add_argument("--qps", type=float, default=200, help="open mode: requests started per second")
+    parser.add_argument("--max-in-flight", type=int, default=1000, help="open mode: cap on outstanding requests")
+    parser.add_argument("--transport", choices=["http", "embedded"], default="http")
+    parser.add_argument("--perk-workers", type=int, default=1)
+    parser.add_argument("--latency-ms", action="append", help="stand-in latency, SERVICE=MS or MS for all, repeatable")
+    parser.add_argument("--jitter-ms", action="append", help="stand-in random extra latency, SERVICE=MS or MS")
+    parser.add_argument("--error-rate", action="append", help="stand-in 503 rate, SERVICE=RATE or RATE")
+    parser.add_argument("--env", action="append", help="extra KEY=VALUE environment for every server, repeatable")
+    parser.add_argument("--base-port", type=int, default=7000, help="perk app port, the stand-ins use the next three")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="also write the report to this file")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = json.dumps(benchmark(args), indent=2)
+    if args.output:
+        Path(args.output).write_text(report + "\n")
+    print(report)
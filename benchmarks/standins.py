@@ -0,0 +1,47 @@
+import os
+import json
+import random
+import asyncio
+
+from src.applications import member_data, prediction, offer_engine
+
+
+APPLICATIONS = {"member_data": member_data.app, "prediction": prediction.app, "offer_engine": offer_engine.app}
+
+
+#Wraps a real application and delays every request by latency_ms plus up to jitter_ms, then fails error_rate of them
+#with a 503. /health and /metrics are left alone so that readiness checks and scrapes are not skewed
+class InjectedFaults:
+
+    def __init__(self,app,latency_ms:float=0,jitter_ms:float=0,error_rate:float=0,seed:int=None):
+        self.app = app
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+
+    async def __call__(self,scope,receive,send):
+        if scope["type"] != "http" or scope["path"] in ("/health","/metrics"):
+            return await self.app(scope,receive,send)
+
+        delay = self.latency + self.random.uniform(0,self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if self.error_rate and self.random.random() < self.error_rate:
+            body = json.dumps({"detail":"Injected failure"}).encode()
+            await send({"type":"http.response.start","status":503,"headers":[(b"content-type",b"application/json"),(b"content-length",str(len(body)).encode())]})
+            await send({"type":"http.response.body","body":body})
+            return
+        await self.app(scope,receive,send)
+
+
+#uvicorn factory, the wrapped application and its faults come from STANDIN_* environment variables:
+#uvicorn --factory benchmarks.standins:create_app with STANDIN_SERVICE=prediction STANDIN_LATENCY_MS=5
+def create_app():
+    return InjectedFaults(
+        APPLICATIONS[os.environ["STANDIN_SERVICE"]],
+        latency_ms = float(os.getenv("STANDIN_LATENCY_MS","0")),
+        jitter_ms = float(os.getenv("STANDIN_JITTER_MS","0")),
+        error_rate = float(os.getenv("STANDIN_ERROR_RATE","0")),
+        seed = int(os.environ["STANDIN_SEED"]) if os.getenv("STANDIN_SEED") else None
+    )
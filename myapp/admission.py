@@ -0,0 +1,104 @@
+import time
+import asyncio
+
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Optional
+
+from myapp.dependency_client import request_deadline
+from src.observability.metrics import Counter, Histogram
+
+
+class AdmissionRejected(Exception):
+
+    def __init__(self,reason:str):
+        super().__init__(f"Request not admitted: {reason}")
+        self.reason = reason
+
+
+#Admission control in front of the offer pipeline. At most max_concurrency requests run at once, the others wait in a
+#bounded FIFO queue. Every request has a deadline (timeout seconds from its arrival): it is turned away as soon as it
+#can no longer be served in time, i.e. when the time left is below the expected service time (a moving average of
+#recent requests), on arrival or while queued, instead of being started and timing out. Admitted requests carry their
+#deadline to the downstream calls (see request_deadline). Requests are rejected with AdmissionRejected whose reason is
+#"queue_full" or "deadline"
+class AdmissionController:
+
+    def __init__(self,max_concurrency:int=200,max_queue:int=1000,timeout:float=2.0,shed: Optional[Counter] = None,
+                 queue_time: Optional[Histogram] = None,smoothing:float=0.1):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.shed = shed
+        self.queue_time = queue_time
+        self.smoothing = smoothing
+        self.in_flight = 0
+        self.waiters: deque = deque()
+        self.service_time = 0.0
+
+    #timeout overrides the default one, e.g. with the client's own
+    @asynccontextmanager
+    async def admit(self,timeout: Optional[float] = None):
+        arrival = time.perf_counter()
+        deadline = arrival + (timeout if timeout is not None else self.timeout)
+        try:
+            await self.acquire(deadline)
+        except AdmissionRejected as e:
+            if self.shed is not None:
+                self.shed.labels(e.reason).inc()
+            raise
+        start = time.perf_counter()
+        if self.queue_time is not None:
+            self.queue_time.observe(start - arrival)
+        token = request_deadline.set(deadline)
+        try:
+            yield deadline
+        finally:
+            request_deadline.reset(token)
+            self.service_time += self.smoothing * (time.perf_counter() - start - self.service_time)
+            self.release()
+
+    def can_finish(self,deadline:float) -> bool:
+        return deadline - time.perf_counter() > self.service_time
+
+    async def acquire(self,deadline:float):
+        if not self.can_finish(deadline):
+            raise AdmissionRejected("deadline")
+        if self.in_flight < self.max_concurrency and not self.waiters:
+            self.in_flight += 1
+            return
+        if len(self.waiters) >= self.max_queue:
+            raise AdmissionRejected("queue_full")
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (future,deadline)
+        self.waiters.append(entry)
+        try:
+            await asyncio.wait_for(asyncio.shield(future),deadline - time.perf_counter() - self.service_time)
+        except (asyncio.TimeoutError,asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                #The slot was handed over just as the wait ended, it goes to the next request
+                self.release()
+            else:
+                future.cancel()
+                if entry in self.waiters:
+                    self.waiters.remove(entry)
+            if isinstance(e,asyncio.CancelledError):
+                raise
+            raise AdmissionRejected("deadline")
+
+    #Hands the slot to the oldest waiter that can still make its deadline, waiters that cannot are rejected now
+    def release(self):
+        while self.waiters:
+            future, deadline = self.waiters.popleft()
+            if future.done():
+                continue
+            if not self.can_finish(deadline):
+                future.set_exception(AdmissionRejected("deadline"))
+                continue
+            future.set_result(None)
+            return
+        self.in_flight -= 1
+
+    def __len__(self):
+        return len(self.waiters)
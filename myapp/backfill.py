@@ -0,0 +1,183 @@
+import os
+import sys
+import csv
+import heapq
+import logging
+import argparse
+import tempfile
+import zlib
+import numpy as np
+
+from multiprocessing import Pool
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from src.features.engine import registry, now_epoch
+from src.features.aggregates import apply_member_transaction, aggregate_stats
+from src.models.member_aggregate import MemberAggregate
+from src.models.member_features import MemberFeatures
+from src.applications.prediction import predict_ats_batch, predict_resp_batch
+from src.applications.offer_rules import CompiledRules, OfferRuleTable, DEFAULT_RULES_PATH
+from src.storage.member_store import parse_timestamp
+from myapp.log_writer import TRANSACTIONS_CSV_COLUMNS
+
+
+#Offline counterpart of the perk app: replays a member data csv without any of the HTTP services and writes one
+#transactions.csv row per transaction. Features come from the same feature engine, predictions from the same
+#vectorized models and offers from the same compiled rules, so a row holds what the perk app would have answered.
+#Members are hash-partitioned over worker processes: the input is read once, each worker gets its members' rows, keeps
+#their running aggregates and scores its rows chunk by chunk. Results are merged back in input order
+
+FEATURE_NAMES = list(MemberFeatures.model_fields)
+FEATURE_TYPES = {name: field.annotation for name, field in MemberFeatures.model_fields.items()}
+CORE_FEATURES = [registry.features[name] for name in FEATURE_NAMES]
+
+
+def partition_for(member_id: str, partitions: int) -> int:
+    return zlib.crc32(member_id.encode()) % partitions
+
+
+#Rows of the input file with their position, rows with empty fields are skipped like the streamer does
+def read_rows(path: str) -> Iterator[Tuple[int, Dict[str, str]]]:
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        for i, row in enumerate(csv.DictReader(f)):
+            if any(value == "" or value is None for value in row.values()):
+                continue
+            yield i, row
+
+
+#Writes every row, prefixed with its position, to the share of its member's partition and returns the input columns
+def split_rows(path: str, shares: List[str]) -> List[str]:
+    files = [open(share, "w", encoding="utf-8", newline="") for share in shares]
+    try:
+        writers = [csv.writer(f) for f in files]
+        fieldnames = None
+        for i, row in read_rows(path):
+            fieldnames = fieldnames or list(row)
+            writers[partition_for(row["memberId"], len(shares))].writerow([i, *row.values()])
+        return fieldnames or []
+    finally:
+        for f in files:
+            f.close()
+
+
+def read_share(share_path: str, fieldnames: List[str]) -> Iterator[Tuple[int, Dict[str, str]]]:
+    with open(share_path, "r", encoding="utf-8", newline="") as f:
+        for row in csv.reader(f):
+            yield int(row[0]), dict(zip(fieldnames, row[1:]))
+
+
+def chunks(rows: Iterator, size: int) -> Iterator[List]:
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+#Scores one chunk: running features row by row (they depend on the member's earlier rows), then predictions and
+#offers for the whole chunk at once
+def score_chunk(chunk: List[Tuple[int, Dict[str, str]]], members: Dict[str, MemberAggregate], rules: CompiledRules, now: int):
+    indices, member_ids, features = [], [], {name: [] for name in FEATURE_NAMES}
+    for i, row in chunk:
+        try:
+            ts = parse_timestamp(row["lastTransactionUtcTs"])
+            points = float(row["lastTransactionPointsBought"])
+            revenue = float(row["lastTransactionRevenueUSD"])
+        except ValueError as e:
+            logging.warning(f"Row {i} skipped: {e}")
+            continue
+        aggregate = members.get(row["memberId"])
+        if aggregate is None:
+            aggregate = members[row["memberId"]] = MemberAggregate()
+        stats = aggregate_stats(apply_member_transaction(aggregate, points, revenue, row["lastTransactionType"], ts))
+        for feature in CORE_FEATURES:
+            features[feature.name].append(FEATURE_TYPES[feature.name](feature.compute(stats, now)))
+        indices.append(i)
+        member_ids.append(row["memberId"])
+
+    if not indices:
+        return []
+    columns = {name: np.asarray(values, dtype=np.float64) for name, values in features.items()}
+    ats = predict_ats_batch(columns)
+    resp = predict_resp_batch(columns)
+    offers = rules.evaluate_batch(ats, resp)
+    ats, resp = ats.tolist(), resp.tolist()
+
+    return [
+        (index, [member_id, *(features[name][k] for name in FEATURE_NAMES), ats[k], resp[k], offers[k]])
+        for k, (index, member_id) in enumerate(zip(indices, member_ids))
+    ]
+
+
+#Scores rows and writes them, prefixed with their input position, to out_path
+def score_rows(rows: Iterator[Tuple[int, Dict[str, str]]], out_path: str, chunk_size: int, now: int, rules_path: str) -> int:
+    rules = OfferRuleTable(rules_path, check_interval=0).rules
+    members: Dict[str, MemberAggregate] = {}
+    written = 0
+    with open(out_path, "w", encoding="utf-8", newline="") as out:
+        writer = csv.writer(out)
+        for chunk in chunks(rows, chunk_size):
+            for index, values in score_chunk(chunk, members, rules, now):
+                writer.writerow([index, *values])
+                written += 1
+    return written
+
+
+#Worker side: the share of one partition, as written by split_rows
+def score_partition(share_path: str, fieldnames: List[str], out_path: str, chunk_size: int, now: int, rules_path: str) -> int:
+    return score_rows(read_share(share_path, fieldnames), out_path, chunk_size, now, rules_path)
+
+
+def read_partition(out_path: str) -> Iterator[Tuple[int, List[str]]]:
+    with open(out_path, "r", encoding="utf-8", newline="") as f:
+        for row in csv.reader(f):
+            yield int(row[0]), row[1:]
+
+
+def backfill(path: str, output: str, workers: Optional[int] = None, chunk_size: int = 10000, now: Optional[int] = None,
+             rules_path: str = DEFAULT_RULES_PATH) -> int:
+    workers = workers or os.cpu_count() or 1
+    now = now_epoch() if now is None else now
+    latency_columns = len(TRANSACTIONS_CSV_COLUMNS) - 1 - len(FEATURE_NAMES) - 3
+
+    with tempfile.TemporaryDirectory(prefix="backfill-") as tmp:
+        parts = [os.path.join(tmp, f"partition-{p}.csv") for p in range(workers)]
+        if workers == 1:
+            counts = [score_rows(read_rows(path), parts[0], chunk_size, now, rules_path)]
+        else:
+            shares = [os.path.join(tmp, f"share-{p}.csv") for p in range(workers)]
+            fieldnames = split_rows(path, shares)
+            with Pool(workers) as pool:
+                counts = pool.starmap(score_partition, [(shares[p], fieldnames, parts[p], chunk_size, now, rules_path)
+                                                        for p in range(workers)])
+
+        os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+        with open(output, "w", encoding="utf-8", newline="") as out:
+            writer = csv.writer(out)
+            writer.writerow(TRANSACTIONS_CSV_COLUMNS)
+            #The backfill has no request latencies, those columns stay empty
+            for _, values in heapq.merge(*(read_partition(part) for part in parts), key=lambda item: item[0]):
+                writer.writerow(values + [""] * latency_columns)
+    return sum(counts)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scores a member data csv offline, in the logs/transactions.csv format")
+    parser.add_argument("--file", default="data/member_data.csv")
+    parser.add_argument("--output", default="logs/transactions_backfill.csv")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, one per core by default")
+    parser.add_argument("--chunk-size", type=int, default=10000, help="rows scored together by a worker")
+    parser.add_argument("--now", default=None, help="reference time for DAYS_SINCE_LAST_TRANSACTION, YYYY-MM-DD HH:MM:SS, now by default")
+    parser.add_argument("--rules", default=os.getenv("OFFER_RULES_PATH", DEFAULT_RULES_PATH))
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    count = backfill(args.file, args.output, args.workers, args.chunk_size,
+                     parse_timestamp(args.now) if args.now else None, args.rules)
+    logging.info(f"{count} transactions scored into {args.output}")
@@ -0,0 +1,246 @@
+import os
+import time
+import asyncio
+import logging
+import contextvars
+
+from contextlib import contextmanager
+from typing import Optional
+from httpx import AsyncClient, Limits, Timeout, TimeoutException
+from src.observability.metrics import Histogram
+from src.observability.profiling import record_span
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+#Raised instead of calling a dependency when the request has no time left, or when a call ran out of it
+class DeadlineExceeded(Exception):
+    pass
+
+
+#time.perf_counter() by which the request being handled must be answered, None when it has no deadline
+request_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("request_deadline", default=None)
+
+
+#Calls made here run without the request's deadline, for work that must not be dropped for lack of time (saves)
+@contextmanager
+def no_deadline():
+    token = request_deadline.set(None)
+    try:
+        yield
+    finally:
+        request_deadline.reset(token)
+
+
+#Opens after failure_threshold consecutive failures and then fails fast for reset_timeout seconds.
+#After that a single trial call is let through (half-open): its success closes the circuit, its failure opens it again
+class CircuitBreaker:
+
+    def __init__(self,name:str,failure_threshold:int=5,reset_timeout:float=10.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.short_circuited = 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if self.trial_in_flight else "open"
+
+    def before_call(self):
+        if self.opened_at is None:
+            return
+        if self.trial_in_flight or time.monotonic() - self.opened_at < self.reset_timeout:
+            self.short_circuited += 1
+            raise CircuitOpenError(f"Circuit open for {self.name}")
+        self.trial_in_flight = True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    #The call ended without telling whether the dependency is healthy (the caller ran out of time): the next call is the trial
+    def record_inconclusive(self):
+        self.trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failure_threshold and (self.trial_in_flight or self.failures >= self.failure_threshold):
+            if self.opened_at is None or self.trial_in_flight:
+                logging.warning(f"Circuit opened for {self.name} after {self.failures} consecutive failures")
+            self.opened_at = time.monotonic()
+            self.trial_in_flight = False
+
+
+#Recent call latencies in a fixed size ring, the sorted copy used for percentiles is refreshed every few records
+class LatencyTracker:
+
+    def __init__(self,size:int=512,min_samples:int=50):
+        self.samples = [0.0]*size
+        self.count = 0
+        self.min_samples = min_samples
+        self.sorted_samples = []
+
+    def record(self,latency:float):
+        self.samples[self.count % len(self.samples)] = latency
+        self.count += 1
+        if self.count % 32 == 0 or self.count == self.min_samples:
+            self.sorted_samples = sorted(self.samples[:min(self.count,len(self.samples))])
+
+    #None until enough samples were recorded
+    def percentile(self,p:float):
+        if self.count < self.min_samples or not self.sorted_samples:
+            return None
+        return self.sorted_samples[min(len(self.sorted_samples) - 1,int(len(self.sorted_samples)*p/100))]
+
+
+#Settings of one downstream dependency, read from <PREFIX>_* environment variables
+class DependencyConfig:
+
+    def __init__(self,prefix:str):
+        def env(name,default):
+            return os.getenv(f"{prefix}_{name}",default)
+
+        self.name = prefix.lower()
+        self.max_connections = int(env("MAX_CONNECTIONS","100"))
+        self.max_keepalive_connections = int(env("MAX_KEEPALIVE_CONNECTIONS","20"))
+        self.keepalive_expiry = float(env("KEEPALIVE_EXPIRY","30"))
+        self.connect_timeout = float(env("CONNECT_TIMEOUT","1.0"))
+        self.read_timeout = float(env("READ_TIMEOUT","5.0"))
+        self.http2 = env("HTTP2","0") == "1"
+        #Percentile of recent latencies after which a read-only call is hedged, 0 disables hedging
+        self.hedge_percentile = float(env("HEDGE_PERCENTILE","0"))
+        #Consecutive failures that open the circuit, 0 disables the breaker
+        self.breaker_failures = int(env("BREAKER_FAILURES","5"))
+        self.breaker_reset_timeout = float(env("BREAKER_RESET_TIMEOUT","10"))
+        #Seconds after which a call that timed out counts as a failure, even when the request deadline ended it
+        self.breaker_slow_call = float(env("BREAKER_SLOW_CALL","1.0"))
+
+
+#Connection pool of a single dependency with its own timeouts, optional hedging of read-only calls and a circuit breaker.
+#Responses with a 5xx status and transport errors count as failures, other statuses are returned to the caller as is
+class DependencyClient:
+
+    def __init__(self,config: DependencyConfig,client: AsyncClient = None,latency: Histogram = None):
+        self.config = config
+        self.client = client or self.build_client(config)
+        self.breaker = CircuitBreaker(config.name,config.breaker_failures,config.breaker_reset_timeout)
+        self.latencies = LatencyTracker()
+        self.hedged_requests = 0
+        #Optional histogram labelled by dependency, method and outcome (status code class or "error")
+        self.latency = latency
+
+    @classmethod
+    def from_env(cls,prefix:str,latency: Histogram = None):
+        return cls(DependencyConfig(prefix),latency=latency)
+
+    @staticmethod
+    def build_client(config: DependencyConfig) -> AsyncClient:
+        limits = Limits(max_connections=config.max_connections,
+                        max_keepalive_connections=config.max_keepalive_connections,
+                        keepalive_expiry=config.keepalive_expiry)
+        timeout = Timeout(config.read_timeout,connect=config.connect_timeout)
+        try:
+            return AsyncClient(limits=limits,timeout=timeout,http2=config.http2)
+        except ImportError:
+            logging.warning(f"HTTP/2 requested for {config.name} but the h2 package is missing, using HTTP/1.1")
+            return AsyncClient(limits=limits,timeout=timeout)
+
+    async def get(self,url:str,hedge:bool=False,**kwargs):
+        return await self.request("GET",url,hedge,**kwargs)
+
+    async def post(self,url:str,hedge:bool=False,**kwargs):
+        return await self.request("POST",url,hedge,**kwargs)
+
+    #Within a request deadline the call's timeouts are capped by the time left, running out of it raises DeadlineExceeded.
+    #Only a call cut short says nothing about the dependency: one that ran for breaker_slow_call seconds is a failure
+    #whoever's deadline ended it, or a hung dependency would never open the circuit while deadlines are below READ_TIMEOUT
+    async def request(self,method:str,url:str,hedge:bool=False,**kwargs):
+        budget = self.budget()
+        if budget is not None:
+            if budget <= 0:
+                raise DeadlineExceeded(f"No time left to call {self.config.name}")
+            kwargs["timeout"] = Timeout(min(self.config.read_timeout,budget),connect=min(self.config.connect_timeout,budget))
+        self.breaker.before_call()
+        start = time.perf_counter()
+        try:
+            delay = self.latencies.percentile(self.config.hedge_percentile) if hedge and self.config.hedge_percentile else None
+            if delay is None:
+                response = await self.client.request(method,url,**kwargs)
+            else:
+                response = await self.hedged_request(delay,method,url,**kwargs)
+        except TimeoutException as e:
+            self.observe(method,"error",start)
+            deadline_ended = budget is not None and budget < self.config.read_timeout
+            if deadline_ended and time.perf_counter() - start < self.config.breaker_slow_call:
+                self.breaker.record_inconclusive()
+            else:
+                self.breaker.record_failure()
+            if deadline_ended:
+                raise DeadlineExceeded(f"{self.config.name} did not answer within the request deadline") from e
+            raise
+        except Exception:
+            self.breaker.record_failure()
+            self.observe(method,"error",start)
+            raise
+        except BaseException:
+            #Cancelled (e.g. the client went away): a half-open trial must not stay in flight forever
+            self.breaker.record_inconclusive()
+            raise
+
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+            self.latencies.record(time.perf_counter() - start)
+        self.observe(method,f"{response.status_code // 100}xx",start)
+        return response
+
+    @staticmethod
+    def budget() -> Optional[float]:
+        deadline = request_deadline.get()
+        return deadline - time.perf_counter() if deadline is not None else None
+
+    def observe(self,method:str,outcome:str,start:float):
+        duration = time.perf_counter() - start
+        if self.latency is not None:
+            self.latency.labels(self.config.name,method,outcome).observe(duration)
+        record_span(f"{self.config.name} {method} {outcome}",duration)
+
+    #Sends a second identical request when the first one is slower than delay and returns whichever succeeds first.
+    #A 5xx is no success: the other request is waited for, the 5xx is returned only when neither succeeds
+    async def hedged_request(self,delay:float,method:str,url:str,**kwargs):
+        tasks = [asyncio.create_task(self.client.request(method,url,**kwargs))]
+        try:
+            done, _ = await asyncio.wait(tasks,timeout=delay)
+            if not done:
+                self.hedged_requests += 1
+                tasks.append(asyncio.create_task(self.client.request(method,url,**kwargs)))
+
+            pending = set(tasks)
+            error, failed = None, None
+            while pending:
+                done, pending = await asyncio.wait(pending,return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                    elif task.result().status_code >= 500:
+                        failed = task.result()
+                    else:
+                        return task.result()
+            if failed is not None:
+                return failed
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def aclose(self):
+        await self.client.aclose()
@@ -1,12 +1,20 @@
 import os
 import sys
 import csv
+import time
+import zlib
+import asyncio
 import logging
+import argparse
 import requests
 
+from httpx import AsyncClient, Limits
 from pathlib import Path
 
 
+PERK_APP_URL = os.getenv("PERK_APP_URL", "http://localhost:6000")
+
+
 #http logs
 logging.basicConfig(
     level = logging.INFO,
@@ -19,8 +27,13 @@ logging.basicConfig(
 class EventStreamer:
     
     #File presence and size check
-    def __init__(self,p:str):
+    #concurrency and rate (requests per second) only apply to the async mode, transport is an optional httpx transport
+    def __init__(self,p:str,url:str=f"{PERK_APP_URL}/api/requests/v1",concurrency:int=32,rate:float=None,transport=None):
         self.path = p
+        self.url = url
+        self.concurrency = concurrency
+        self.rate = rate
+        self.transport = transport
         file = Path(p)
         if not file.is_file():
             raise FileNotFoundError("File does not exist! \n")
@@ -29,12 +42,15 @@ class EventStreamer:
 
         
     #Master function that manages sending requests
-    def requests_manager(self):
+    def requests_manager(self,mode:str="sync"):
         try:
 
             with open(self.path,"r",encoding="utf-8") as f:
                 stream = csv.DictReader(f)
-                self.send_requests(stream)
+                if mode == "async":
+                    asyncio.run(self.send_requests_async(stream))
+                else:
+                    self.send_requests(stream)
 
         except csv.Error as e:
             logging.error(f"CSV error: {e}")
@@ -51,14 +67,14 @@ class EventStreamer:
         i = 1
         
         for row in s:
-            if row["memberId"] == "" or row["lastTransactionUtcTs"] == "" or row["lastTransactionType"] == "" or row["lastTransactionPointsBought"] == "" or row["lastTransactionRevenueUSD"] == "":
+            if self.has_empty_fields(row):
                 logging.info(f"Row {i} skipped: empty fields found")
                 skipped_count += 1
                 continue
             else:
                 try:
                     row = self.transform_row(row)
-                    request_response = requests.post("http://localhost:6000/api/requests/v1",json=row)
+                    request_response = requests.post(self.url,json=row)
                     if  200 <= request_response.status_code < 300:
                         logging.info(f"Row {i} sent successfully: {request_response.status_code}")
                         sent_count += 1 
@@ -72,6 +88,78 @@ class EventStreamer:
             self.progress_bar(i)  
             i += 1
 
+        self.log_summary(sent_count,skipped_count,failed_count)
+
+
+    #Async counterpart of send_requests: pooled keep-alive connections and one worker per partition.
+    #Rows are partitioned on memberId, so a member's events are always sent in file order by the same worker
+    async def send_requests_async(self,s):
+        self.sent_count = 0
+        self.skipped_count = 0
+        self.failed_count = 0
+        self.completed_count = 0
+        self.next_send_time = time.perf_counter()
+
+        partitions = [asyncio.Queue(maxsize=100) for _ in range(self.concurrency)]
+        limits = Limits(max_connections=self.concurrency,max_keepalive_connections=self.concurrency)
+
+        async with AsyncClient(limits=limits,transport=self.transport) as client:
+            workers = [asyncio.create_task(self.partition_worker(client,q)) for q in partitions]
+
+            i = 1
+            for row in s:
+                if self.has_empty_fields(row):
+                    logging.info(f"Row {i} skipped: empty fields found")
+                    self.skipped_count += 1
+                    continue
+                partition = zlib.crc32(row["memberId"].encode()) % self.concurrency
+                await partitions[partition].put((i,row))
+                i += 1
+
+            for q in partitions:
+                await q.put(None)
+            await asyncio.gather(*workers)
+
+        self.log_summary(self.sent_count,self.skipped_count,self.failed_count)
+
+    #Sends the rows of one partition one after the other, keeping the per-member order
+    async def partition_worker(self,client:AsyncClient,q:asyncio.Queue):
+        while True:
+            item = await q.get()
+            if item is None:
+                return
+            i,row = item
+            await self.wait_for_rate()
+            try:
+                row = self.transform_row(row)
+                request_response = await client.post(self.url,json=row)
+                if  200 <= request_response.status_code < 300:
+                    logging.info(f"Row {i} sent successfully: {request_response.status_code}")
+                    self.sent_count += 1
+                else:
+                    logging.warning(f"Error while attempting to process row {i} {request_response.status_code}")
+                    self.failed_count += 1
+            except Exception as e:
+                self.failed_count += 1
+                logging.error(f"Exception sending row {i}: {e}")
+
+            self.completed_count += 1
+            self.progress_bar(self.completed_count)
+
+    #Spaces sends evenly when a target rate is set, shared across all partition workers
+    async def wait_for_rate(self):
+        if not self.rate:
+            return
+        now = time.perf_counter()
+        send_time = max(now,self.next_send_time)
+        self.next_send_time = send_time + 1/self.rate
+        if send_time > now:
+            await asyncio.sleep(send_time - now)
+
+    def has_empty_fields(self,row):
+        return row["memberId"] == "" or row["lastTransactionUtcTs"] == "" or row["lastTransactionType"] == "" or row["lastTransactionPointsBought"] == "" or row["lastTransactionRevenueUSD"] == ""
+
+    def log_summary(self,sent_count,skipped_count,failed_count):
         logging.info("\n\n")
         logging.info("===================================================================")
         logging.info(f"Successfully sent rows count: {sent_count}")
@@ -94,13 +182,21 @@ class EventStreamer:
 
 
 
-print("\nStream started.... \n")
-print("=====================================================\n\n")
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replays a member data csv file against the perk app")
+    parser.add_argument("--file",default="data/member_data.csv")
+    parser.add_argument("--mode",choices=["sync","async"],default="sync")
+    parser.add_argument("--concurrency",type=int,default=32,help="async mode: number of member partitions and pooled connections")
+    parser.add_argument("--rate",type=float,default=None,help="async mode: target requests per second, unlimited by default")
+    args = parser.parse_args()
+
+    print("\nStream started.... \n")
+    print("=====================================================\n\n")
 
-s = EventStreamer("data/member_data.csv")
-print("Progress: ",end="")
-s.requests_manager()
+    s = EventStreamer(args.file,concurrency=args.concurrency,rate=args.rate)
+    print("Progress: ",end="")
+    s.requests_manager(args.mode)
 
-print("\n")
-print("=====================================================\n")
-print("Stream ended! \n")
\ No newline at end of file
+    print("\n")
+    print("=====================================================\n")
+    print("Stream ended! \n")
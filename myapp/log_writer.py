@@ -0,0 +1,188 @@
+import io
+import os
+import csv
+import queue
+import random
+import logging
+import threading
+import time
+
+from logging.handlers import QueueHandler
+from typing import Dict, List
+
+
+STOP = object()
+
+#Failures of the writer itself go to stderr: the files it writes may be what is failing, and a record sent back to the
+#writer would only fail again
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.StreamHandler())
+logger.propagate = False
+
+#Columns of logs/transactions.csv, one row per processed transaction
+TRANSACTIONS_CSV_COLUMNS = ['memberId', 'AVG_POINTS_BOUGHT', 'AVG_REVENUE_USD', 'LAST_3_TRANSACTIONS_AVG_POINTS_BOUGHT',
+'LAST_3_TRANSACTIONS_AVG_REVENUE_USD', 'PCT_BUY_TRANSACTIONS', 'PCT_GIFT_TRANSACTIONS', 'PCT_REDEEM_TRANSACTIONS', 
+'DAYS_SINCE_LAST_TRANSACTION', 'ats', 'resp', 'offer', 'fetch_member_data_latency', 'calculate_features_latency', 
+'get_predictions_latency', 'assign_offer_latency', 'total_latency']
+
+
+#Append-only file that rolls over to path.1, path.2, ... once it grows past max_bytes.
+#The header, if any, is written at the top of every new file
+class RotatingFile:
+
+    def __init__(self,path:str,max_bytes:int,backup_count:int,header:str=""):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.header = header
+        self.file = None
+
+    def open(self):
+        os.makedirs(os.path.dirname(self.path) or ".",exist_ok=True)
+        self.file = open(self.path,"a",newline="",encoding="utf-8")
+        if self.file.tell() == 0 and self.header:
+            self.file.write(self.header)
+
+    def write(self,text:str):
+        if self.file is None:
+            self.open()
+        if self.max_bytes and self.file.tell() + len(text) > self.max_bytes and self.file.tell() > len(self.header):
+            self.rotate()
+        self.file.write(text)
+
+    def rotate(self):
+        self.file.close()
+        for i in range(self.backup_count - 1,0,-1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}",f"{self.path}.{i + 1}")
+        if self.backup_count > 0:
+            os.replace(self.path,f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.open()
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+#Keeps only a fraction of the INFO records (the per-request success lines), warnings and errors always go through
+class InfoSampler(logging.Filter):
+
+    def __init__(self,rate:float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self,record):
+        return record.levelno != logging.INFO or self.rate >= 1 or random.random() < self.rate
+
+
+#QueueHandler that drops the record instead of failing when the queue is full
+class DroppingQueueHandler(QueueHandler):
+
+    def __init__(self,pending: queue.Queue,on_drop):
+        super().__init__(pending)
+        self.on_drop = on_drop
+
+    def enqueue(self,record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.on_drop(record)
+
+
+#Background writer for the transactions csv and the processed requests log.
+#Request handlers only enqueue, a thread batches rows and log records and writes them once batch_size
+#items are pending or flush_interval seconds have passed, keeping file I/O off the event loop.
+#At most max_pending items wait to be written (0 for no limit): when the disk falls behind, new rows and records are
+#dropped and counted rather than piling up in memory
+class BufferedLogWriter:
+
+    def __init__(self,csv_path:str,csv_columns:List[str],log_path:str,log_format:str,
+                 batch_size:int=500,flush_interval:float=0.5,max_bytes:int=50*1024*1024,backup_count:int=5,
+                 info_sample_rate:float=1.0,max_pending:int=100000):
+        self.csv_columns = csv_columns
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.csv_file = RotatingFile(csv_path,max_bytes,backup_count,header=",".join(csv_columns) + "\r\n")
+        self.log_file = RotatingFile(log_path,max_bytes,backup_count)
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = None
+        self.lock = threading.Lock()
+        self.dropped_rows = 0
+        self.dropped_records = 0
+        self.failed_rows = 0
+        self.failed_records = 0
+
+        self.handler = DroppingQueueHandler(self.queue,self.drop_record)
+        self.handler.setFormatter(logging.Formatter(log_format))
+        self.handler.addFilter(InfoSampler(info_sample_rate))
+
+    def write_row(self,row: Dict):
+        try:
+            self.queue.put_nowait(row)
+        except queue.Full:
+            with self.lock:
+                self.dropped_rows += 1
+
+    def drop_record(self,record: logging.LogRecord):
+        with self.lock:
+            self.dropped_records += 1
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run,name="log-writer",daemon=True)
+            self.thread.start()
+
+    #Flushes everything still queued and closes the files
+    def stop(self):
+        if self.thread is not None:
+            self.queue.put(STOP)
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        rows, records = [], []
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                item = self.queue.get(timeout=max(0,deadline - time.monotonic()))
+                if item is STOP:
+                    break
+                if isinstance(item,logging.LogRecord):
+                    records.append(item)
+                else:
+                    rows.append(item)
+            except queue.Empty:
+                pass
+
+            if len(rows) + len(records) >= self.batch_size or time.monotonic() >= deadline:
+                self.flush(rows,records)
+                rows, records = [], []
+                deadline = time.monotonic() + self.flush_interval
+
+        self.flush(rows,records)
+        self.csv_file.close()
+        self.log_file.close()
+
+    def flush(self,rows: List[Dict],records: List[logging.LogRecord]):
+        try:
+            if rows:
+                buffer = io.StringIO()
+                csv.DictWriter(buffer,fieldnames=self.csv_columns).writerows(rows)
+                self.csv_file.write(buffer.getvalue())
+                self.csv_file.flush()
+            if records:
+                #QueueHandler already formatted the records, msg holds the final line
+                self.log_file.write("".join(f"{r.msg}\n" for r in records))
+                self.log_file.flush()
+        except Exception:
+            #Counted as lost, part of the batch may have been written before the failure
+            self.failed_rows += len(rows)
+            self.failed_records += len(records)
+            logger.exception("Log writer failed to flush %d rows and %d records",len(rows),len(records))
@@ -0,0 +1,107 @@
+import asyncio
+
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional
+
+from src.applications.member_data import MemberAggregate, apply_member_transaction
+from src.storage.member_store import parse_timestamp
+
+
+#State shared by the requests of one member that are in the perk app at the same time
+class MemberSlot:
+    __slots__ = ("lock", "users", "flight", "loaded", "aggregate")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0
+        self.flight: Optional[asyncio.Task] = None
+        self.loaded = False
+        self.aggregate: Optional[MemberAggregate] = None
+
+
+#Per-member coordination of the requests in flight. The pipeline runs of a member are queued on the member's own lock,
+#in arrival order, so its offers are computed and its transactions saved one after the other while other members
+#run freely. A burst of requests for a member fetches the aggregate once: the first request starts the fetch and the
+#others join it, each run then folds the transactions saved by the runs before it. A member's slot only lives while
+#it has requests in flight, memory is bounded by the concurrency, not by the number of members
+class MemberCoordinator:
+
+    def __init__(self,fetch: Callable[[str],Awaitable[Optional[MemberAggregate]]]):
+        self.fetch = fetch
+        self.slots: Dict[str,MemberSlot] = {}
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self.slots)
+
+    #Holds the locks of the given members, always taken in the same order so that batches never deadlock
+    @asynccontextmanager
+    async def members(self,m_ids: Iterable[str]):
+        m_ids = sorted(set(m_ids))
+        slots = [self.join(m_id) for m_id in m_ids]
+        acquired = []
+        try:
+            for slot in slots:
+                await slot.lock.acquire()
+                acquired.append(slot)
+            yield
+        finally:
+            for slot in acquired:
+                slot.lock.release()
+            for m_id,slot in zip(m_ids,slots):
+                slot.users -= 1
+                if slot.users == 0:
+                    del self.slots[m_id]
+
+    #The fetch starts on arrival, while the request may still be queued behind the member's earlier runs
+    def join(self,m_id:str) -> MemberSlot:
+        slot = self.slots.get(m_id)
+        if slot is None:
+            slot = self.slots[m_id] = MemberSlot()
+        slot.users += 1
+        if slot.flight is None and not slot.loaded:
+            self.start_flight(m_id,slot)
+        else:
+            self.coalesced += 1
+        return slot
+
+    def start_flight(self,m_id:str,slot: MemberSlot):
+        slot.flight = asyncio.create_task(self.fetch(m_id))
+        #The fetch may outlive every request that waited for it, its error is then not retrieved by anyone
+        slot.flight.add_done_callback(lambda task: task.cancelled() or task.exception())
+
+    #A private copy of the member's aggregate with every transaction saved so far, None when the member has no history.
+    #Members without a slot (coordination not held) are fetched directly
+    async def aggregate(self,m_id:str) -> Optional[MemberAggregate]:
+        slot = self.slots.get(m_id)
+        if slot is None:
+            return await self.fetch(m_id)
+        if not slot.loaded:
+            if slot.flight is None:
+                self.start_flight(m_id,slot)
+            flight = slot.flight
+            try:
+                aggregate = await flight
+            except Exception:
+                #Later runs try again rather than share a failed fetch
+                if slot.flight is flight:
+                    slot.flight = None
+                raise
+            slot.aggregate, slot.loaded, slot.flight = aggregate, True, None
+        return slot.aggregate.model_copy(deep=True) if slot.aggregate is not None else None
+
+    #Called once a transaction is saved (or queued for saving) by the run holding the member's lock
+    def record(self,data: Dict[str,Any]):
+        slot = self.slots.get(data["memberId"])
+        if slot is None:
+            return
+        if not slot.loaded:
+            #Saved before the aggregate was fetched (fallback offer): the next run fetches it again
+            slot.flight = None
+            return
+        slot.aggregate = slot.aggregate or MemberAggregate()
+        apply_member_transaction(slot.aggregate,data["lastTransactionPointsBought"],data["lastTransactionRevenueUsd"],
+                                 data["lastTransactionType"],parse_timestamp(data["lastTransactionUtcTs"]))
+
+    def stats(self) -> dict:
+        return {"members_in_flight": len(self.slots), "coalesced_fetches": self.coalesced}
@@ -0,0 +1,90 @@
+import math
+import hashlib
+import numpy as np
+
+from typing import Iterable, Tuple
+
+
+#Bloom filter of the members known to have history. A member it does not contain has certainly never been saved, so
+#its history lookup is skipped. A member it contains most likely has history, the lookup is made and its 404 is a false
+#positive. Members are never removed, the bits only fill up: past `capacity` members the false positive rate grows
+#beyond `error_rate`. The filter is unusable (every member is looked up) until it has been seeded with the stored members
+class KnownMemberFilter:
+
+    def __init__(self,capacity:int=1000000,error_rate:float=0.01):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(64,math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1,round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.ready = False
+        self.skipped = 0
+        self.false_positives = 0
+        self.seeds = 0
+
+    #Double hashing: the i-th bit of a member is h1 + i*h2 (modulo 2**64, like the uint64 arithmetic of add_many),
+    #both halves of one 128 bit digest
+    @staticmethod
+    def digest(m_id:str) -> Tuple[int,int]:
+        digest = hashlib.blake2b(m_id.encode(),digest_size=16).digest()
+        return int.from_bytes(digest[:8],"little"), int.from_bytes(digest[8:],"little") | 1
+
+    def positions(self,m_id:str):
+        h1, h2 = self.digest(m_id)
+        return [((h1 + i * h2) & 0xFFFFFFFFFFFFFFFF) % self.size for i in range(self.hashes)]
+
+    def add(self,m_id:str):
+        for position in self.positions(m_id):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    #Byte and bit mask of every bit of every member, computed with numpy for all of them at once. Reads nothing but the
+    #filter's dimensions, so seeding can run it in a thread and only set the bits on the event loop
+    def locate(self,m_ids: Iterable[str]) -> Tuple[np.ndarray,np.ndarray]:
+        digests = b"".join(hashlib.blake2b(m_id.encode(),digest_size=16).digest() for m_id in m_ids)
+        halves = np.frombuffer(digests,dtype="<u8").reshape(-1,2)
+        h1, h2 = halves[:,0], halves[:,1] | np.uint64(1)
+        positions = (h1[:,None] + np.arange(self.hashes,dtype=np.uint64) * h2[:,None]) % np.uint64(self.size)
+        return (positions >> np.uint64(3)).astype(np.int64).ravel(), (np.uint8(1) << (positions & np.uint64(7)).astype(np.uint8)).ravel()
+
+    def set_bits(self,indices: np.ndarray,masks: np.ndarray):
+        np.bitwise_or.at(np.frombuffer(self.bits,dtype=np.uint8),indices,masks)
+
+    def add_many(self,m_ids: Iterable[str]):
+        self.set_bits(*self.locate(m_ids))
+
+    def __contains__(self,m_id:str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(m_id))
+
+    #False only for a member certainly without history, i.e. when the lookup can be skipped
+    def may_be_known(self,m_id:str) -> bool:
+        if not self.ready or m_id in self:
+            return True
+        self.skipped += 1
+        return False
+
+    #Members are only ever added, a new seed adds the stored members to those saved since the last one
+    def seed(self,indices: np.ndarray,masks: np.ndarray):
+        self.set_bits(indices,masks)
+        self.ready = True
+        self.seeds += 1
+
+    def fill_ratio(self) -> float:
+        return int(np.unpackbits(np.frombuffer(self.bits,dtype=np.uint8)).sum()) / self.size
+
+    def stats(self) -> dict:
+        fill = self.fill_ratio()
+        #Members added, estimated from the bits set, and the probability that a new member looks known
+        members = -self.size / self.hashes * math.log(1 - fill) if fill < 1 else float("inf")
+        return {
+            "ready": self.ready,
+            "capacity": self.capacity,
+            "estimated_members": round(members),
+            "bits": self.size,
+            "hashes": self.hashes,
+            "memory_bytes": len(self.bits),
+            "fill_ratio": round(fill,4),
+            "false_positive_rate": round(fill ** self.hashes,6),
+            "skipped_lookups": self.skipped,
+            "false_positives": self.false_positives,
+            "seeds": self.seeds
+        }
@@ -0,0 +1,89 @@
+import asyncio
+import contextvars
+
+from typing import Any, Awaitable, Callable, List, Optional
+
+from myapp.dependency_client import request_deadline
+from src.observability.metrics import Histogram
+
+
+#Collects concurrent calls of the same kind and sends them downstream as one bulk call, each caller gets its own result.
+#The window adapts to the load: when no batch is in flight the calls of the current event loop iteration leave at once,
+#otherwise calls accumulate while the previous batch is out and leave when it returns, when max_batch_size calls are
+#waiting or at the latest max_delay seconds after the first of them. call_batch returns one result per item, in order,
+#an error fails every call of the batch. A batch runs until the latest deadline of its callers (none if one has none),
+#so that one caller running out of time does not fail the others
+class MicroBatcher:
+
+    def __init__(self,call_batch: Callable[[List[Any]],Awaitable[List[Any]]],max_batch_size:int=64,max_delay:float=0.002,
+                 sizes: Optional[Histogram] = None):
+        self.call_batch = call_batch
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.sizes = sizes
+        self.pending: List = []
+        self.in_flight = 0
+        self.tasks = set()
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.scheduled = False
+        self.batches = 0
+        self.items = 0
+
+    async def submit(self,item: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((item,future,request_deadline.get()))
+        if len(self.pending) >= self.max_batch_size:
+            self.flush()
+        elif self.in_flight == 0:
+            if not self.scheduled:
+                self.scheduled = True
+                loop.call_soon(self.flush)
+        elif self.timer is None:
+            self.timer = loop.call_later(self.max_delay,self.flush)
+        return await future
+
+    def flush(self):
+        self.scheduled = False
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        while self.pending:
+            batch, self.pending = self.pending[:self.max_batch_size], self.pending[self.max_batch_size:]
+            self.in_flight += 1
+            deadlines = [deadline for _,_,deadline in batch]
+            context = contextvars.copy_context()
+            context.run(request_deadline.set,None if None in deadlines else max(deadlines))
+            task = asyncio.create_task(self.send(batch),context=context)
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def send(self,batch: List):
+        self.batches += 1
+        self.items += len(batch)
+        if self.sizes is not None:
+            self.sizes.observe(len(batch))
+        try:
+            results = await self.call_batch([item for item,_,_ in batch])
+            if len(results) != len(batch):
+                raise ValueError(f"A batch of {len(batch)} calls got {len(results)} results")
+            for (_,future,_),result in zip(batch,results):
+                if not future.done():
+                    future.set_result(result)
+        except Exception as e:
+            for _,future,_ in batch:
+                if not future.done():
+                    future.set_exception(e)
+        except asyncio.CancelledError:
+            for _,future,_ in batch:
+                future.cancel()
+            raise
+        finally:
+            self.in_flight -= 1
+            #What accumulated while this batch was out leaves now instead of waiting for the timer
+            if self.pending and self.in_flight == 0:
+                self.flush()
+
+    def stats(self) -> dict:
+        return {"batches": self.batches, "items": self.items, "pending": len(self.pending), "in_flight": self.in_flight,
+                "avg_batch_size": self.items / self.batches if self.batches else 0}
@@ -5,97 +5,419 @@ import logging
 import requests
 import csv
 import time
+import asyncio
 
 
-from fastapi import FastAPI
-from typing import Dict, Any, List
+from fastapi import FastAPI, Header, HTTPException
+from typing import Dict, Any, List, Optional, Annotated
 from datetime import datetime, timezone
 from pathlib import Path
 
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
-from src.applications.member_data import MemberData
-from src.applications.prediction import MemberFeatures
-from src.applications.offer_engine import OfferRequest
+from src.applications.member_data import MemberData, MemberAggregate, apply_member_transaction, member_aggregate_features
+from src.applications.prediction import MemberFeatures, MemberFeaturesBatch
+from src.applications.offer_engine import OfferRequest, OfferRequestBatch, offer_rules
+from src.features.engine import compute_stats, member_features
+from src.storage.member_store import parse_timestamp
+from myapp.log_writer import BufferedLogWriter, TRANSACTIONS_CSV_COLUMNS
+from myapp.prediction_cache import PredictionCache
+from myapp.member_filter import KnownMemberFilter
+from myapp.write_behind import WriteBehindQueue
+from myapp.micro_batcher import MicroBatcher
+from myapp.member_coordinator import MemberCoordinator
+from myapp.admission import AdmissionController, AdmissionRejected
+from src.observability.metrics import MetricsRegistry, instrument
+from src.observability.profiling import add_diagnostics, record_span
+from src.applications import wire_format
+from src.applications.wire_format import FastResponse, WireRoute
 
 #Necessary to create a global concurrent client
 from httpx import AsyncClient
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, nullcontext
 
-incoming_client_request = None
+from myapp.transport import HttpTransport, EmbeddedTransport
+from myapp.dependency_client import DependencyClient, CircuitOpenError, DeadlineExceeded, no_deadline
+from src.storage.sharding import ShardMap
 
 
 MEMBER_DATA_URL = os.getenv("MEMBER_DATA_URL", "http://localhost:6001")
 ML_SERVICE_URL = os.getenv("ML_SERVICE_URL", "http://localhost:6002")
 OFFER_SERVICE_URL = os.getenv("OFFER_SERVICE_URL", "http://localhost:6003")
 
-#http logs
-logging.basicConfig(
-    level = logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    filename = 'logs/processed_requests.log',
-    filemode = 'a'
-)
+#Urls of the member_data shards (see member_data_shards). When set, history reads and saves go straight to the
+#shard owning the member instead of MEMBER_DATA_URL
+MEMBER_DATA_SHARDS = ShardMap.from_env(os.getenv("MEMBER_DATA_SHARD_URLS"))
+
+#"http" (default) calls the other applications over the network, "embedded" runs them inside this process
+PERK_TRANSPORT = os.getenv("PERK_TRANSPORT", "http")
+
+#With LOCAL_OFFER_RULES=1 offers come from the compiled rule table in this process instead of the offer_engine
+#application, the assign offer stage then no longer makes a network call
+LOCAL_OFFER_RULES = os.getenv("LOCAL_OFFER_RULES", "0") == "1"
+
+#Encoding of the calls to the other applications, "msgpack" (default) or "json"
+INTERNAL_WIRE_FORMAT = os.getenv("INTERNAL_WIRE_FORMAT", "msgpack")
 
+#Offer returned without waiting when a dependency's circuit breaker is open or the request runs out of time
+FALLBACK_OFFER = os.getenv("FALLBACK_OFFER", "35% Bonus")
+
+transport = None
+
+#Predictions are cached on the feature vector rounded to PREDICTION_CACHE_PRECISION decimals.
+#PREDICTION_CACHE_SIZE=0 (the default) disables the cache. The model version is checked every
+#PREDICTION_CACHE_VERSION_CHECK seconds and a new version empties the cache
+prediction_cache = PredictionCache(
+    max_size = int(os.getenv("PREDICTION_CACHE_SIZE", "0")),
+    ttl = float(os.getenv("PREDICTION_CACHE_TTL", "300")),
+    precision = int(os.getenv("PREDICTION_CACHE_PRECISION", "4"))
+)
+PREDICTION_CACHE_VERSION_CHECK = float(os.getenv("PREDICTION_CACHE_VERSION_CHECK", "30"))
+
+#With MEMBER_FILTER=1 members missing from a Bloom filter of the members with history are not looked up, their history
+#is empty. The filter is seeded from member_data at startup and every MEMBER_FILTER_REFRESH seconds (0 seeds it once),
+#and this app adds every member it saves. It is sized for MEMBER_FILTER_CAPACITY members at MEMBER_FILTER_ERROR_RATE
+#false positives (see KnownMemberFilter)
+MEMBER_FILTER = os.getenv("MEMBER_FILTER", "0") == "1"
+member_filter = KnownMemberFilter(
+    capacity = int(os.getenv("MEMBER_FILTER_CAPACITY", "1000000")),
+    error_rate = float(os.getenv("MEMBER_FILTER_ERROR_RATE", "0.01"))
+) if MEMBER_FILTER else None
+MEMBER_FILTER_REFRESH = float(os.getenv("MEMBER_FILTER_REFRESH", "300"))
+MEMBER_FILTER_RETRY = float(os.getenv("MEMBER_FILTER_RETRY", "5"))
+
+#With WRITE_BEHIND=1 (the default) transactions are saved in the background through a bounded queue, in batches,
+#instead of before the response. WRITE_BEHIND=0 saves each transaction before responding
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "1") == "1"
+write_behind = None
+
+#With MICRO_BATCH=1 the history lookups, predictions and offers of concurrent requests are grouped into bulk calls of
+#up to MICRO_BATCH_MAX_SIZE, a call waits at most MICRO_BATCH_MAX_DELAY seconds for its batch to leave (see MicroBatcher)
+MICRO_BATCH = os.getenv("MICRO_BATCH", "0") == "1"
+MICRO_BATCH_MAX_SIZE = int(os.getenv("MICRO_BATCH_MAX_SIZE", "64"))
+MICRO_BATCH_MAX_DELAY = float(os.getenv("MICRO_BATCH_MAX_DELAY", "0.002"))
+
+#With MEMBER_COORDINATION=1 (the default) the requests of a member run one after the other and a burst of them
+#fetches the member's history once (see MemberCoordinator). MEMBER_COORDINATION=0 lets them run concurrently
+MEMBER_COORDINATION = os.getenv("MEMBER_COORDINATION", "1") == "1"
+
+#At most ADMISSION_MAX_CONCURRENCY offer requests run at once, up to ADMISSION_MAX_QUEUE more wait for their turn.
+#A request must be answered within ADMISSION_TIMEOUT_MS, or the X-Request-Timeout-Ms header of the client, and is shed
+#as soon as it cannot be (see AdmissionController). ADMISSION_SHED=fallback (the default) answers shed requests with
+#the fallback offer and still saves their transaction, "reject" answers 503. ADMISSION_MAX_CONCURRENCY=0 disables it
+ADMISSION_MAX_CONCURRENCY = int(os.getenv("ADMISSION_MAX_CONCURRENCY", "200"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "1000"))
+ADMISSION_TIMEOUT_MS = float(os.getenv("ADMISSION_TIMEOUT_MS", "2000"))
+ADMISSION_SHED = os.getenv("ADMISSION_SHED", "fallback")
 
 #Log file for relevant metrics initialization 
 logs_file = "logs/transactions.csv"
-csv_columns = ['memberId', 'AVG_POINTS_BOUGHT', 'AVG_REVENUE_USD', 'LAST_3_TRANSACTIONS_AVG_POINTS_BOUGHT',
-'LAST_3_TRANSACTIONS_AVG_REVENUE_USD', 'PCT_BUY_TRANSACTIONS', 'PCT_GIFT_TRANSACTIONS', 'PCT_REDEEM_TRANSACTIONS', 
-'DAYS_SINCE_LAST_TRANSACTION', 'ats', 'resp', 'offer', 'fetch_member_data_latency', 'calculate_features_latency', 
-'get_predictions_latency', 'assign_offer_latency', 'total_latency']
+csv_columns = TRANSACTIONS_CSV_COLUMNS
+
+#Both the metrics csv and the http logs go through a background writer, requests only enqueue.
+#LOG_INFO_SAMPLE_RATE keeps that fraction of the INFO success lines, warnings and errors are always written.
+#Past LOG_MAX_PENDING unwritten rows and records, new ones are dropped (see perk_log_dropped_total)
+log_writer = BufferedLogWriter(
+    csv_path = logs_file,
+    csv_columns = csv_columns,
+    log_path = 'logs/processed_requests.log',
+    log_format = '%(asctime)s - %(levelname)s - %(message)s',
+    batch_size = int(os.getenv("LOG_BATCH_SIZE", "500")),
+    flush_interval = float(os.getenv("LOG_FLUSH_INTERVAL", "0.5")),
+    max_bytes = int(os.getenv("LOG_MAX_BYTES", str(50*1024*1024))),
+    backup_count = int(os.getenv("LOG_BACKUP_COUNT", "5")),
+    info_sample_rate = float(os.getenv("LOG_INFO_SAMPLE_RATE", "1.0")),
+    max_pending = int(os.getenv("LOG_MAX_PENDING", "100000"))
+)
 
-if not os.path.exists(logs_file):
-    with open(logs_file,"w",newline="") as f:
-        w = csv.DictWriter(f,fieldnames=csv_columns)
-        w.writeheader()
+#http logs. force replaces any handler installed by a record logged while the applications were imported
+logging.basicConfig(
+    level = logging.INFO,
+    handlers = [log_writer.handler],
+    force = True
+)
 
 
 
 """Application code starts here"""
 
 #Function to control the life time of incoming client requests
+#msgpack falls back to JSON when it is not installed, the other applications then answer in JSON anyway
+def internal_content_type() -> str:
+    content_type = {"json": wire_format.JSON, "msgpack": wire_format.MSGPACK}[INTERNAL_WIRE_FORMAT]
+    if not wire_format.supported(content_type):
+        logging.warning(f"INTERNAL_WIRE_FORMAT is {INTERNAL_WIRE_FORMAT} but msgpack is not installed, calls use JSON")
+        return wire_format.JSON
+    return content_type
+
+
+#A failed batch is retried until the member_data circuit had two chances to close again, nothing to wait for when embedded
+def write_behind_retry_for() -> float:
+    if isinstance(transport,HttpTransport):
+        return 2 * transport.member_data_client.config.breaker_reset_timeout
+    return 0.0
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global incoming_client_request
-    incoming_client_request = AsyncClient()
+    global transport, write_behind
+    log_writer.start()
+    if PERK_TRANSPORT == "embedded":
+        transport = EmbeddedTransport()
+    else:
+        #Pool sizes, timeouts, hedging and breakers are set per dependency, see DependencyConfig
+        transport = HttpTransport(DependencyClient.from_env("MEMBER_DATA",downstream_latency),
+                                  DependencyClient.from_env("ML_SERVICE",downstream_latency),
+                                  DependencyClient.from_env("OFFER_SERVICE",downstream_latency),
+                                  MEMBER_DATA_URL,ML_SERVICE_URL,OFFER_SERVICE_URL,MEMBER_DATA_SHARDS,
+                                  internal_content_type())
+        for client in (transport.member_data_client,transport.ml_client,transport.offer_client):
+            breaker_open.labels(client.config.name).set_function(lambda breaker=client.breaker: int(breaker.state != "closed"))
+    logging.info(f"Perk app started with the {PERK_TRANSPORT} transport")
+    version_watcher = asyncio.create_task(watch_model_version()) if prediction_cache.enabled else None
+    filter_watcher = asyncio.create_task(watch_known_members()) if member_filter is not None else None
+    if WRITE_BEHIND:
+        write_behind = WriteBehindQueue(
+            persist_member_data_batch,
+            max_pending = int(os.getenv("WRITE_BEHIND_MAX_PENDING", "10000")),
+            batch_size = int(os.getenv("WRITE_BEHIND_BATCH_SIZE", "500")),
+            flush_interval = float(os.getenv("WRITE_BEHIND_FLUSH_INTERVAL", "0.05")),
+            max_retries = int(os.getenv("WRITE_BEHIND_MAX_RETRIES", "5")),
+            retry_for = float(os.getenv("WRITE_BEHIND_RETRY_FOR", str(write_behind_retry_for()))),
+            partition = transport.member_data_partition
+        )
+        write_behind.start()
     yield
-    await incoming_client_request.aclose()
+    for watcher in (version_watcher,filter_watcher):
+        if watcher is not None:
+            watcher.cancel()
+    #Drains the queue while the transport is still open
+    if write_behind is not None:
+        await write_behind.stop()
+        write_behind = None
+    await transport.aclose()
+    log_writer.stop()
+
+#Same encoding as the other applications: orjson responses and bodies, msgpack for clients that ask for it
+app = FastAPI(lifespan=lifespan,default_response_class=FastResponse)
+app.router.route_class = WireRoute
+
+#Live metrics on /metrics, in the Prometheus text format. Histograms have fixed buckets so they stay cheap enough
+#to be always on, p50/p99 come from histogram_quantile on the scraped buckets
+metrics = MetricsRegistry()
+instrument(app,metrics)
+#Profiler, slow requests with their stage breakdown and event loop lag under /admin
+slow_requests, loop_lag = add_diagnostics(app,metrics)
+stage_latency = metrics.histogram("perk_stage_latency_seconds","Latency of each stage of an offer calculation",("stage",))
+downstream_latency = metrics.histogram("perk_downstream_request_duration_seconds","Latency of the calls to the other applications",
+                                       ("dependency","method","outcome"))
+offers_total = metrics.counter("perk_offers_total","Offers assigned",("offer",))
+fallback_offers_total = metrics.counter("perk_fallback_offers_total","Fallback offers returned because a circuit was open or time ran out")
+invalid_transactions_total = metrics.counter("perk_invalid_transactions_total","Transactions not saved because member_data would reject them")
+shed_requests_total = metrics.counter("perk_shed_requests_total","Requests turned away by admission control",("reason",))
+admission_queue_time = metrics.histogram("perk_admission_queue_seconds","Time admitted requests waited for their turn")
+breaker_open = metrics.gauge("perk_circuit_breaker_open","1 while the circuit of a dependency is open",("dependency",))
+metrics.gauge("perk_write_behind_pending","Transactions waiting to be saved").set_function(lambda: len(write_behind) if write_behind is not None else 0)
+metrics.counter("perk_prediction_cache_hits_total","Prediction cache hits").set_function(lambda: prediction_cache.hits)
+metrics.counter("perk_prediction_cache_misses_total","Prediction cache misses").set_function(lambda: prediction_cache.misses)
+metrics.gauge("perk_member_filter_false_positive_rate","Estimated share of new members the known member filter lets through").set_function(
+    lambda: member_filter.stats()["false_positive_rate"] if member_filter is not None else 0)
+metrics.gauge("perk_member_filter_bytes","Memory of the known member filter").set_function(lambda: len(member_filter.bits) if member_filter is not None else 0)
+metrics.counter("perk_member_filter_skipped_lookups_total","History lookups skipped for members not in the filter").set_function(
+    lambda: member_filter.skipped if member_filter is not None else 0)
+metrics.counter("perk_member_filter_false_positives_total","History lookups of members in the filter that had no history").set_function(
+    lambda: member_filter.false_positives if member_filter is not None else 0)
+log_dropped_total = metrics.counter("perk_log_dropped_total","Log rows and records dropped because the log writer fell behind",("kind",))
+log_dropped_total.labels("rows").set_function(lambda: log_writer.dropped_rows)
+log_dropped_total.labels("records").set_function(lambda: log_writer.dropped_records)
+log_flush_failed_total = metrics.counter("perk_log_flush_failed_total","Log rows and records lost because writing them failed",("kind",))
+log_flush_failed_total.labels("rows").set_function(lambda: log_writer.failed_rows)
+log_flush_failed_total.labels("records").set_function(lambda: log_writer.failed_records)
+micro_batch_size = metrics.histogram("perk_micro_batch_size","Calls sent together by the micro-batchers",("call",),
+                                     buckets=(1,2,4,8,16,32,64,128,256,512))
+
+
+#Bulk calls behind the micro-batchers, one result per call in call order
+async def fetch_member_aggregates(m_ids: List[str]):
+    return await transport.get_member_aggregates(m_ids)
+
+async def fetch_predictions(batch_features: List[MemberFeatures]):
+    predictions = await transport.predict_batch(MemberFeaturesBatch.from_rows(batch_features))
+    return list(zip(predictions["ats"],predictions["resp"]))
+
+async def assign_offers(offers: List[OfferRequest]):
+    assigned = await transport.assign_offer_batch(OfferRequestBatch(ats_predictions=[o.ats_prediction for o in offers],
+                                                                    resp_predictions=[o.resp_prediction for o in offers]))
+    return [{"offer": offer} for offer in assigned]
+
+aggregate_batcher = MicroBatcher(fetch_member_aggregates,MICRO_BATCH_MAX_SIZE,MICRO_BATCH_MAX_DELAY,micro_batch_size.labels("member_aggregate"))
+prediction_batcher = MicroBatcher(fetch_predictions,MICRO_BATCH_MAX_SIZE,MICRO_BATCH_MAX_DELAY,micro_batch_size.labels("prediction"))
+offer_batcher = MicroBatcher(assign_offers,MICRO_BATCH_MAX_SIZE,MICRO_BATCH_MAX_DELAY,micro_batch_size.labels("offer"))
+
+
+#Runs of the given members are queued behind their earlier ones, see MemberCoordinator
+member_coordinator = MemberCoordinator(lambda m_id: read_member_aggregate(m_id)) if MEMBER_COORDINATION else None
+metrics.gauge("perk_members_in_flight","Members with requests in flight").set_function(lambda: len(member_coordinator or ()))
+metrics.counter("perk_coalesced_history_fetches_total","Requests that reused a history fetch of their member").set_function(
+    lambda: member_coordinator.coalesced if member_coordinator is not None else 0)
+
+def coordinate(m_ids):
+    return member_coordinator.members(m_ids) if member_coordinator is not None else nullcontext()
+
+
+admission = AdmissionController(ADMISSION_MAX_CONCURRENCY,ADMISSION_MAX_QUEUE,ADMISSION_TIMEOUT_MS / 1000,
+                                shed_requests_total,admission_queue_time) if ADMISSION_MAX_CONCURRENCY > 0 else None
+metrics.gauge("perk_admitted_requests","Offer requests running").set_function(lambda: admission.in_flight if admission is not None else 0)
+metrics.gauge("perk_queued_requests","Offer requests waiting for admission").set_function(lambda: len(admission or ()))
+
+
+#Keeps the prediction cache on the current model version
+async def watch_model_version():
+    while True:
+        await refresh_model_version()
+        await asyncio.sleep(PREDICTION_CACHE_VERSION_CHECK)
+
+
+async def refresh_model_version():
+    try:
+        version = await transport.model_version()
+    except Exception as e:
+        logging.warning(f"Model version check failed: {e}")
+        return
+    if version != prediction_cache.version:
+        logging.info(f"Prediction cache now on model version {version}")
+    prediction_cache.set_version(version)
+
+
+@app.get("/api/prediction_cache")
+async def prediction_cache_stats():
+    return prediction_cache.stats()
+
+
+#Until a first seed succeeds every member is looked up, a failed seed is retried after MEMBER_FILTER_RETRY seconds
+async def watch_known_members():
+    while True:
+        if await seed_member_filter() and not MEMBER_FILTER_REFRESH:
+            return
+        await asyncio.sleep(MEMBER_FILTER_REFRESH if member_filter.ready else MEMBER_FILTER_RETRY)
 
-app = FastAPI(lifespan=lifespan)
+
+#The ids are hashed in a thread, only setting the bits holds the event loop
+async def seed_member_filter() -> bool:
+    try:
+        m_ids = await transport.member_ids()
+    except Exception as e:
+        logging.warning(f"Known member filter seeding failed: {e}")
+        return False
+    member_filter.seed(*await asyncio.to_thread(member_filter.locate,m_ids))
+    logging.info(f"Known member filter seeded with {len(m_ids)} members")
+    return True
+
+
+@app.get("/api/member_filter")
+async def member_filter_stats():
+    return member_filter.stats() if member_filter is not None else {"enabled": False}
 
 
 @app.post("/api/requests/v1")
-async def handle_request(data: Dict[str,Any]):
+async def handle_request(data: Dict[str,Any],x_request_timeout_ms: Annotated[Optional[float],Header()] = None):
+
+    if admission is None:
+        return await process_request(data)
+    try:
+        async with admission.admit(x_request_timeout_ms / 1000 if x_request_timeout_ms is not None else None):
+            return await process_request(data)
+    except AdmissionRejected as e:
+        if ADMISSION_SHED == "reject":
+            raise HTTPException(status_code=503,detail=str(e),headers={"Retry-After": "1"})
+        return await process_request(data,shed=e)
+
+
+#A shed request gets the fallback offer without calling anything, its transaction is saved all the same
+async def process_request(data: Dict[str,Any],shed: Optional[AdmissionRejected] = None):
 
     request_logs = {"memberId": data["memberId"]}
 
-    member_offer = await calculate_offer(data["memberId"],data,request_logs)
-    await save_member_data(data["memberId"],data)
+    async with coordinate([data["memberId"]]):
+        if shed is None:
+            try:
+                member_offer = await calculate_offer(data["memberId"],data,request_logs)
+            except (CircuitOpenError,DeadlineExceeded) as e:
+                member_offer = fallback_offer(data["memberId"],request_logs,e)
+        else:
+            member_offer = fallback_offer(data["memberId"],request_logs,shed)
+        offers_total.labels(member_offer["offer"]).inc()
+        with no_deadline():
+            await save_member_data(data["memberId"],data)
     record_logs(request_logs)
 
     return member_offer
-    
+
+
+def fallback_offer(m_id:str,r_logs,reason: Exception):
+    logging.warning(f"Fallback offer for member {m_id}: {reason}")
+    r_logs["offer"] = FALLBACK_OFFER
+    fallback_offers_total.inc()
+    return {"memberId":m_id,"offer":FALLBACK_OFFER}
+
+
+#Bulk ingestion: offers are returned in input order, downstream work is grouped for the whole batch.
+#A batch goes through admission control like a single request and takes one slot, a shed batch gets fallback offers
+@app.post("/api/requests/v1/batch")
+async def handle_batch_request(data: List[Dict[str,Any]],x_request_timeout_ms: Annotated[Optional[float],Header()] = None):
+
+    if admission is None:
+        return await process_batch_request(data)
+    try:
+        async with admission.admit(x_request_timeout_ms / 1000 if x_request_timeout_ms is not None else None):
+            return await process_batch_request(data)
+    except AdmissionRejected as e:
+        if ADMISSION_SHED == "reject":
+            raise HTTPException(status_code=503,detail=str(e),headers={"Retry-After": "1"})
+        return await process_batch_request(data,shed=e)
+
+
+async def process_batch_request(data: List[Dict[str,Any]],shed: Optional[AdmissionRejected] = None):
+
+    batch_logs = [{"memberId": d["memberId"]} for d in data]
+
+    async with coordinate(d["memberId"] for d in data):
+        if shed is None:
+            try:
+                member_offers = await calculate_offers_batch(data,batch_logs)
+            except (CircuitOpenError,DeadlineExceeded) as e:
+                member_offers = fallback_offers(data,batch_logs,e)
+        else:
+            member_offers = fallback_offers(data,batch_logs,shed)
+        for member_offer in member_offers:
+            offers_total.labels(member_offer["offer"]).inc()
+        with no_deadline():
+            await save_member_data_batch(data)
+    for request_logs in batch_logs:
+        record_logs(request_logs)
+
+    return member_offers
+
+
+def fallback_offers(data: List[Dict[str,Any]],batch_logs,reason: Exception):
+    logging.warning(f"Fallback offers for a batch of {len(data)} transactions: {reason}")
+    for request_logs in batch_logs:
+        request_logs["offer"] = FALLBACK_OFFER
+    fallback_offers_total.inc(len(data))
+    return [{"memberId":d["memberId"],"offer":FALLBACK_OFFER} for d in data]
+
 
 #Core algorithm, namely the orchestrator, that calculates an offer
 async def calculate_offer(m_id:str,data: Dict[str,Any],r_logs):
 
     member_start_time = time.perf_counter()
     
-    transactions = await incoming_client_request.get(f"{MEMBER_DATA_URL}/member_data/{m_id}")
-    if transactions.status_code == 404:
-        logging.info(f"Member {m_id} does not have purchase history: {transactions.status_code}")
-        transactions = []
-    else:
-        logging.info(f"Member history fetched successfully: {transactions.status_code}")
-        transactions = transactions.json()
-        
+    aggregate = await fetch_member_aggregate(m_id)
     member_end_time = time.perf_counter()
 
 
     features_start_time = time.perf_counter()
-    transactions.append(data)
-    mem_features = calculate_member_features(transactions,r_logs)
+    mem_features = calculate_aggregate_features(aggregate,data,r_logs)
     features_end_time = time.perf_counter()
    
     prediction_start_time = time.perf_counter()
@@ -110,89 +432,282 @@ async def calculate_offer(m_id:str,data: Dict[str,Any],r_logs):
 
     r_logs["offer"] = special_offer['offer']
 
-    #Latency calculations
-    r_logs["fetch_member_data_latency"] = round(member_end_time - member_start_time,3)
-    r_logs["calculate_features_latency"] = round(features_end_time - features_start_time,3)
-    r_logs["get_predictions_latency"] = round(prediction_end_time - prediction_start_time,3)
-    r_logs["assign_offer_latency"] = round(offer_end_time - offer_start_time,3)
-    r_logs["total_latency"] = round(r_logs["fetch_member_data_latency"] + r_logs["calculate_features_latency"] + r_logs["get_predictions_latency"] + r_logs["assign_offer_latency"],3)
+    record_latencies(r_logs,member_end_time - member_start_time,features_end_time - features_start_time,
+                     prediction_end_time - prediction_start_time,offer_end_time - offer_start_time)
     
     return {"memberId":m_id,"offer":special_offer["offer"]}
 
 
-#Support function that calculate a member's features
-def calculate_member_features(m_data:List[Dict[str,Any]],r_logs):
-    mf = MemberFeatures(AVG_POINTS_BOUGHT=0,AVG_REVENUE_USD=0,
-    LAST_3_TRANSACTIONS_AVG_POINTS_BOUGHT=0,LAST_3_TRANSACTIONS_AVG_REVENUE_USD=0,
-    PCT_BUY_TRANSACTIONS=0,PCT_GIFT_TRANSACTIONS=0,PCT_REDEEM_TRANSACTIONS=0,
-    DAYS_SINCE_LAST_TRANSACTION=0
-    )
+#Batch counterpart of calculate_offer: one aggregate lookup per distinct member, one prediction call and one offer call.
+#A member's transactions are folded into its aggregate in input order, so repeated members see their earlier transactions
+async def calculate_offers_batch(data: List[Dict[str,Any]],batch_logs: List[Dict]):
 
-    r_logs["AVG_POINTS_BOUGHT"] = mf.AVG_POINTS_BOUGHT = sum(x["lastTransactionPointsBought"] for x in m_data)/len(m_data)
-    r_logs["AVG_REVENUE_USD"]= mf.AVG_REVENUE_USD = sum(x["lastTransactionRevenueUsd"] for x in m_data)/len(m_data)
+    member_start_time = time.perf_counter()
+    member_ids = list(dict.fromkeys(d["memberId"] for d in data))
+    aggregates = dict(zip(member_ids,await asyncio.gather(*(fetch_member_aggregate(m_id) for m_id in member_ids))))
+    member_end_time = time.perf_counter()
 
-    last_3 = m_data[-3:]
-    r_logs["LAST_3_TRANSACTIONS_AVG_POINTS_BOUGHT"] =  mf.LAST_3_TRANSACTIONS_AVG_POINTS_BOUGHT = sum(x["lastTransactionPointsBought"] for x in last_3)/len(last_3)
-    r_logs["LAST_3_TRANSACTIONS_AVG_REVENUE_USD"] = mf.LAST_3_TRANSACTIONS_AVG_REVENUE_USD = sum(x["lastTransactionRevenueUsd"] for x in last_3)/len(last_3)
+    features_start_time = time.perf_counter()
+    batch_features = [calculate_aggregate_features(aggregates[d["memberId"]],d,r_logs) for d,r_logs in zip(data,batch_logs)]
+    features_end_time = time.perf_counter()
 
-    
-    r_logs["PCT_BUY_TRANSACTIONS"] = mf.PCT_BUY_TRANSACTIONS = sum(x["lastTransactionType"] == "buy" for x in m_data)/len(m_data)
-    r_logs["PCT_GIFT_TRANSACTIONS"] = mf.PCT_GIFT_TRANSACTIONS = sum(x["lastTransactionType"] == "gift" for x in m_data)/len(m_data)
-    r_logs["PCT_REDEEM_TRANSACTIONS"] = mf.PCT_REDEEM_TRANSACTIONS = sum(x["lastTransactionType"] == "redeem" for x in m_data)/len(m_data)
+    prediction_start_time = time.perf_counter()
+    ats_resp = await get_ats_resp_batch(batch_features,batch_logs)
+    prediction_end_time = time.perf_counter()
 
-    r_logs["DAYS_SINCE_LAST_TRANSACTION"] = mf.DAYS_SINCE_LAST_TRANSACTION = (datetime.now() - datetime.strptime(m_data[-1]["lastTransactionUtcTs"], '%Y-%m-%d %H:%M:%S')).days
-    
+    offer_start_time = time.perf_counter()
+    offers = await offer_request_batch(OfferRequestBatch(ats_predictions=ats_resp["ats"],resp_predictions=ats_resp["resp"]))
+    offer_end_time = time.perf_counter()
+
+    #Stage latencies are those of the whole batch, shared by each of its transactions
+    for r_logs,offer in zip(batch_logs,offers):
+        r_logs["offer"] = offer
+        record_latencies(r_logs,member_end_time - member_start_time,features_end_time - features_start_time,
+                         prediction_end_time - prediction_start_time,offer_end_time - offer_start_time)
+
+    return [{"memberId":d["memberId"],"offer":offer} for d,offer in zip(data,offers)]
+
+
+#Support function that fetches a member's running aggregate, an empty one when the member has no history.
+#Only the aggregate is fetched, so payload and CPU stay flat whatever the history length.
+#Requests holding the member's coordination share one fetch and see the transactions saved by the runs before them
+async def fetch_member_aggregate(m_id:str):
+    if member_coordinator is not None:
+        aggregate = await member_coordinator.aggregate(m_id)
+    else:
+        aggregate = await read_member_aggregate(m_id)
+    if aggregate is None:
+        logging.info(f"Member {m_id} does not have purchase history")
+        return MemberAggregate()
+
+    logging.info(f"Member {m_id} history fetched successfully")
+    return aggregate
+
+
+#Transactions still waiting in the write-behind queue are folded in, so a member always sees its previous transactions
+async def read_member_aggregate(m_id:str):
+    if write_behind is None:
+        return await get_member_aggregate(m_id)
+    aggregate, pending = await write_behind.read_through(m_id,lambda: get_member_aggregate(m_id))
+    if pending:
+        aggregate = aggregate or MemberAggregate()
+        for d in pending:
+            apply_member_transaction(aggregate,d["lastTransactionPointsBought"],d["lastTransactionRevenueUsd"],
+                                     d["lastTransactionType"],parse_timestamp(d["lastTransactionUtcTs"]))
+    return aggregate
+
+
+#A member missing from the known member filter has no history, it is not looked up
+async def get_member_aggregate(m_id:str):
+    if member_filter is not None and not member_filter.may_be_known(m_id):
+        return None
+    if MICRO_BATCH:
+        aggregate = await aggregate_batcher.submit(m_id)
+    else:
+        aggregate = await transport.get_member_aggregate(m_id)
+    if aggregate is None and member_filter is not None and member_filter.ready:
+        member_filter.false_positives += 1
+    return aggregate
+
+
+#Latency calculations, the csv gets them rounded to the millisecond, the histograms as measured
+def record_latencies(r_logs,member_latency,features_latency,prediction_latency,offer_latency):
+    record_span("fetch_member_data",member_latency)
+    record_span("calculate_features",features_latency)
+    record_span("get_predictions",prediction_latency)
+    record_span("assign_offer",offer_latency)
+    stage_latency.labels("fetch_member_data").observe(member_latency)
+    stage_latency.labels("calculate_features").observe(features_latency)
+    stage_latency.labels("get_predictions").observe(prediction_latency)
+    stage_latency.labels("assign_offer").observe(offer_latency)
+    stage_latency.labels("total").observe(member_latency + features_latency + prediction_latency + offer_latency)
+    r_logs["fetch_member_data_latency"] = round(member_latency,3)
+    r_logs["calculate_features_latency"] = round(features_latency,3)
+    r_logs["get_predictions_latency"] = round(prediction_latency,3)
+    r_logs["assign_offer_latency"] = round(offer_latency,3)
+    r_logs["total_latency"] = round(r_logs["fetch_member_data_latency"] + r_logs["calculate_features_latency"] + r_logs["get_predictions_latency"] + r_logs["assign_offer_latency"],3)
+
+
+#Support function that calculate a member's features from its whole history, in a single pass of the feature engine
+def calculate_member_features(m_data:List[Dict[str,Any]],r_logs):
+    stats = compute_stats((x["lastTransactionPointsBought"],x["lastTransactionRevenueUsd"],x["lastTransactionType"],x["lastTransactionUtcTs"]) for x in m_data)
+    mf = member_features(stats)
+    r_logs.update(mf.model_dump())
+    return mf
 
+#Support function that calculates a member's features from its running aggregate and the incoming transaction.
+#The incoming timestamp is the only one parsed, the aggregate already holds epoch seconds
+def calculate_aggregate_features(aggregate: MemberAggregate,data: Dict[str,Any],r_logs):
+    apply_member_transaction(aggregate,data["lastTransactionPointsBought"],data["lastTransactionRevenueUsd"],
+                             data["lastTransactionType"],parse_timestamp(data["lastTransactionUtcTs"]))
+    mf = member_aggregate_features(aggregate)
+    r_logs.update(mf.model_dump())
     return mf
 
-#Support function that retrives ats and resp predictions
+#Support function that retrives ats and resp predictions, both models are queried concurrently, or together with the
+#predictions of concurrent requests with MICRO_BATCH=1. Members with already seen features are answered from the prediction cache
 async def get_ats_resp(memb_features: MemberFeatures,r_logs):
+    cached = prediction_cache.get(memb_features) if prediction_cache.enabled else None
+    if cached is not None:
+        ats_pred, resp_pred = cached
+    else:
+        if MICRO_BATCH:
+            ats_pred, resp_pred = await fetch_batched_prediction(memb_features)
+        else:
+            ats_pred, resp_pred = await asyncio.gather(
+                fetch_prediction("ats",memb_features),
+                fetch_prediction("resp",memb_features)
+            )
+        if prediction_cache.enabled:
+            prediction_cache.put(memb_features,ats_pred,resp_pred)
+    r_logs["ats"] = ats_pred
+    r_logs["resp"] = resp_pred
+
+    return {"ats": ats_pred, "resp": resp_pred}
+
+#Support function that fetches a single model's prediction with its own error handling and logging
+async def fetch_prediction(model:str,memb_features: MemberFeatures):
     try:
-        ats_request = await incoming_client_request.post(f"{ML_SERVICE_URL}/ml/ats/predict",json=memb_features.model_dump())
-        ats_request.raise_for_status() 
-        r_logs["ats"] = ats_pred = ats_request.json()["prediction"]
-        logging.info(f"ATS fetched successfuly: {ats_request.status_code} | ")
+        prediction = await transport.predict(model,memb_features)
+        logging.info(f"{model.upper()} fetched successfully | ")
     except Exception as e:
-        logging.info(f"ATS fetching failed: {e}")
-        raise 
+        logging.warning(f"{model.upper()} fetching failed: {e}")
+        raise
+
+    return prediction
 
+#Both predictions of a member in the next micro-batch of the prediction application
+async def fetch_batched_prediction(memb_features: MemberFeatures):
     try:
-        resp_request = await incoming_client_request.post(f"{ML_SERVICE_URL}/ml/resp/predict",json=memb_features.model_dump())
-        resp_request.raise_for_status() 
-        r_logs["resp"] = resp_pred = resp_request.json()["prediction"]
-        logging.info(f"RESP fetched successfully: {resp_request.status_code} | ")
+        prediction = await prediction_batcher.submit(memb_features)
+        logging.info(f"ATS and RESP fetched successfully | ")
     except Exception as e:
-        logging.info(f"RESP fetching failed: {e}")
+        logging.warning(f"ATS and RESP fetching failed: {e}")
         raise
 
-    return {"ats": ats_pred, "resp": resp_pred}
+    return prediction
+
+#Support function that retrieves the ats and resp predictions of a whole batch in one call, only the rows missing
+#from the prediction cache are sent
+async def get_ats_resp_batch(batch_features: List[MemberFeatures],batch_logs: List[Dict]):
+    cached = [prediction_cache.get(mf) if prediction_cache.enabled else None for mf in batch_features]
+    missing = [i for i,c in enumerate(cached) if c is None]
+    fetched = {"ats": [], "resp": []}
+    if missing:
+        try:
+            fetched = await transport.predict_batch(MemberFeaturesBatch.from_rows([batch_features[i] for i in missing]))
+            logging.info(f"Batch predictions fetched successfully | ")
+        except Exception as e:
+            logging.warning(f"Batch predictions fetching failed: {e}")
+            raise
+
+    for i,ats,resp in zip(missing,fetched["ats"],fetched["resp"]):
+        cached[i] = (ats,resp)
+        if prediction_cache.enabled:
+            prediction_cache.put(batch_features[i],ats,resp)
+    predictions = {"ats": [c[0] for c in cached], "resp": [c[1] for c in cached]}
+
+    for r_logs,ats,resp in zip(batch_logs,predictions["ats"],predictions["resp"]):
+        r_logs["ats"] = ats
+        r_logs["resp"] = resp
+
+    return predictions
 
 #support function that calculates the offer on the basis of the values retrieved by get_ats_resp function
 async def offer_request(offer: OfferRequest):
+    if LOCAL_OFFER_RULES:
+        return {"offer": offer_rules.evaluate(offer.ats_prediction,offer.resp_prediction)}
+    try:
+        calc_offer = await (offer_batcher.submit(offer) if MICRO_BATCH else transport.assign_offer(offer))
+        logging.info(f"Offer fetched successfully")
+    except Exception as e:
+        logging.warning(f"Error fetching offer: {e}")
+        raise
+
+    return calc_offer
+
+#Support function that assigns the offers of a whole batch in one call
+async def offer_request_batch(offers: OfferRequestBatch):
+    if LOCAL_OFFER_RULES:
+        return offer_rules.evaluate_batch(offers.ats_predictions,offers.resp_predictions)
     try:
-        calc_offer = await incoming_client_request.post(f"{OFFER_SERVICE_URL}/offer/assign",json=offer.model_dump())
-        calc_offer.raise_for_status() 
-        logging.info(f"Offer fetched successfully: {calc_offer.status_code}")
+        calc_offers = await transport.assign_offer_batch(offers)
+        logging.info(f"Batch offers fetched successfully")
     except Exception as e:
-        logging.info(f"Error fetching offer: {e}")
+        logging.warning(f"Error fetching batch offers: {e}")
         raise
 
-    return calc_offer.json()
+    return calc_offers
 
+#Queues the transaction when write-behind is on, the response then does not wait for the save
 async def save_member_data(m_id:str,d:Dict[str,Any]):
+    if not valid_transactions([d]):
+        return
+    remember_members([d])
+    if write_behind is not None:
+        await write_behind.enqueue(d)
+        record_saved([d])
+        return
     try:
-        save_member_transcation = await incoming_client_request.post(f"{MEMBER_DATA_URL}/member_data",json=d)
-        logging.info(f"Member {m_id} data successfully saved: {save_member_transcation.status_code}")
+        await transport.save_member_data(d)
+        record_saved([d])
+        logging.info(f"Member {m_id} data successfully saved")
     except Exception as e:
-        logging.info(f"Error while attempting to save member {m_id} data: {e}")
+        logging.warning(f"Error while attempting to save member {m_id} data: {e}")
         #raise #No raising here or else we dont record all the features of the member. Though we have it logged at least 
 
+async def save_member_data_batch(d: List[Dict[str,Any]]):
+    d = valid_transactions(d)
+    if not d:
+        return
+    remember_members(d)
+    if write_behind is not None:
+        await write_behind.enqueue_batch(d)
+        record_saved(d)
+        return
+    try:
+        await transport.save_member_data_batch(d)
+        record_saved(d)
+        logging.info(f"Batch of {len(d)} transactions successfully saved")
+    except Exception as e:
+        logging.warning(f"Error while attempting to save a batch of {len(d)} transactions: {e}")
+
+
+#The next runs of these members fold the saved transactions into the aggregate they share
+#Transactions member_data would reject are not saved, nor queued: the fallback and shed paths save the request as it
+#came in, and a rejected row would otherwise fail its whole write-behind batch
+def valid_transactions(d: List[Dict[str,Any]]) -> List[Dict[str,Any]]:
+    valid = []
+    for data in d:
+        try:
+            parse_timestamp(MemberData(**data).lastTransactionUtcTs)
+        except (ValueError,TypeError) as e:
+            logging.warning(f"Transaction of member {data.get('memberId')} not saved, it is invalid: {e}")
+            invalid_transactions_total.inc()
+            continue
+        valid.append(data)
+    return valid
 
-#support function that stores relevant metrics in a csv format ready to be used for stochastic analysis
-def record_logs(logs: Dict):
-    with open(logs_file,"a",newline="") as f:
-        w = csv.DictWriter(f,fieldnames=csv_columns)
-        w.writerow(logs)
 
+#Members go into the known member filter before their save is attempted: a save that fails on our side may still have
+#been stored, and a member wrongly looked up only costs a lookup while one wrongly skipped loses its history
+def remember_members(d: List[Dict[str,Any]]):
+    if member_filter is not None:
+        for data in d:
+            member_filter.add(data["memberId"])
 
 
+def record_saved(d: List[Dict[str,Any]]):
+    if member_coordinator is not None:
+        for data in d:
+            member_coordinator.record(data)
+
+
+#Saves a batch taken off the write-behind queue, errors go back to the queue which retries the batch
+async def persist_member_data_batch(d: List[Dict[str,Any]]):
+    await transport.save_member_data_batch(d)
+
+
+#support function that stores relevant metrics in a csv format ready to be used for stochastic analysis
+def record_logs(logs: Dict):
+    log_writer.write_row(logs)
@@ -0,0 +1,78 @@
+import time
+
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from src.models.member_features import MemberFeatures
+
+
+#LRU cache of (ats, resp) predictions keyed on the feature vector rounded to `precision` decimals, so members with
+#identical or nearly identical features share an entry. Entries expire after ttl seconds (0 keeps them until evicted)
+#and the whole cache is dropped when the model version changes
+class PredictionCache:
+
+    def __init__(self,max_size:int=10000,ttl:float=300.0,precision:int=4):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.precision = precision
+        self.entries: OrderedDict = OrderedDict()
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    #The rounded vector itself, not its hash: vectors whose hashes collide must not share predictions
+    def key(self,features: MemberFeatures) -> tuple:
+        return tuple(round(float(value),self.precision) for value in features.__dict__.values())
+
+    def get(self,features: MemberFeatures) -> Optional[Tuple[float,float]]:
+        key = self.key(features)
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        prediction, stored_at = entry
+        if self.ttl and time.monotonic() - stored_at > self.ttl:
+            del self.entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return prediction
+
+    def put(self,features: MemberFeatures,ats:float,resp:float):
+        key = self.key(features)
+        self.entries[key] = ((ats,resp),time.monotonic())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    #Drops every entry when the version differs from the one the entries were computed with
+    def set_version(self,version):
+        if version != self.version:
+            if self.entries:
+                self.invalidations += 1
+            self.entries.clear()
+            self.version = version
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "model_version": self.version,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups,4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations
+        }
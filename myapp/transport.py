@@ -0,0 +1,179 @@
+import asyncio
+
+from typing import Dict, Any, List, Optional
+
+from src.applications import member_data, prediction, offer_engine
+from src.models.member_data import MemberData
+from src.models.member_aggregate import MemberAggregate
+from src.models.member_features import MemberFeatures, MemberFeaturesBatch
+from src.models.offer_request import OfferRequest, OfferRequestBatch
+from src.storage.sharding import ShardMap
+from src.applications import wire_format
+
+
+#How the perk app reaches member_data, prediction and offer_engine.
+#Both transports expose the same coroutines, errors are raised to the orchestrator which handles and logs them
+
+
+#Distributed deployment: every call is an HTTP request to the service urls, each service has its own client.
+#Clients are DependencyClient objects, history and prediction calls are read-only and may be hedged.
+#With member_data_shards, member_data calls go straight to the shard owning the member instead of member_data_url.
+#content_type is the wire format of bodies and responses, "application/msgpack" is smaller and faster to decode than JSON
+class HttpTransport:
+
+    def __init__(self,member_data_client,ml_client,offer_client,member_data_url:str,ml_service_url:str,offer_service_url:str,
+                 member_data_shards: ShardMap = None,content_type:str = wire_format.JSON):
+        self.member_data_client = member_data_client
+        self.ml_client = ml_client
+        self.offer_client = offer_client
+        self.member_data_url = member_data_url
+        self.ml_service_url = ml_service_url
+        self.offer_service_url = offer_service_url
+        self.member_data_shards = member_data_shards
+        self.content_type = content_type
+
+    #Request arguments for a body, JSON bodies are left to httpx
+    def body(self,data) -> Dict[str,Any]:
+        if self.content_type == wire_format.JSON:
+            return {"json": data}
+        content,headers = wire_format.encode(data,self.content_type)
+        return {"content": content,"headers": headers}
+
+    def accept(self) -> Dict[str,Any]:
+        return {} if self.content_type == wire_format.JSON else {"headers": {"accept": self.content_type}}
+
+    def member_data_url_for(self,m_id:str) -> str:
+        return self.member_data_shards.url_for(m_id) if self.member_data_shards is not None else self.member_data_url
+
+    #Key of the member_data process a transaction is saved to, batches are only atomic within one
+    def member_data_partition(self,data: Dict[str,Any]) -> str:
+        return self.member_data_url_for(data["memberId"])
+
+    #None when the member has no history yet
+    async def get_member_aggregate(self,m_id:str) -> Optional[MemberAggregate]:
+        response = await self.member_data_client.get(f"{self.member_data_url_for(m_id)}/member_data/{m_id}/aggregate",hedge=True,**self.accept())
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return MemberAggregate(**wire_format.decode(response))
+
+    #Aggregates of several members in one call per member_data process, in the order asked
+    async def get_member_aggregates(self,m_ids: List[str]) -> List[Optional[MemberAggregate]]:
+        groups: Dict[str,List[int]] = {}
+        for i,m_id in enumerate(m_ids):
+            groups.setdefault(self.member_data_url_for(m_id),[]).append(i)
+        responses = await asyncio.gather(*(self.member_data_client.post(f"{url}/member_data/aggregates",hedge=True,**self.body([m_ids[i] for i in indices]))
+                                           for url,indices in groups.items()))
+        aggregates = [None] * len(m_ids)
+        for indices,response in zip(groups.values(),responses):
+            response.raise_for_status()
+            for i,aggregate in zip(indices,wire_format.decode(response)):
+                aggregates[i] = MemberAggregate(**aggregate) if aggregate is not None else None
+        return aggregates
+
+    #Every member with history, from each shard when the perk app knows them
+    async def member_ids(self) -> List[str]:
+        urls = self.member_data_shards.urls if self.member_data_shards is not None else [self.member_data_url]
+        responses = await asyncio.gather(*(self.member_data_client.get(f"{url}/member_ids",**self.accept()) for url in urls))
+        member_ids = []
+        for response in responses:
+            response.raise_for_status()
+            member_ids.extend(wire_format.decode(response))
+        return member_ids
+
+    async def save_member_data(self,data: Dict[str,Any]):
+        response = await self.member_data_client.post(f"{self.member_data_url_for(data['memberId'])}/member_data",**self.body(data))
+        response.raise_for_status()
+
+    #With shards every shard gets its part of the batch, concurrently, and the first error is raised once all are done
+    async def save_member_data_batch(self,data: List[Dict[str,Any]]):
+        if self.member_data_shards is None:
+            response = await self.member_data_client.post(f"{self.member_data_url}/member_data/batch",**self.body(data))
+            response.raise_for_status()
+            return
+        results = await asyncio.gather(*(self.save_shard_batch(url,group) for url,group in self.member_data_shards.split(data).items()),
+                                       return_exceptions=True)
+        for result in results:
+            if isinstance(result,Exception):
+                raise result
+
+    async def save_shard_batch(self,url:str,data: List[Dict[str,Any]]):
+        response = await self.member_data_client.post(f"{url}/member_data/batch",**self.body(data))
+        response.raise_for_status()
+
+    #model is "ats" or "resp"
+    async def predict(self,model:str,features: MemberFeatures) -> float:
+        response = await self.ml_client.post(f"{self.ml_service_url}/ml/{model}/predict",**self.body(features.model_dump()),hedge=True)
+        response.raise_for_status()
+        return wire_format.decode(response)["prediction"]
+
+    async def predict_batch(self,batch: MemberFeaturesBatch) -> Dict[str,List[float]]:
+        response = await self.ml_client.post(f"{self.ml_service_url}/ml/batch/predict",**self.body(batch.model_dump()),hedge=True)
+        response.raise_for_status()
+        return wire_format.decode(response)
+
+    async def model_version(self) -> str:
+        response = await self.ml_client.get(f"{self.ml_service_url}/ml/version",**self.accept())
+        response.raise_for_status()
+        return wire_format.decode(response)["version"]
+
+    async def assign_offer(self,offer: OfferRequest) -> Dict[str,str]:
+        response = await self.offer_client.post(f"{self.offer_service_url}/offer/assign",**self.body(offer.model_dump()))
+        response.raise_for_status()
+        return wire_format.decode(response)
+
+    async def assign_offer_batch(self,offers: OfferRequestBatch) -> List[str]:
+        response = await self.offer_client.post(f"{self.offer_service_url}/offer/batch/assign",**self.body(offers.model_dump()))
+        response.raise_for_status()
+        return wire_format.decode(response)["offers"]
+
+    async def aclose(self):
+        for client in {id(c): c for c in (self.member_data_client,self.ml_client,self.offer_client)}.values():
+            await client.aclose()
+
+
+#Edge deployments and benchmarks: the three applications run in the perk app process and are called directly,
+#without serialization, sockets or a second round of validation
+class EmbeddedTransport:
+
+    PREDICTORS = {"ats": prediction.predict_ats, "resp": prediction.predict_resp}
+
+    #Everything is stored by this process
+    def member_data_partition(self,data: Dict[str,Any]) -> str:
+        return ""
+
+    #Store calls run in a thread: the store may be writing a snapshot under its lock and the event loop must not wait for
+    #it. The aggregate is a copy, the orchestrator folds the incoming transaction into it
+    async def get_member_aggregate(self,m_id:str) -> Optional[MemberAggregate]:
+        return await asyncio.to_thread(member_data.load_member_aggregate,m_id)
+
+    async def get_member_aggregates(self,m_ids: List[str]) -> List[Optional[MemberAggregate]]:
+        return await asyncio.to_thread(lambda: [member_data.load_member_aggregate(m_id) for m_id in m_ids])
+
+    async def member_ids(self) -> List[str]:
+        return await asyncio.to_thread(member_data.get_member_ids)
+
+    async def save_member_data(self,data: Dict[str,Any]):
+        await asyncio.to_thread(member_data.store_member_data,MemberData(**data))
+
+    async def save_member_data_batch(self,data: List[Dict[str,Any]]):
+        await asyncio.to_thread(member_data.store_member_data_batch,[MemberData(**d) for d in data])
+
+    async def predict(self,model:str,features: MemberFeatures) -> float:
+        return self.PREDICTORS[model](features)["prediction"]
+
+    async def predict_batch(self,batch: MemberFeaturesBatch) -> Dict[str,List[float]]:
+        return prediction.predict_batch(batch)
+
+    async def model_version(self) -> str:
+        return prediction.model_version()["version"]
+
+    async def assign_offer(self,offer: OfferRequest) -> Dict[str,str]:
+        return offer_engine.get_offer(offer)
+
+    async def assign_offer_batch(self,offers: OfferRequestBatch) -> List[str]:
+        return offer_engine.get_offer_batch(offers)["offers"]
+
+    #The embedded member store is owned by this process, snapshot it like the member_data application would
+    async def aclose(self):
+        await asyncio.to_thread(member_data.member_data_store.close)
@@ -0,0 +1,201 @@
+import time
+import asyncio
+import logging
+
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+
+#Bounded write-behind queue for member transactions. Requests only enqueue, a background task saves the queued
+#transactions in batches, in arrival order, so a member's transactions are always saved in the order they came in.
+#A failed batch stays at the head of the queue and is retried with backoff (doubling up to max_backoff). It is dropped and
+#logged only once it failed max_retries more times and retry_for seconds have passed since its first attempt, which
+#lets an outage as long as the store's circuit breaker reset go by without losing anything.
+#A batch the store rejects (4xx) would fail every time: its rows are saved one by one instead and only the rejected
+#ones are dropped, to the dead letters. An error that lists the members it did not store (a partial write through the
+#member_data router) narrows the batch to their rows, the rows already stored are never saved again.
+#Transactions are kept in pending until their batch is saved, so readers can fold them into what they fetch.
+#partition maps a transaction to the store it is saved to (e.g. a member_data shard): a batch is then saved as one
+#sub-batch per partition, each retried on its own, so a failing store never makes another one save a batch twice
+class WriteBehindQueue:
+
+    def __init__(self,save_batch: Callable[[List[Dict[str,Any]]],Awaitable[Any]],max_pending:int=10000,batch_size:int=500,
+                 flush_interval:float=0.05,max_retries:int=5,retry_backoff:float=0.1,retry_for:float=0.0,max_backoff:float=2.0,
+                 partition: Callable[[Dict[str,Any]],Any] = None):
+        self.save_batch = save_batch
+        self.partition = partition
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.retry_for = retry_for
+        self.max_backoff = max_backoff
+
+        self.items = deque()
+        self.pending_by_member: Dict[str,List[Dict[str,Any]]] = {}
+        #Transactions of a member currently being saved, and how many of its transactions left the queue so far
+        self.in_flight: Dict[str,int] = {}
+        self.flushed: Dict[str,int] = {}
+        self.readers: Dict[str,int] = {}
+        self.changed = asyncio.Condition()
+        self.task = None
+        self.stopping = False
+        self.dropped = 0
+        self.dead_letters = deque(maxlen=1000)
+
+    def __len__(self):
+        return len(self.items)
+
+    def start(self):
+        self.stopping = False
+        self.task = asyncio.create_task(self.run())
+
+    #Saves everything still queued before returning
+    async def stop(self):
+        if self.task is None:
+            return
+        async with self.changed:
+            self.stopping = True
+            self.changed.notify_all()
+        await self.task
+        self.task = None
+
+    #Waits for room when the queue is full, which pushes back on the requests instead of growing without bound
+    async def enqueue(self,data: Dict[str,Any]):
+        async with self.changed:
+            await self.changed.wait_for(lambda: len(self.items) < self.max_pending)
+            self.items.append(data)
+            self.pending_by_member.setdefault(data["memberId"],[]).append(data)
+            self.changed.notify_all()
+
+    async def enqueue_batch(self,data: List[Dict[str,Any]]):
+        for d in data:
+            await self.enqueue(d)
+
+    #A member's queued transactions that are not saved yet, oldest first
+    def pending(self,member_id:str) -> List[Dict[str,Any]]:
+        return list(self.pending_by_member.get(member_id,()))
+
+    #Runs fetch (a read of the member's saved data) and returns its result with the member's unsaved transactions.
+    #A read that overlaps a batch holding some of the member's transactions may or may not have seen them, so it is
+    #repeated once that batch is done
+    async def read_through(self,member_id:str,fetch: Callable[[],Awaitable[Any]]):
+        self.readers[member_id] = self.readers.get(member_id,0) + 1
+        try:
+            while True:
+                async with self.changed:
+                    await self.changed.wait_for(lambda: not self.in_flight.get(member_id))
+                flushed = self.flushed.get(member_id,0)
+                pending = self.pending(member_id)
+                result = await fetch()
+                if not self.in_flight.get(member_id) and self.flushed.get(member_id,0) == flushed:
+                    return result, pending
+        finally:
+            self.readers[member_id] -= 1
+            if not self.readers[member_id]:
+                del self.readers[member_id]
+            self.prune(member_id)
+
+    #A member's flush count is only needed while it has transactions queued or being saved, or a read in progress
+    def prune(self,member_id:str):
+        if member_id not in self.pending_by_member and member_id not in self.in_flight and member_id not in self.readers:
+            self.flushed.pop(member_id,None)
+
+    async def run(self):
+        while True:
+            async with self.changed:
+                await self.changed.wait_for(lambda: self.items or self.stopping)
+                if not self.items:
+                    return
+            #Lets a few more transactions in so batches fill up under load
+            if len(self.items) < self.batch_size and not self.stopping:
+                await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def save_with_retries(self,batch: List[Dict[str,Any]]):
+        start = time.monotonic()
+        attempt = 0
+        while True:
+            try:
+                await self.save_batch(batch)
+                logging.info(f"Write-behind saved {len(batch)} transactions")
+                return
+            except Exception as e:
+                failed = failed_members(e)
+                if failed is not None:
+                    batch = [d for d in batch if d["memberId"] in failed]
+                    if not batch:
+                        return
+                if rejected(e):
+                    await self.save_rejected(batch,e)
+                    return
+                logging.warning(f"Write-behind batch of {len(batch)} transactions failed (attempt {attempt + 1}): {e}")
+                if attempt >= self.max_retries and time.monotonic() - start >= self.retry_for:
+                    break
+                await asyncio.sleep(min(self.max_backoff,self.retry_backoff * 2 ** attempt))
+                attempt += 1
+        self.dropped += len(batch)
+        logging.error(f"Write-behind dropped {len(batch)} transactions after {attempt + 1} attempts in {time.monotonic() - start:.1f}s")
+
+    #Nothing of a rejected batch is stored, its rows are saved one by one, in order, to set the offending ones aside
+    async def save_rejected(self,batch: List[Dict[str,Any]],error: Exception):
+        if len(batch) > 1:
+            for d in batch:
+                await self.save_with_retries([d])
+            return
+        self.dropped += 1
+        self.dead_letters.append((batch[0],str(error)))
+        logging.error(f"Write-behind dropped a transaction of member {batch[0].get('memberId')} rejected by the store: {error}")
+
+    async def flush(self):
+        batch = [self.items[i] for i in range(min(self.batch_size,len(self.items)))]
+        members = {}
+        for d in batch:
+            members[d["memberId"]] = members.get(d["memberId"],0) + 1
+        for member_id,count in members.items():
+            self.in_flight[member_id] = self.in_flight.get(member_id,0) + count
+
+        try:
+            if self.partition is None:
+                await self.save_with_retries(batch)
+            else:
+                groups = {}
+                for d in batch:
+                    groups.setdefault(self.partition(d),[]).append(d)
+                await asyncio.gather(*(self.save_with_retries(group) for group in groups.values()))
+        finally:
+            async with self.changed:
+                for _ in batch:
+                    self.items.popleft()
+                for member_id,count in members.items():
+                    del self.pending_by_member[member_id][:count]
+                    if not self.pending_by_member[member_id]:
+                        del self.pending_by_member[member_id]
+                    self.in_flight[member_id] -= count
+                    if not self.in_flight[member_id]:
+                        del self.in_flight[member_id]
+                    self.flushed[member_id] = self.flushed.get(member_id,0) + count
+                    self.prune(member_id)
+                self.changed.notify_all()
+
+
+#Errors the store answers with a 4xx: the same request can never succeed. Covers httpx status errors (HTTP transport)
+#and the HTTPException raised by member_data itself (embedded transport)
+def rejected(error: Exception) -> bool:
+    status = getattr(error,"status_code",None)
+    if status is None:
+        status = getattr(getattr(error,"response",None),"status_code",None)
+    return isinstance(status,int) and 400 <= status < 500
+
+
+#Members a partially stored batch did not store, from the detail of the member_data router's error. None when the
+#error does not say, then none of the batch is known to be stored
+def failed_members(error: Exception) -> Optional[Set[str]]:
+    try:
+        detail = error.response.json()["detail"]
+    except Exception:
+        return None
+    if not isinstance(detail,dict) or not isinstance(detail.get("failed_members"),list):
+        return None
+    return set(detail["failed_members"])
@@ -1,10 +1,21 @@
 from fastapi import FastAPI
+from src.observability.metrics import MetricsRegistry, instrument
+from src.observability.profiling import add_diagnostics
+from src.applications.wire_format import FastResponse, WireRoute
 
 
 class BaseApplication(FastAPI):
     def __init__(self, *args, **kwargs):
+        #Responses are encoded with orjson, or msgpack for callers that accept it (see wire_format)
+        kwargs.setdefault("default_response_class", FastResponse)
         super().__init__(*args, **kwargs)
+        self.router.route_class = WireRoute
         self.add_api_route("/health", self.health, methods=["GET"])
+        #Every application serves its request metrics on /metrics, applications can register their own in self.metrics
+        self.metrics = MetricsRegistry()
+        instrument(self, self.metrics)
+        #Profiler, slow requests and event loop lag under /admin, see profiling
+        self.slow_requests, self.loop_lag = add_diagnostics(self, self.metrics)
 
     def health(self):
         return {"status": "ok"}
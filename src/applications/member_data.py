@@ -1,28 +1,211 @@
+import os
 from pydantic import BaseModel
-from fastapi import HTTPException
+from fastapi import FastAPI, HTTPException
+from contextlib import asynccontextmanager
 from src.applications.base_application import BaseApplication
+from src.applications.wire_format import trusted
 from src.models.member_data import MemberData
-from typing import Dict, List
+from src.models.member_aggregate import MemberAggregate
+from src.models.member_features import MemberFeatures
+from src.storage.member_store import MemberStore, parse_timestamp
+from src.storage.sharding import shard_for
+from src.features.engine import SECONDS_PER_DAY, WindowSum, registry, compute_stats, compute_features, now_epoch
+from src.features.aggregates import apply_member_transaction, member_aggregate_features, aggregate_stats
+from typing import Dict, List, Optional
 
 
+#Columnar member history. Durable when MEMBER_STORE_DIR is set: appends go to a log and snapshots make restarts fast
+member_data_store = MemberStore(
+    os.getenv("MEMBER_STORE_DIR"),
+    snapshot_every=int(os.getenv("MEMBER_STORE_SNAPSHOT_EVERY", "100000")),
+    fsync=os.getenv("MEMBER_STORE_FSYNC", "0") == "1"
+)
 
-member_data_store: Dict[str, List[MemberData]] = {}
+#When this process is one of several shards (see member_data_shards), it only accepts the members hashed to it,
+#a misrouted member would otherwise get a second, diverging history on another shard
+MEMBER_DATA_SHARDS = int(os.getenv("MEMBER_DATA_SHARDS", "1"))
+MEMBER_DATA_SHARD_INDEX = int(os.getenv("MEMBER_DATA_SHARD_INDEX", "0"))
 
+#Running per-member aggregates, updated on every store so features never need a full history scan.
+#Members loaded from disk get theirs built on first use
+member_aggregates: Dict[str, MemberAggregate] = {}
 
+
+#Stores run in the threadpool, the append and the fold into the aggregate happen together under the store's lock
 def store_member_data(data: MemberData):
     member_id = data.memberId
-    if member_id not in member_data_store:
-        member_data_store[member_id] = []
-    member_data_store[member_id].append(data)
+    check_shard(member_id)
+    ts = parse_member_timestamp(data)
+    with member_data_store.lock:
+        aggregate = member_aggregate(member_id) or MemberAggregate()
+        member_data_store.append(member_id, ts, data.lastTransactionType,
+                                 data.lastTransactionPointsBought, data.lastTransactionRevenueUsd)
+        member_aggregates[member_id] = apply_member_transaction(aggregate, data.lastTransactionPointsBought,
+                                 data.lastTransactionRevenueUsd, data.lastTransactionType, ts)
     return data
 
 
-def get_member_data(member_id: str) -> List[MemberData]:
-    if member_id not in member_data_store:
+def check_shard(member_id: str):
+    if MEMBER_DATA_SHARDS > 1:
+        shard = shard_for(member_id, MEMBER_DATA_SHARDS)
+        if shard != MEMBER_DATA_SHARD_INDEX:
+            raise HTTPException(status_code=421, detail=f"Member {member_id} belongs to shard {shard}, not {MEMBER_DATA_SHARD_INDEX}")
+
+
+#Timestamps are parsed once, when a transaction comes in, and kept as epoch seconds from then on
+def parse_member_timestamp(data: MemberData) -> int:
+    try:
+        return parse_timestamp(data.lastTransactionUtcTs)
+    except ValueError:
+        raise HTTPException(status_code=422, detail="lastTransactionUtcTs must be formatted as YYYY-MM-DD HH:MM:SS")
+
+
+#Stores a list of transactions in order, one call for a whole batch
+def store_member_data_batch(data: List[MemberData]) -> dict:
+    #The whole batch is rejected before anything is stored
+    for d in data:
+        check_shard(d.memberId)
+        parse_member_timestamp(d)
+    for d in data:
+        store_member_data(d)
+    return {"stored": len(data)}
+
+
+#Whole history by default. since and until (YYYY-MM-DD HH:MM:SS, inclusive) and limit (latest N) select a time range,
+#returned in timestamp order without scanning the rest of the history
+def get_member_data(member_id: str, since: Optional[str] = None, until: Optional[str] = None,
+                    limit: Optional[int] = None) -> List[MemberData]:
+    check_shard(member_id)
+    if limit is not None and limit < 1:
+        raise HTTPException(status_code=422, detail="limit must be at least 1")
+    history = member_data_store.history(member_id, parse_query_timestamp("since", since), parse_query_timestamp("until", until), limit)
+    if history is None:
+        raise HTTPException(status_code=404, detail="Member not found")
+    return history
+
+
+def parse_query_timestamp(name: str, value: Optional[str]) -> Optional[int]:
+    if value is None:
+        return None
+    try:
+        return parse_timestamp(value)
+    except ValueError:
+        raise HTTPException(status_code=422, detail=f"{name} must be formatted as YYYY-MM-DD HH:MM:SS")
+
+
+def get_member_aggregate(member_id: str) -> MemberAggregate:
+    check_shard(member_id)
+    aggregate = load_member_aggregate(member_id)
+    if aggregate is None:
         raise HTTPException(status_code=404, detail="Member not found")
-    return member_data_store[member_id]
+    return aggregate
+
+
+#Aggregates of several members in one call, in the order asked, None for members without history
+def get_member_aggregates(member_ids: List[str]) -> List[Optional[MemberAggregate]]:
+    for member_id in member_ids:
+        check_shard(member_id)
+    return [load_member_aggregate(member_id) for member_id in member_ids]
+
+
+#Every member with history in this process, clients use it to know which members they can skip looking up
+def get_member_ids() -> List[str]:
+    return member_data_store.member_ids()
+
+
+#A copy of the member's running aggregate, callers may render or change it while other requests store transactions
+def load_member_aggregate(member_id: str) -> Optional[MemberAggregate]:
+    with member_data_store.lock:
+        aggregate = member_aggregate(member_id)
+        return aggregate.model_copy(deep=True) if aggregate is not None else None
+
+
+#The live aggregate, rebuilt from the member's stored columns the first time it is needed after a restart.
+#Only used under the store's lock
+def member_aggregate(member_id: str) -> Optional[MemberAggregate]:
+    aggregate = member_aggregates.get(member_id)
+    if aggregate is None:
+        columns = member_data_store.get(member_id)
+        if columns is None:
+            return None
+        aggregate = MemberAggregate()
+        type_names = member_data_store.type_names
+        for ts, t, points, revenue in zip(columns.ts.tolist(), columns.types.tolist(),
+                                          columns.points.tolist(), columns.revenue.tolist()):
+            apply_member_transaction(aggregate, points, revenue, type_names[t], ts)
+        member_aggregates[member_id] = aggregate
+    return aggregate
+
+
+#Features of a member's stored history plus the incoming transaction, without mutating the stored aggregate
+def get_member_features(member_id: str, data: MemberData) -> MemberFeatures:
+    check_shard(member_id)
+    aggregate = load_member_aggregate(member_id) or MemberAggregate()
+    apply_member_transaction(aggregate, data.lastTransactionPointsBought, data.lastTransactionRevenueUsd,
+                             data.lastTransactionType, parse_member_timestamp(data))
+    return member_aggregate_features(aggregate)
+
+
+#Every registered feature, windowed and recency ones included, from a single pass over the stored history
+def get_member_extended_features(member_id: str) -> Dict[str, float]:
+    check_shard(member_id)
+    #The columns are copied under the store lock, an append in between would leave them with different lengths
+    with member_data_store.lock:
+        columns = member_data_store.get(member_id)
+        if columns is None:
+            raise HTTPException(status_code=404, detail="Member not found")
+        points, revenue, types, ts = columns.points.tolist(), columns.revenue.tolist(), columns.types.tolist(), columns.ts.tolist()
+    type_names = member_data_store.type_names
+    rows = zip(points, revenue, [type_names[t] for t in types], ts)
+    return compute_features(compute_stats(rows, registry.accumulators()))
+
+
+#Features made of time windows only, e.g. TRANSACTIONS_30D
+WINDOWED_FEATURES = [f.name for f in registry.features.values()
+                     if f.accumulators and all(isinstance(acc, WindowSum) for acc in f.accumulators)]
+
+
+#The windowed features of the registry from the member's time index: every window is two binary searches and a
+#difference of prefix sums, the core statistics come from the running aggregate. at sets the reference time (now by default),
+#transactions after it are outside every window
+def get_member_windowed_features(member_id: str, at: Optional[str] = None) -> Dict[str, float]:
+    check_shard(member_id)
+    columns = member_data_store.get(member_id)
+    if columns is None:
+        raise HTTPException(status_code=404, detail="Member not found")
+    now = parse_query_timestamp("at", at) if at is not None else now_epoch()
+    #The index is built and kept up to date by appends under the store lock, it is only read under it
+    with member_data_store.lock:
+        index = columns.time_index()
+        stats = aggregate_stats(load_member_aggregate(member_id))
+        for acc in registry.accumulators(WINDOWED_FEATURES):
+            since = now - acc.days * SECONDS_PER_DAY
+            count, points, revenue = index.totals(since, now)
+            stats.extra[acc.key] = {"since": since, "until": now, "sum": points if acc.column == "points" else revenue,
+                                    "count": count}
+    return compute_features(stats, now, WINDOWED_FEATURES)
+
+
+#Snapshots the store on shutdown so the next start only memory maps it
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    member_data_store.close()
 
 
-app = BaseApplication()
+app = BaseApplication(lifespan=lifespan)
 app.add_api_route("/member_data", store_member_data, methods=["POST"], response_model=MemberData)
-app.add_api_route("/member_data/{member_id}", get_member_data, methods=["GET"], response_model=List[MemberData])
+app.add_api_route("/member_data/batch", store_member_data_batch, methods=["POST"])
+#History and aggregates are built by this application, they are rendered without being validated again.
+#The models still document the responses
+app.add_api_route("/member_data/aggregates", trusted(get_member_aggregates), methods=["POST"], response_model=None,
+                  responses={200: {"model": List[Optional[MemberAggregate]]}})
+app.add_api_route("/member_ids", trusted(get_member_ids), methods=["GET"], response_model=None,
+                  responses={200: {"model": List[str]}})
+app.add_api_route("/member_data/{member_id}", trusted(get_member_data), methods=["GET"], response_model=None,
+                  responses={200: {"model": List[MemberData]}})
+app.add_api_route("/member_data/{member_id}/aggregate", trusted(get_member_aggregate), methods=["GET"], response_model=None,
+                  responses={200: {"model": MemberAggregate}})
+app.add_api_route("/member_data/{member_id}/features", get_member_features, methods=["POST"], response_model=MemberFeatures)
+app.add_api_route("/member_data/{member_id}/extended_features", get_member_extended_features, methods=["GET"])
+app.add_api_route("/member_data/{member_id}/windowed_features", get_member_windowed_features, methods=["GET"])
@@ -0,0 +1,147 @@
+import os
+import asyncio
+from typing import Dict, List
+from fastapi import FastAPI, HTTPException, Request, Response
+from contextlib import asynccontextmanager
+from httpx import AsyncClient, Limits
+from src.applications.base_application import BaseApplication
+from src.storage.sharding import ShardMap
+from src.applications import wire_format
+
+
+#Stateless front of the member_data shards: every request is forwarded to the shard owning its member, so it can run
+#with as many workers as needed. Clients that know the shard urls (the perk app) can skip it and call the shards directly
+shard_map = ShardMap.from_env(os.getenv("MEMBER_DATA_SHARD_URLS"))
+client: AsyncClient = None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global client
+    if shard_map is None:
+        raise RuntimeError("MEMBER_DATA_SHARD_URLS must list the member_data shard urls")
+    connections = int(os.getenv("MEMBER_DATA_ROUTER_CONNECTIONS", "100"))
+    client = AsyncClient(limits=Limits(max_connections=connections, max_keepalive_connections=connections))
+    yield
+    await client.aclose()
+
+
+def as_response(response) -> Response:
+    return Response(content=response.content, status_code=response.status_code,
+                    media_type=response.headers.get("content-type"))
+
+
+#Bodies and responses are passed through in the caller's wire format, the shard negotiates it like for a direct call
+async def forward(request: Request, member_id: str, path: str, body: bytes = None) -> Response:
+    headers = {"accept": request.headers.get("accept", wire_format.JSON)}
+    if body is not None:
+        headers["content-type"] = wire_format.request_content_type(request)
+    query = f"?{request.url.query}" if request.url.query else ""
+    response = await client.request(request.method, f"{shard_map.url_for(member_id)}{path}{query}", content=body, headers=headers)
+    return as_response(response)
+
+
+def parse_body(request: Request, body: bytes):
+    try:
+        return wire_format.loads(body, wire_format.request_content_type(request))
+    except ValueError:
+        raise HTTPException(status_code=422, detail="Request body must be JSON or msgpack")
+
+
+async def store_member_data(request: Request):
+    body = await request.body()
+    data = parse_body(request, body)
+    if not isinstance(data, dict) or "memberId" not in data:
+        raise HTTPException(status_code=422, detail="memberId is required")
+    return await forward(request, data["memberId"], "/member_data", body)
+
+
+#Splits the batch per shard, each shard gets its members' transactions in batch order.
+#Shards are written concurrently and a shard stores all of its part or nothing. When some fail the response lists the
+#members that were not stored, so a client retries only those and never stores the other shards' part twice: 502 when a
+#shard did not answer, or the shard's own 4xx when it rejected its part
+async def store_member_data_batch(request: Request):
+    data = parse_body(request, await request.body())
+    if not isinstance(data, list) or not all(isinstance(d, dict) and "memberId" in d for d in data):
+        raise HTTPException(status_code=422, detail="A list of transactions with a memberId is required")
+
+    groups = shard_map.split(data)
+    responses = await asyncio.gather(*(client.post(f"{url}/member_data/batch", json=group) for url, group in groups.items()),
+                                     return_exceptions=True)
+    stored, failed, status_code = 0, [], None
+    for group, response in zip(groups.values(), responses):
+        if isinstance(response, Exception) or response.status_code >= 500:
+            failed.extend(d["memberId"] for d in group)
+            status_code = 502
+        elif response.status_code >= 300:
+            failed.extend(d["memberId"] for d in group)
+            status_code = status_code or response.status_code
+        else:
+            stored += response.json()["stored"]
+    if failed:
+        raise HTTPException(status_code=status_code, detail={"stored": stored, "failed_members": list(dict.fromkeys(failed))})
+    return {"stored": stored}
+
+
+#Each shard gets the ids of its members, the aggregates are put back in the order asked
+async def get_member_aggregates(request: Request):
+    member_ids = parse_body(request, await request.body())
+    if not isinstance(member_ids, list) or not all(isinstance(m, str) for m in member_ids):
+        raise HTTPException(status_code=422, detail="A list of member ids is required")
+
+    positions: Dict[str, List[int]] = {}
+    for i, member_id in enumerate(member_ids):
+        positions.setdefault(shard_map.url_for(member_id), []).append(i)
+    responses = await asyncio.gather(*(client.post(f"{url}/member_data/aggregates", json=[member_ids[i] for i in indices])
+                                       for url, indices in positions.items()), return_exceptions=True)
+    aggregates = [None] * len(member_ids)
+    for (url, indices), response in zip(positions.items(), responses):
+        if isinstance(response, Exception) or response.status_code >= 300:
+            raise HTTPException(status_code=502, detail=f"Shard {url} did not answer")
+        for i, aggregate in zip(indices, response.json()):
+            aggregates[i] = aggregate
+    return aggregates
+
+
+#The members of every shard, fetched in msgpack whatever the caller asked for
+async def get_member_ids():
+    responses = await asyncio.gather(*(client.get(f"{url}/member_ids", headers={"accept": wire_format.MSGPACK})
+                                       for url in shard_map.urls), return_exceptions=True)
+    member_ids = []
+    for url, response in zip(shard_map.urls, responses):
+        if isinstance(response, Exception) or response.status_code >= 300:
+            raise HTTPException(status_code=502, detail=f"Shard {url} did not answer")
+        member_ids.extend(wire_format.decode(response))
+    return member_ids
+
+
+async def get_member_data(member_id: str, request: Request):
+    return await forward(request, member_id, f"/member_data/{member_id}")
+
+
+async def get_member_aggregate(member_id: str, request: Request):
+    return await forward(request, member_id, f"/member_data/{member_id}/aggregate")
+
+
+async def get_member_features(member_id: str, request: Request):
+    return await forward(request, member_id, f"/member_data/{member_id}/features", await request.body())
+
+
+async def get_member_extended_features(member_id: str, request: Request):
+    return await forward(request, member_id, f"/member_data/{member_id}/extended_features")
+
+
+async def get_member_windowed_features(member_id: str, request: Request):
+    return await forward(request, member_id, f"/member_data/{member_id}/windowed_features")
+
+
+app = BaseApplication(lifespan=lifespan)
+app.add_api_route("/member_data", store_member_data, methods=["POST"])
+app.add_api_route("/member_data/batch", store_member_data_batch, methods=["POST"])
+app.add_api_route("/member_data/aggregates", get_member_aggregates, methods=["POST"])
+app.add_api_route("/member_ids", get_member_ids, methods=["GET"])
+app.add_api_route("/member_data/{member_id}", get_member_data, methods=["GET"])
+app.add_api_route("/member_data/{member_id}/aggregate", get_member_aggregate, methods=["GET"])
+app.add_api_route("/member_data/{member_id}/features", get_member_features, methods=["POST"])
+app.add_api_route("/member_data/{member_id}/extended_features", get_member_extended_features, methods=["GET"])
+app.add_api_route("/member_data/{member_id}/windowed_features", get_member_windowed_features, methods=["GET"])
@@ -0,0 +1,88 @@
+import os
+import sys
+import json
+import time
+import signal
+import argparse
+import subprocess
+from pathlib import Path
+from typing import List
+
+
+#Runs member_data as N shard processes, one uvicorn worker each, plus the router in front of them.
+#Each shard owns the members hashed to it and, with --store-dir, its own durable store in <store-dir>/shard-<i>,
+#so stores never share a member and each member's transactions are appended by a single process, in order
+def shard_urls(host: str, base_port: int, shards: int) -> List[str]:
+    return [f"http://{host}:{base_port + i}" for i in range(shards)]
+
+
+def uvicorn_command(target: str, host: str, port: int, workers: int) -> List[str]:
+    return [sys.executable, "-m", "uvicorn", target, "--host", host, "--port", str(port),
+            "--workers", str(workers), "--no-access-log", "--log-level", "warning"]
+
+
+#Members are placed by hash modulo the shard count, a store directory written with another count would lose members
+def check_layout(store_dir: str, shards: int):
+    os.makedirs(store_dir, exist_ok=True)
+    layout_path = os.path.join(store_dir, "shards.json")
+    if os.path.exists(layout_path):
+        with open(layout_path) as f:
+            previous = json.load(f)["shards"]
+        if previous != shards:
+            raise SystemExit(f"{store_dir} holds {previous} shards, it cannot be opened with {shards}")
+    else:
+        with open(layout_path, "w") as f:
+            json.dump({"shards": shards}, f)
+
+
+def start(shards: int, base_port: int, router_port: int, router_workers: int, store_dir: str = None, host: str = "127.0.0.1"):
+    if store_dir:
+        check_layout(store_dir, shards)
+    root = str(Path(__file__).resolve().parent.parent.parent)
+    env = dict(os.environ, PYTHONPATH=root, MEMBER_DATA_SHARDS=str(shards))
+    processes = []
+    for i in range(shards):
+        shard_env = dict(env, MEMBER_DATA_SHARD_INDEX=str(i))
+        if store_dir:
+            shard_env["MEMBER_STORE_DIR"] = os.path.join(store_dir, f"shard-{i}")
+        processes.append(subprocess.Popen(uvicorn_command("src.applications.member_data:app", host, base_port + i, 1), env=shard_env))
+
+    urls = shard_urls(host, base_port, shards)
+    if router_port:
+        router_env = dict(env, MEMBER_DATA_SHARD_URLS=",".join(urls))
+        processes.append(subprocess.Popen(uvicorn_command("src.applications.member_data_router:app", host, router_port, router_workers), env=router_env))
+    return processes, urls
+
+
+#Shards snapshot their stores on SIGTERM, so they are always stopped rather than killed
+def stop(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs member_data as hash-partitioned shard processes behind a router")
+    parser.add_argument("--shards", type=int, default=os.cpu_count())
+    parser.add_argument("--base-port", type=int, default=6101, help="port of shard 0, shard i listens on base port + i")
+    parser.add_argument("--router-port", type=int, default=6001, help="0 runs the shards without a router")
+    parser.add_argument("--router-workers", type=int, default=1)
+    parser.add_argument("--store-dir", default=os.getenv("MEMBER_STORE_DIR"), help="shard i stores its data in <store-dir>/shard-i")
+    parser.add_argument("--host", default="127.0.0.1")
+    args = parser.parse_args()
+
+    processes, urls = start(args.shards, args.base_port, args.router_port, args.router_workers, args.store_dir, args.host)
+    print(f"MEMBER_DATA_SHARD_URLS={','.join(urls)}", flush=True)
+
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda *_: stopping.append(True))
+    try:
+        while not stopping and all(process.poll() is None for process in processes):
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        pass
+    stop(processes)
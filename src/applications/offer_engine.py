@@ -1,15 +1,26 @@
+import os
 from pydantic import BaseModel
 from src.applications.base_application import BaseApplication
-from src.models.offer_request import OfferRequest
+from src.applications.offer_rules import OfferRuleTable, DEFAULT_RULES_PATH
+from src.models.offer_request import OfferRequest, OfferRequestBatch
+from fastapi import HTTPException
+
+
+#Offer rules are data, edits to the file are picked up without a restart
+offer_rules = OfferRuleTable(os.getenv("OFFER_RULES_PATH", DEFAULT_RULES_PATH))
 
 
 def get_offer(prediction: OfferRequest) -> dict:
-    if prediction.ats_prediction * prediction.resp_prediction >= 200:
-        result = "50% Discount"
-    else:
-        result = "35% Bonus"
-    return {"offer": result}
+    return {"offer": offer_rules.evaluate(prediction.ats_prediction, prediction.resp_prediction)}
+
+
+#Assigns the offers of N prediction pairs in one call, in input order
+def get_offer_batch(predictions: OfferRequestBatch) -> dict:
+    if len(predictions.ats_predictions) != len(predictions.resp_predictions):
+        raise HTTPException(status_code=422, detail="ats_predictions and resp_predictions must have the same length")
+    return {"offers": offer_rules.evaluate_batch(predictions.ats_predictions, predictions.resp_predictions)}
 
 
 app = BaseApplication()
 app.add_api_route("/offer/assign", get_offer, methods=["POST"])
+app.add_api_route("/offer/batch/assign", get_offer_batch, methods=["POST"])
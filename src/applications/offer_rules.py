@@ -0,0 +1,127 @@
+import os
+import json
+import time
+import bisect
+import logging
+import numpy as np
+
+from typing import Dict, List, Optional
+
+
+DEFAULT_RULES_PATH = os.path.join(os.path.dirname(__file__), "offer_rules.json")
+
+SEGMENT_BOUNDS = {
+    "min_ats": ("ats", False), "max_ats": ("ats", True),
+    "min_resp": ("resp", False), "max_resp": ("resp", True),
+}
+
+
+#One offer rule: applies when score = ats * resp is in [min_score, max_score) and the segment bounds hold.
+#Among matching rules the highest priority wins, then the highest min_score
+class OfferRule:
+
+    def __init__(self, rule: Dict):
+        self.name = rule.get("name", rule["offer"])
+        self.offer = rule["offer"]
+        self.min_score = float(rule.get("min_score", float("-inf")))
+        self.max_score = rule.get("max_score")
+        self.priority = rule.get("priority", 0)
+        self.segment = rule.get("segment", {})
+        unknown = set(self.segment) - set(SEGMENT_BOUNDS)
+        if unknown:
+            raise ValueError(f"Unknown segment conditions in rule {self.name}: {sorted(unknown)}")
+
+    #True when the rule only depends on min_score, which the threshold index already checked
+    @property
+    def unconditional(self) -> bool:
+        return self.max_score is None and not self.segment
+
+    def matches(self, score: float, ats: float, resp: float) -> bool:
+        if self.max_score is not None and score >= self.max_score:
+            return False
+        values = {"ats": ats, "resp": resp}
+        for condition, bound in self.segment.items():
+            field, is_max = SEGMENT_BOUNDS[condition]
+            if (values[field] >= bound) if is_max else (values[field] < bound):
+                return False
+        return True
+
+
+#Rules compiled into a sorted threshold index: thresholds[i] is the i-th distinct min_score and candidates[i]
+#the rules reachable from it, by priority. Evaluation is a binary search plus, only for conditional rules, a short scan
+class CompiledRules:
+
+    def __init__(self, config: Dict):
+        self.default_offer = config["default_offer"]
+        rules = [OfferRule(r) for r in config.get("rules", [])]
+
+        self.thresholds = sorted({r.min_score for r in rules})
+        self.candidates = [
+            sorted((r for r in rules if r.min_score <= t), key=lambda r: (-r.priority, -r.min_score))
+            for t in self.thresholds
+        ]
+        #Offer of each threshold when its best candidate has no extra condition, None when rows need a scan
+        self.direct_offers = np.array(
+            [self.default_offer] + [c[0].offer if c[0].unconditional else None for c in self.candidates], dtype=object)
+        self.threshold_array = np.asarray(self.thresholds, dtype=np.float64)
+
+    def evaluate(self, ats: float, resp: float) -> str:
+        score = ats * resp
+        i = bisect.bisect_right(self.thresholds, score) - 1
+        if i < 0:
+            return self.default_offer
+        for rule in self.candidates[i]:
+            if rule.matches(score, ats, resp):
+                return rule.offer
+        return self.default_offer
+
+    def evaluate_batch(self, ats: List[float], resp: List[float]) -> List[str]:
+        ats = np.asarray(ats, dtype=np.float64)
+        resp = np.asarray(resp, dtype=np.float64)
+        positions = np.searchsorted(self.threshold_array, ats * resp, side="right")
+        offers = self.direct_offers[positions]
+        for row in np.flatnonzero(np.equal(offers, None)):
+            offers[row] = self.evaluate(float(ats[row]), float(resp[row]))
+        return offers.tolist()
+
+
+#Offer rules loaded from a json file and reloaded when the file changes, checked at most every check_interval seconds.
+#A file that fails to load or compile is logged and the previous rules are kept
+class OfferRuleTable:
+
+    def __init__(self, path: str = DEFAULT_RULES_PATH, check_interval: float = 1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self.mtime = None
+        self.next_check = 0
+        self.rules: Optional[CompiledRules] = None
+        self.reload()
+        if self.rules is None:
+            raise ValueError(f"Offer rules could not be loaded from {path}")
+
+    def reload(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime == self.mtime:
+                return
+            self.mtime = mtime
+            with open(self.path) as f:
+                rules = CompiledRules(json.load(f))
+            self.rules = rules
+            logging.info(f"Offer rules loaded from {self.path}: {len(rules.thresholds)} thresholds")
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.error(f"Offer rules reload from {self.path} failed, keeping the current rules: {e}")
+
+    def maybe_reload(self):
+        now = time.monotonic()
+        if now >= self.next_check:
+            self.next_check = now + self.check_interval
+            self.reload()
+
+    def evaluate(self, ats: float, resp: float) -> str:
+        self.maybe_reload()
+        return self.rules.evaluate(ats, resp)
+
+    def evaluate_batch(self, ats: List[float], resp: List[float]) -> List[str]:
+        self.maybe_reload()
+        return self.rules.evaluate_batch(ats, resp)
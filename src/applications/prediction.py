@@ -1,6 +1,12 @@
 from src.applications.base_application import BaseApplication
-from src.models.member_features import MemberFeatures
+from src.models.member_features import MemberFeatures, MemberFeaturesBatch
 from pydantic import BaseModel
+import numpy as np
+import os
+
+
+#Version of the ats and resp models, clients caching predictions drop them when it changes
+MODEL_VERSION = os.getenv("MODEL_VERSION", "1")
 
 
 def predict_ats(member_features: MemberFeatures) -> dict:
@@ -33,6 +39,64 @@ def predict_resp(member_features: MemberFeatures) -> dict:
     return {"prediction": min(0.9, 1000 * product)}
 
 
+#Both predictions from a single payload, saving a round trip per offer
+def predict(member_features: MemberFeatures) -> dict:
+    return {
+        "ats": predict_ats(member_features)["prediction"],
+        "resp": predict_resp(member_features)["prediction"]
+    }
+
+
+#Vectorized counterparts of predict_ats and predict_resp, operating on whole feature columns at once
+def predict_ats_batch(columns: dict) -> np.ndarray:
+    expected_volume = (
+        columns["LAST_3_TRANSACTIONS_AVG_POINTS_BOUGHT"] * 0.7
+        + columns["AVG_POINTS_BOUGHT"] * 0.3
+    )
+    weight = (
+        columns["PCT_BUY_TRANSACTIONS"]
+        + columns["PCT_GIFT_TRANSACTIONS"]
+        - columns["PCT_REDEEM_TRANSACTIONS"]
+    )
+    weight = np.where(weight < 0, 0, weight)
+    return np.abs(expected_volume * weight)
+
+
+def predict_resp_batch(columns: dict) -> np.ndarray:
+    product_weight = (
+        columns["PCT_BUY_TRANSACTIONS"] * 0.4
+        + columns["PCT_GIFT_TRANSACTIONS"] * 0.3
+        + columns["PCT_REDEEM_TRANSACTIONS"] * 0.3
+    )
+    revenue_weight = (
+        columns["AVG_REVENUE_USD"] * 0.3
+        + columns["LAST_3_TRANSACTIONS_AVG_REVENUE_USD"] * 0.7
+    ) / 100
+    day_weight = 1 / (columns["DAYS_SINCE_LAST_TRANSACTION"] + 1)
+    product = product_weight * revenue_weight * day_weight
+    return np.minimum(0.9, 1000 * product)
+
+
+def feature_columns(batch: MemberFeaturesBatch) -> dict:
+    return {name: np.asarray(values, dtype=np.float64) for name, values in batch}
+
+
+#Scores N feature rows sent as columns in one call
+def predict_batch(batch: MemberFeaturesBatch) -> dict:
+    columns = feature_columns(batch)
+    return {
+        "ats": predict_ats_batch(columns).tolist(),
+        "resp": predict_resp_batch(columns).tolist()
+    }
+
+
+def model_version() -> dict:
+    return {"version": MODEL_VERSION}
+
+
 app = BaseApplication()
 app.add_api_route("/ml/ats/predict", predict_ats, methods=["POST"])
 app.add_api_route("/ml/resp/predict", predict_resp, methods=["POST"])
+app.add_api_route("/ml/predict", predict, methods=["POST"])
+app.add_api_route("/ml/batch/predict", predict_batch, methods=["POST"])
+app.add_api_route("/ml/version", model_version, methods=["GET"])
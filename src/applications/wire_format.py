@@ -0,0 +1,160 @@
+import json
+import inspect
+import functools
+import contextvars
+import numpy as np
+from pydantic import BaseModel
+from fastapi import Request, Response
+from fastapi.routing import APIRoute
+from typing import Any, Callable, Optional, Tuple
+from src.observability.profiling import span
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+#Encoding of the calls between the applications. JSON stays the default for every client, an internal caller that
+#sends "Accept: application/msgpack" gets msgpack back and may send msgpack bodies with that content type.
+#JSON is encoded with orjson when it is installed, both fall back to the standard json module
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+
+#Format of the response being rendered, set per request from its Accept header
+response_format: contextvars.ContextVar[str] = contextvars.ContextVar("response_format", default=JSON)
+
+
+#Types neither encoder knows natively: models returned as is and numpy values from the vectorized predictions
+def default(value: Any):
+    if isinstance(value, BaseModel):
+        return value.model_dump()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f"Object of type {type(value).__name__} is not serializable")
+
+
+def dumps(data: Any, fmt: str = JSON) -> bytes:
+    if fmt == MSGPACK and msgpack is not None:
+        return msgpack.packb(data, default=default)
+    if orjson is not None:
+        return orjson.dumps(data, default=default, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, default=default, separators=(",", ":")).encode()
+
+
+def loads(body: bytes, content_type: Optional[str] = None) -> Any:
+    if content_type and content_type.startswith(MSGPACK):
+        if msgpack is None:
+            raise ValueError("msgpack is not installed")
+        return msgpack.unpackb(body)
+    return orjson.loads(body) if orjson is not None else json.loads(body)
+
+
+#Formats this process can answer with
+def supported(fmt: str) -> bool:
+    return fmt == JSON or (fmt == MSGPACK and msgpack is not None)
+
+
+#Response class of the applications: JSON or msgpack depending on what the request accepted
+class FastResponse(Response):
+    media_type = JSON
+
+    def render(self, content: Any) -> bytes:
+        fmt = response_format.get()
+        #render runs before the headers are built, so the content type follows the format actually used
+        self.media_type = fmt
+        with span("serialization"):
+            return dumps(content, fmt)
+
+
+#A msgpack body is decoded by request.json(), FastAPI then validates it exactly like a JSON one
+class WireRequest(Request):
+
+    async def json(self) -> Any:
+        if not hasattr(self, "_json"):
+            body = await self.body()
+            try:
+                with span("decode"):
+                    self._json = loads(body, self.scope.get("wire_content_type"))
+            except ValueError as e:
+                raise json.JSONDecodeError(str(e), body.decode("latin-1"), 0)
+        return self._json
+
+
+#Route class of the applications: negotiates the response format and accepts msgpack bodies.
+#The endpoint's own time is a span of the request trace, the rest of the handler is validation and encoding
+class WireRoute(APIRoute):
+
+    def __init__(self, path: str, endpoint: Callable, **kwargs):
+        super().__init__(path, traced(endpoint), **kwargs)
+
+    def get_route_handler(self) -> Callable:
+        handler = super().get_route_handler()
+
+        async def wire_handler(request: Request) -> Response:
+            accept = request.headers.get("accept", "")
+            token = response_format.set(MSGPACK if MSGPACK in accept and supported(MSGPACK) else JSON)
+            try:
+                return await handler(wire_request(request))
+            finally:
+                response_format.reset(token)
+
+        return wire_handler
+
+
+def traced(endpoint: Callable) -> Callable:
+    if inspect.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def async_wrapper(*args, **kwargs):
+            with span("endpoint"):
+                return await endpoint(*args, **kwargs)
+        return async_wrapper
+
+    @functools.wraps(endpoint)
+    def wrapper(*args, **kwargs):
+        with span("endpoint"):
+            return endpoint(*args, **kwargs)
+    return wrapper
+
+
+def wire_request(request: Request) -> Request:
+    content_type = request.headers.get("content-type", "")
+    scope = request.scope
+    if content_type.startswith(MSGPACK):
+        #FastAPI only parses application/json bodies, the original type is kept for the decoder
+        headers = [(k, v) for k, v in scope["headers"] if k != b"content-type"] + [(b"content-type", JSON.encode())]
+        scope = dict(scope, headers=headers, wire_content_type=content_type)
+    return WireRequest(scope, request.receive)
+
+
+#Content type the caller sent, the route may have relabelled a msgpack body for FastAPI
+def request_content_type(request: Request) -> str:
+    return request.scope.get("wire_content_type") or request.headers.get("content-type", JSON)
+
+
+#Endpoints whose data is built by the application itself: the result is rendered as it is, without the response
+#model validating and copying every object again. Register them with response_model=None
+def trusted(endpoint: Callable) -> Callable:
+    @functools.wraps(endpoint)
+    def wrapper(*args, **kwargs):
+        return FastResponse(endpoint(*args, **kwargs))
+    return wrapper
+
+
+#Client side: request arguments for a body in the given format, and the decoded body of a response
+def encode(data: Any, fmt: str = JSON) -> Tuple[bytes, dict]:
+    return dumps(data, fmt), {"content-type": fmt, "accept": fmt}
+
+
+def decode(response) -> Any:
+    content_type = response.headers.get("content-type", "")
+    if isinstance(content_type, str) and content_type.startswith(MSGPACK):
+        return loads(response.content, content_type)
+    return response.json()
@@ -0,0 +1,35 @@
+from src.models.member_aggregate import MemberAggregate
+from src.models.member_features import MemberFeatures
+from src.features.engine import FeatureStats, LAST_N_TRANSACTIONS, member_features
+
+
+#Running per-member aggregate shared by member_data, the perk app and the offline backfill, so that all of them fold
+#transactions by the same rules
+
+
+#Folds one transaction into a member's running aggregate in O(1), the last-N buffer never grows past LAST_N_TRANSACTIONS
+def apply_member_transaction(aggregate: MemberAggregate, points: float, revenue: float, transaction_type: str, ts: int):
+    aggregate.transactionCount += 1
+    aggregate.totalPointsBought += points
+    aggregate.totalRevenueUsd += revenue
+    aggregate.transactionTypeCounts[transaction_type] = aggregate.transactionTypeCounts.get(transaction_type, 0) + 1
+
+    aggregate.last3PointsBought.append(points)
+    aggregate.last3RevenueUsd.append(revenue)
+    if len(aggregate.last3PointsBought) > LAST_N_TRANSACTIONS:
+        aggregate.last3PointsBought.pop(0)
+        aggregate.last3RevenueUsd.pop(0)
+
+    aggregate.lastTransactionTs = ts
+    return aggregate
+
+
+#The feature engine's core features computed from the aggregate alone, in O(1)
+def member_aggregate_features(aggregate: MemberAggregate) -> MemberFeatures:
+    return member_features(aggregate_stats(aggregate))
+
+
+def aggregate_stats(aggregate: MemberAggregate) -> FeatureStats:
+    return FeatureStats(aggregate.transactionCount, aggregate.totalPointsBought, aggregate.totalRevenueUsd,
+                        aggregate.transactionTypeCounts, aggregate.last3PointsBought, aggregate.last3RevenueUsd,
+                        aggregate.lastTransactionTs)
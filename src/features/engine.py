@@ -0,0 +1,235 @@
+import calendar
+from collections import deque
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from src.models.member_features import MemberFeatures
+from src.storage.member_store import parse_timestamp
+
+
+LAST_N_TRANSACTIONS = 3
+SECONDS_PER_DAY = 86400
+
+
+#Current local wall clock as epoch seconds, the same clock the features have always used (datetime.now())
+def now_epoch() -> int:
+    return calendar.timegm(datetime.now().timetuple())
+
+
+def to_epoch(ts) -> int:
+    return ts if isinstance(ts, int) else parse_timestamp(ts)
+
+
+def days_since(ts: int, now: int) -> int:
+    return (now - ts) // SECONDS_PER_DAY
+
+
+#Everything a feature can be computed from. The core statistics are always there, extra holds the final state of
+#the accumulators that registered features asked for
+class FeatureStats:
+
+    def __init__(self, count: int, sum_points: float, sum_revenue: float, type_counts: Dict[str, int],
+                 last_points: List[float], last_revenue: List[float], last_ts: int, extra: Optional[Dict[str, Any]] = None):
+        self.count = count
+        self.sum_points = sum_points
+        self.sum_revenue = sum_revenue
+        self.type_counts = type_counts
+        self.last_points = last_points
+        self.last_revenue = last_revenue
+        self.last_ts = last_ts
+        self.extra = extra or {}
+
+
+#Per-row state for features the core statistics cannot express. Accumulators are updated in the kernel's single pass,
+#two features asking for the same key share one accumulator
+class Accumulator:
+    key = ""
+
+    def start(self, now: int):
+        raise NotImplementedError
+
+    def update(self, state, points: float, revenue: float, transaction_type: str, ts: int):
+        raise NotImplementedError
+
+
+#Sum and count of points or revenue over the last `days` days up to now, later transactions are not counted
+class WindowSum(Accumulator):
+
+    def __init__(self, column: str, days: int):
+        self.column = column
+        self.days = days
+        self.key = f"window:{column}:{days}"
+
+    def start(self, now: int):
+        return {"since": now - self.days * SECONDS_PER_DAY, "until": now, "sum": 0.0, "count": 0}
+
+    def update(self, state, points, revenue, transaction_type, ts):
+        if state["since"] <= ts <= state["until"]:
+            state["sum"] += points if self.column == "points" else revenue
+            state["count"] += 1
+
+
+#Sum of points or revenue where each transaction weighs 0.5 ** (age in days / half_life_days)
+class DecayedSum(Accumulator):
+
+    def __init__(self, column: str, half_life_days: float):
+        self.column = column
+        self.half_life = half_life_days * SECONDS_PER_DAY
+        self.key = f"decay:{column}:{half_life_days}"
+
+    def start(self, now: int):
+        return {"now": now, "sum": 0.0}
+
+    def update(self, state, points, revenue, transaction_type, ts):
+        value = points if self.column == "points" else revenue
+        state["sum"] += value * 0.5 ** ((state["now"] - ts) / self.half_life)
+
+
+class Feature:
+
+    def __init__(self, name: str, compute: Callable[[FeatureStats, int], Any], accumulators: Tuple[Accumulator, ...], core: bool):
+        self.name = name
+        self.compute = compute
+        self.accumulators = accumulators
+        self.core = core
+
+
+#Declarative feature registry. Core features make up MemberFeatures and only use the core statistics, so they can be
+#computed from a running aggregate in O(1). Other features may add accumulators, updated in the same single pass
+class FeatureRegistry:
+
+    def __init__(self):
+        self.features: Dict[str, Feature] = {}
+
+    def register(self, name: str, compute: Callable[[FeatureStats, int], Any], accumulators: Tuple[Accumulator, ...] = (), core: bool = False):
+        if core and accumulators:
+            raise ValueError(f"Core feature {name} can only use the core statistics")
+        self.features[name] = Feature(name, compute, tuple(accumulators), core)
+
+    #Decorator form of register
+    def feature(self, name: str, *accumulators: Accumulator, core: bool = False):
+        def decorator(compute):
+            self.register(name, compute, accumulators, core)
+            return compute
+        return decorator
+
+    #Distinct accumulators needed by the given features (all of them by default)
+    def accumulators(self, names: Optional[Iterable[str]] = None) -> List[Accumulator]:
+        features = self.features.values() if names is None else [self.features[n] for n in names]
+        return list({acc.key: acc for f in features for acc in f.accumulators}.values())
+
+
+registry = FeatureRegistry()
+feature = registry.feature
+
+
+#Single pass over a member's history. rows yields (points, revenue, transaction type, timestamp) oldest first,
+#timestamps may be epoch seconds or strings: strings are only parsed when an accumulator needs them, and for the last row
+def compute_stats(rows: Iterable[Tuple[float, float, str, Any]], accumulators: List[Accumulator] = (), now: Optional[int] = None) -> FeatureStats:
+    now = now_epoch() if now is None else now
+    count, sum_points, sum_revenue = 0, 0, 0
+    type_counts: Dict[str, int] = {}
+    last_points = deque(maxlen=LAST_N_TRANSACTIONS)
+    last_revenue = deque(maxlen=LAST_N_TRANSACTIONS)
+    last_ts = None
+    states = [(acc, acc.start(now)) for acc in accumulators]
+
+    for points, revenue, transaction_type, ts in rows:
+        count += 1
+        sum_points += points
+        sum_revenue += revenue
+        type_counts[transaction_type] = type_counts.get(transaction_type, 0) + 1
+        last_points.append(points)
+        last_revenue.append(revenue)
+        last_ts = ts
+        if states:
+            ts = to_epoch(ts)
+            for acc, state in states:
+                acc.update(state, points, revenue, transaction_type, ts)
+
+    return FeatureStats(count, sum_points, sum_revenue, type_counts, list(last_points), list(last_revenue),
+                        to_epoch(last_ts) if last_ts is not None else None, {acc.key: state for acc, state in states})
+
+
+#Features by name. Features whose accumulators are missing from stats (e.g. stats of a running aggregate) are skipped
+def compute_features(stats: FeatureStats, now: Optional[int] = None, names: Optional[Iterable[str]] = None) -> Dict[str, Any]:
+    now = now_epoch() if now is None else now
+    features = registry.features.values() if names is None else [registry.features[n] for n in names]
+    return {
+        f.name: f.compute(stats, now)
+        for f in features
+        if all(acc.key in stats.extra for acc in f.accumulators)
+    }
+
+
+def member_features(stats: FeatureStats, now: Optional[int] = None) -> MemberFeatures:
+    now = now_epoch() if now is None else now
+    return MemberFeatures(**{f.name: f.compute(stats, now) for f in registry.features.values() if f.core})
+
+
+#Core features, the MemberFeatures fields
+
+@feature("AVG_POINTS_BOUGHT", core=True)
+def avg_points_bought(stats, now):
+    return stats.sum_points / stats.count
+
+
+@feature("AVG_REVENUE_USD", core=True)
+def avg_revenue_usd(stats, now):
+    return stats.sum_revenue / stats.count
+
+
+@feature("LAST_3_TRANSACTIONS_AVG_POINTS_BOUGHT", core=True)
+def last_3_avg_points_bought(stats, now):
+    return sum(stats.last_points) / len(stats.last_points)
+
+
+@feature("LAST_3_TRANSACTIONS_AVG_REVENUE_USD", core=True)
+def last_3_avg_revenue_usd(stats, now):
+    return sum(stats.last_revenue) / len(stats.last_revenue)
+
+
+@feature("PCT_BUY_TRANSACTIONS", core=True)
+def pct_buy_transactions(stats, now):
+    return stats.type_counts.get("buy", 0) / stats.count
+
+
+@feature("PCT_GIFT_TRANSACTIONS", core=True)
+def pct_gift_transactions(stats, now):
+    return stats.type_counts.get("gift", 0) / stats.count
+
+
+@feature("PCT_REDEEM_TRANSACTIONS", core=True)
+def pct_redeem_transactions(stats, now):
+    return stats.type_counts.get("redeem", 0) / stats.count
+
+
+@feature("DAYS_SINCE_LAST_TRANSACTION", core=True)
+def days_since_last_transaction(stats, now):
+    return days_since(stats.last_ts, now)
+
+
+#Windowed and recency features, computed from a member's history
+
+def window_average(column: str, days: int):
+    def compute(stats, now):
+        window = stats.extra[f"window:{column}:{days}"]
+        return window["sum"] / window["count"] if window["count"] else 0.0
+    return compute
+
+
+def window_count(column: str, days: int):
+    def compute(stats, now):
+        return stats.extra[f"window:{column}:{days}"]["count"]
+    return compute
+
+
+for days in (7, 30, 90):
+    registry.register(f"AVG_POINTS_BOUGHT_{days}D", window_average("points", days), (WindowSum("points", days),))
+    registry.register(f"AVG_REVENUE_USD_{days}D", window_average("revenue", days), (WindowSum("revenue", days),))
+    registry.register(f"TRANSACTIONS_{days}D", window_count("points", days), (WindowSum("points", days),))
+
+
+@feature("RECENCY_WEIGHTED_POINTS_BOUGHT", DecayedSum("points", 30))
+def recency_weighted_points_bought(stats, now):
+    return stats.extra["decay:points:30"]["sum"]
@@ -0,0 +1,13 @@
+from pydantic import BaseModel
+from typing import Dict, List
+
+
+class MemberAggregate(BaseModel):
+    transactionCount: int = 0
+    totalPointsBought: float = 0
+    totalRevenueUsd: float = 0
+    transactionTypeCounts: Dict[str, int] = {}
+    last3PointsBought: List[float] = []
+    last3RevenueUsd: List[float] = []
+    #Epoch seconds, parsed once when the transaction was stored
+    lastTransactionTs: int = 0
@@ -1,4 +1,5 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, model_validator
+from typing import List
 
 
 class MemberFeatures(BaseModel):
@@ -10,3 +11,25 @@ class MemberFeatures(BaseModel):
     PCT_GIFT_TRANSACTIONS: float
     PCT_REDEEM_TRANSACTIONS: float
     DAYS_SINCE_LAST_TRANSACTION: int
+
+
+#Columnar form of N MemberFeatures rows, one list per feature
+class MemberFeaturesBatch(BaseModel):
+    AVG_POINTS_BOUGHT: List[float]
+    AVG_REVENUE_USD: List[float]
+    LAST_3_TRANSACTIONS_AVG_POINTS_BOUGHT: List[float]
+    LAST_3_TRANSACTIONS_AVG_REVENUE_USD: List[float]
+    PCT_BUY_TRANSACTIONS: List[float]
+    PCT_GIFT_TRANSACTIONS: List[float]
+    PCT_REDEEM_TRANSACTIONS: List[float]
+    DAYS_SINCE_LAST_TRANSACTION: List[int]
+
+    @model_validator(mode="after")
+    def check_same_length(self):
+        if len({len(column) for column in self.__dict__.values()}) > 1:
+            raise ValueError("All feature columns must have the same length")
+        return self
+
+    @classmethod
+    def from_rows(cls, rows: List[MemberFeatures]):
+        return cls(**{name: [getattr(row, name) for row in rows] for name in MemberFeatures.model_fields})
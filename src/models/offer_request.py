@@ -1,5 +1,12 @@
 from pydantic import BaseModel
+from typing import List
 
 class OfferRequest(BaseModel):
     ats_prediction: float
-    resp_prediction: float
\ No newline at end of file
+    resp_prediction: float
+
+
+#Columnar form of N OfferRequest objects
+class OfferRequestBatch(BaseModel):
+    ats_predictions: List[float]
+    resp_predictions: List[float]
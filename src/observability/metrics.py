@@ -0,0 +1,230 @@
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
+
+
+#Latency buckets in seconds, fixed so that an observation is one bisect and two additions
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+#Base of the three metric types. A metric without label names is its own single child, a metric with label names
+#hands out one child per label values through labels(). Metrics are updated from the event loop, without locks
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.children: Dict[Tuple[str, ...], "Metric"] = {}
+
+    def labels(self, *values) -> "Metric":
+        values = tuple(str(v) for v in values)
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self.child()
+        return child
+
+    def child(self) -> "Metric":
+        raise NotImplementedError
+
+    def samples(self) -> List[Tuple[Tuple[str, ...], "Metric"]]:
+        return list(self.children.items()) if self.labelnames else [((), self)]
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in self.samples():
+            lines.extend(child.render_sample(self.name, self.labelnames, values))
+        return lines
+
+
+#A counter is either incremented by the code or, with set_function, read when the metrics are rendered from a count
+#that an object keeps itself and that only ever grows
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str = "", help: str = "", labelnames: Iterable[str] = ()):
+        super().__init__(name, help, labelnames)
+        self.value = 0.0
+        self.function: Optional[Callable[[], float]] = None
+
+    def child(self):
+        return Counter()
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def set_function(self, function: Callable[[], float]):
+        self.function = function
+
+    def render_sample(self, name, labelnames, values):
+        value = self.function() if self.function is not None else self.value
+        return [f"{name}{format_labels(labelnames, values)} {format_value(value)}"]
+
+
+#A gauge is either set by the code or, with set_function, read when the metrics are rendered
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str = "", help: str = "", labelnames: Iterable[str] = ()):
+        super().__init__(name, help, labelnames)
+        self.value = 0.0
+        self.function: Optional[Callable[[], float]] = None
+
+    def child(self):
+        return Gauge()
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+    def set_function(self, function: Callable[[], float]):
+        self.function = function
+
+    def render_sample(self, name, labelnames, values):
+        value = self.function() if self.function is not None else self.value
+        return [f"{name}{format_labels(labelnames, values)} {format_value(value)}"]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str = "", help: str = "", labelnames: Iterable[str] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        #Per bucket counts, the last one is +Inf. They are made cumulative when rendered
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def child(self):
+        return Histogram(buckets=self.buckets)
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    #Estimated quantile, interpolated linearly inside the bucket it falls in
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+    def render_sample(self, name, labelnames, values):
+        lines = []
+        cumulative = 0
+        for bound, count in zip((*self.buckets, "+Inf"), self.counts):
+            cumulative += count
+            le = 'le="' + (bound if bound == "+Inf" else format_value(bound)) + '"'
+            lines.append(f"{name}_bucket{format_labels(labelnames, values, le)} {cumulative}")
+        lines.append(f"{name}_sum{format_labels(labelnames, values)} {format_value(self.sum)}")
+        lines.append(f"{name}_count{format_labels(labelnames, values)} {self.count}")
+        return lines
+
+
+#Metrics of one application, rendered in the Prometheus text format
+class MetricsRegistry:
+
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self.register(Counter(name, help, labelnames))
+
+    def gauge(self, name: str, help: str, labelnames: Iterable[str] = ()) -> Gauge:
+        return self.register(Gauge(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: Iterable[str] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def render(self) -> str:
+        return "\n".join(line for metric in self.metrics.values() for line in metric.render()) + "\n"
+
+
+#ASGI middleware counting requests, errors, in-flight requests and their latency per route.
+#Plain ASGI rather than a FastAPI http middleware, which would wrap every request and response in extra tasks
+class RequestMetrics:
+
+    def __init__(self, app, requests_total: Counter, errors_total: Counter, in_flight: Gauge, latency: Histogram):
+        self.app = app
+        self.requests_total = requests_total
+        self.errors_total = errors_total
+        self.in_flight = in_flight
+        self.latency = latency
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status = 500
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        self.in_flight.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            self.in_flight.dec()
+            route = scope.get("route")
+            route = route.path if route is not None else "unmatched"
+            if route != "/metrics":
+                method = scope["method"]
+                self.latency.labels(method, route).observe(time.perf_counter() - start)
+                self.requests_total.labels(method, route, status).inc()
+                if status >= 500:
+                    self.errors_total.labels(method, route).inc()
+
+
+#Adds GET /metrics and the request metrics middleware to an application
+def instrument(app: FastAPI, registry: MetricsRegistry):
+    app.add_middleware(
+        RequestMetrics,
+        requests_total=registry.counter("http_requests_total", "Requests handled", ("method", "route", "status")),
+        errors_total=registry.counter("http_request_errors_total", "Requests that failed with a 5xx or an exception", ("method", "route")),
+        in_flight=registry.gauge("http_requests_in_flight", "Requests being handled"),
+        latency=registry.histogram("http_request_duration_seconds", "Request latency", ("method", "route"))
+    )
+
+    def metrics():
+        return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+    app.add_api_route("/metrics", metrics, methods=["GET"], include_in_schema=False)
@@ -0,0 +1,207 @@
+import os
+import sys
+import time
+import asyncio
+import threading
+import contextvars
+from collections import Counter as Counts, deque
+from contextlib import contextmanager
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import PlainTextResponse
+from typing import Dict, List, Optional
+
+from src.observability.metrics import MetricsRegistry, Histogram
+
+
+#Diagnostics served under /admin by every application, to look into a slowdown without restarting it:
+#a sampling profiler producing collapsed stacks, the stage breakdown of the slowest requests and the event loop lag
+
+#Spans of the request being handled, None outside a request
+current_trace: contextvars.ContextVar[Optional[list]] = contextvars.ContextVar("current_trace", default=None)
+
+
+def record_span(name: str, seconds: float):
+    trace = current_trace.get()
+    if trace is not None:
+        trace.append((name, seconds))
+
+
+@contextmanager
+def span(name: str):
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.append((name, time.perf_counter() - start))
+
+
+#Samples the stacks of every thread but its own every `interval` seconds. Stacks are counted in the collapsed format
+#(root first, frames separated by ';'), which flamegraph.pl and speedscope read as is
+class SamplingProfiler:
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.stacks: Counts = Counts()
+        self.samples = 0
+        self.stopping = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="sampling-profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+
+    def run(self):
+        own = threading.get_ident()
+        while not self.stopping.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    self.stacks[self.collapse(names.get(ident, str(ident)), frame)] += 1
+            self.samples += 1
+
+    @staticmethod
+    def collapse(thread_name: str, frame) -> str:
+        frames = []
+        while frame is not None:
+            code = frame.f_code
+            frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        frames.append(thread_name)
+        return ";".join(reversed(frames))
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+#The last `size` requests slower than threshold seconds, with the spans recorded while they were handled
+class SlowRequestLog:
+
+    def __init__(self, threshold: float = 0.5, size: int = 100):
+        self.threshold = threshold
+        self.requests = deque(maxlen=size)
+
+    def add(self, method: str, path: str, status: int, started_at: float, duration: float, trace: list):
+        self.requests.append({
+            "method": method, "path": path, "status": status, "started_at": started_at,
+            "duration_ms": round(duration * 1000, 3),
+            "spans": [{"name": name, "ms": round(seconds * 1000, 3)} for name, seconds in trace]
+        })
+
+
+#ASGI middleware giving every request a trace, kept when the request is slower than the log's threshold
+class SlowRequestTracer:
+
+    def __init__(self, app, log: SlowRequestLog, lag: "LoopLagMonitor"):
+        self.app = app
+        self.log = log
+        self.lag = lag
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        self.lag.ensure_running()
+        if scope["path"].startswith("/admin/") or scope["path"] == "/metrics":
+            return await self.app(scope, receive, send)
+
+        status = 500
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        trace = []
+        token = current_trace.set(trace)
+        started_at, start = time.time(), time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            current_trace.reset(token)
+            duration = time.perf_counter() - start
+            if duration >= self.log.threshold:
+                self.log.add(scope["method"], scope["path"], status, started_at, duration, trace)
+
+
+#Measures how late the event loop wakes up a task sleeping for `interval` seconds, i.e. how long callbacks waited
+#behind code holding the loop. Started with the first request of the loop
+class LoopLagMonitor:
+
+    def __init__(self, histogram: Histogram, interval: float = 0.1):
+        self.histogram = histogram
+        self.interval = interval
+        self.task: Optional[asyncio.Task] = None
+        self.last = 0.0
+        self.max = 0.0
+
+    def ensure_running(self):
+        loop = asyncio.get_running_loop()
+        if self.task is None or self.task.done() or self.task.get_loop() is not loop:
+            self.task = loop.create_task(self.run())
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.last = max(0.0, loop.time() - start - self.interval)
+            self.max = max(self.max, self.last)
+            self.histogram.observe(self.last)
+
+    def report(self) -> Dict[str, Optional[float]]:
+        ms = lambda seconds: round(seconds * 1000, 3) if seconds is not None else None
+        return {"interval_ms": ms(self.interval), "last_ms": ms(self.last), "max_ms": ms(self.max),
+                "p50_ms": ms(self.histogram.quantile(0.5)), "p99_ms": ms(self.histogram.quantile(0.99))}
+
+
+#Adds the diagnostics routes and the slow request middleware to an application:
+#GET /admin/profile?seconds=10&interval_ms=5 samples for that long and returns the collapsed stacks,
+#GET /admin/slow_requests lists the slowest requests, POST changes the threshold and/or clears the list,
+#GET /admin/loop_lag reports the event loop lag
+def add_diagnostics(app: FastAPI, registry: MetricsRegistry):
+    slow_requests = SlowRequestLog(float(os.getenv("SLOW_REQUEST_THRESHOLD_MS", "500")) / 1000,
+                                   int(os.getenv("SLOW_REQUEST_BUFFER", "100")))
+    lag = LoopLagMonitor(registry.histogram("event_loop_lag_seconds", "Delay of the event loop in waking up a sleeping task",
+                                            buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)),
+                         float(os.getenv("LOOP_LAG_INTERVAL", "0.1")))
+    max_seconds = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+    running: List[SamplingProfiler] = []
+    app.add_middleware(SlowRequestTracer, log=slow_requests, lag=lag)
+
+    async def profile(seconds: float = 10, interval_ms: float = 5):
+        if not 0 < seconds <= max_seconds or interval_ms < 1:
+            raise HTTPException(status_code=422, detail=f"seconds must be in (0, {max_seconds}] and interval_ms at least 1")
+        if running:
+            raise HTTPException(status_code=409, detail="A profile is already being taken")
+        profiler = SamplingProfiler(interval_ms / 1000)
+        running.append(profiler)
+        profiler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            await asyncio.to_thread(profiler.stop)
+            running.remove(profiler)
+        return PlainTextResponse(profiler.collapsed(), headers={"x-profile-samples": str(profiler.samples)})
+
+    def get_slow_requests():
+        return {"threshold_ms": slow_requests.threshold * 1000, "requests": list(slow_requests.requests)}
+
+    def set_slow_requests(threshold_ms: Optional[float] = None, clear: bool = False):
+        if threshold_ms is not None:
+            slow_requests.threshold = threshold_ms / 1000
+        if clear:
+            slow_requests.requests.clear()
+        return get_slow_requests()
+
+    app.add_api_route("/admin/profile", profile, methods=["GET"], include_in_schema=False)
+    app.add_api_route("/admin/slow_requests", get_slow_requests, methods=["GET"], include_in_schema=False)
+    app.add_api_route("/admin/slow_requests", set_slow_requests, methods=["POST"], include_in_schema=False)
+    app.add_api_route("/admin/loop_lag", lag.report, methods=["GET"], include_in_schema=False)
+    return slow_requests, lag
@@ -0,0 +1,410 @@
+import os
+import json
+import time
+import shutil
+import struct
+import logging
+import calendar
+import threading
+import numpy as np
+
+from typing import Dict, List, Optional, Tuple
+
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+#Log record layout: memberId length, memberId, epoch timestamp, points, revenue, type length, type
+RECORD_HEAD = struct.Struct("<H")
+RECORD_BODY = struct.Struct("<qddH")
+
+COLUMNS = {"points": np.float64, "revenue": np.float64, "ts": np.int64, "types": np.uint16}
+
+
+def parse_timestamp(utc_ts: str) -> int:
+    return calendar.timegm(time.strptime(utc_ts, TIMESTAMP_FORMAT))
+
+
+def format_timestamp(epoch: int) -> str:
+    return time.strftime(TIMESTAMP_FORMAT, time.gmtime(epoch))
+
+
+#Writes a file and fsyncs it, it is on disk before anything relies on it
+def write_durably(path: str, write):
+    with open(path, "wb") as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+#Makes the creation, rename or removal of the entries of a directory durable
+def fsync_directory(path: str):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+#Columnar history of a single member. Arrays grow by doubling, so appends are amortized O(1).
+#Members loaded from a snapshot start as read-only views of the memory mapped columns and are copied on their first append
+class MemberColumns:
+
+    def __init__(self, arrays: Optional[Dict[str, np.ndarray]] = None):
+        if arrays is None:
+            arrays = {name: np.empty(4, dtype=dtype) for name, dtype in COLUMNS.items()}
+            self.length = 0
+        else:
+            self.length = len(arrays["ts"])
+        self.arrays = arrays
+        self.index: Optional[TimeIndex] = None
+
+    #Built on the first time query and kept up to date by appends from then on
+    def time_index(self) -> "TimeIndex":
+        if self.index is None:
+            self.index = TimeIndex(self)
+        return self.index
+
+    def append(self, points: float, revenue: float, ts: int, type_code: int):
+        if self.length == len(self.arrays["ts"]):
+            capacity = max(4, self.length * 2)
+            for name in COLUMNS:
+                grown = np.empty(capacity, dtype=COLUMNS[name])
+                grown[:self.length] = self.arrays[name][:self.length]
+                self.arrays[name] = grown
+        i = self.length
+        self.arrays["points"][i] = points
+        self.arrays["revenue"][i] = revenue
+        self.arrays["ts"][i] = ts
+        self.arrays["types"][i] = type_code
+        self.length += 1
+        #A transaction older than the latest one reorders the index, it is rebuilt on the next time query
+        if self.index is not None and not self.index.append(points, revenue, ts):
+            self.index = None
+
+    def __len__(self):
+        return self.length
+
+    @property
+    def points(self) -> np.ndarray:
+        return self.arrays["points"][:self.length]
+
+    @property
+    def revenue(self) -> np.ndarray:
+        return self.arrays["revenue"][:self.length]
+
+    @property
+    def ts(self) -> np.ndarray:
+        return self.arrays["ts"][:self.length]
+
+    @property
+    def types(self) -> np.ndarray:
+        return self.arrays["types"][:self.length]
+
+
+#A member's timestamps in ascending order with prefix sums of points and revenue in that order: the count and totals
+#of any time range are two binary searches away, whatever the length of the history. order maps index positions to
+#column rows, it is None when the transactions arrived in timestamp order (the usual case) and positions are rows
+class TimeIndex:
+
+    def __init__(self, columns: MemberColumns):
+        ts = columns.ts
+        self.length = len(ts)
+        in_order = self.length < 2 or bool(np.all(ts[1:] >= ts[:-1]))
+        self.order = None if in_order else np.argsort(ts, kind="stable")
+        rows = slice(None) if in_order else self.order
+        capacity = max(4, self.length)
+        self.ts = np.empty(capacity, dtype=np.int64)
+        self.ts[:self.length] = ts[rows]
+        self.cum_points = np.zeros(capacity + 1, dtype=np.float64)
+        self.cum_revenue = np.zeros(capacity + 1, dtype=np.float64)
+        np.cumsum(columns.points[rows], out=self.cum_points[1:self.length + 1])
+        np.cumsum(columns.revenue[rows], out=self.cum_revenue[1:self.length + 1])
+
+    #Amortized O(1) for a transaction not older than the latest one, False when the index has to be rebuilt
+    def append(self, points: float, revenue: float, ts: int) -> bool:
+        if self.order is not None or (self.length and ts < self.ts[self.length - 1]):
+            return False
+        if self.length == len(self.ts):
+            capacity = self.length * 2
+            self.ts = np.concatenate([self.ts, np.empty(capacity - self.length, dtype=np.int64)])
+            self.cum_points = np.concatenate([self.cum_points, np.zeros(capacity - self.length)])
+            self.cum_revenue = np.concatenate([self.cum_revenue, np.zeros(capacity - self.length)])
+        n = self.length
+        self.ts[n] = ts
+        self.cum_points[n + 1] = self.cum_points[n] + points
+        self.cum_revenue[n + 1] = self.cum_revenue[n] + revenue
+        self.length += 1
+        return True
+
+    #Index positions [lo, hi) of the transactions with since <= ts <= until, either bound may be open
+    def positions(self, since: Optional[int] = None, until: Optional[int] = None) -> Tuple[int, int]:
+        ts = self.ts[:self.length]
+        lo = 0 if since is None else int(np.searchsorted(ts, since, "left"))
+        hi = self.length if until is None else int(np.searchsorted(ts, until, "right"))
+        return lo, max(lo, hi)
+
+    #Count, points and revenue of a time range in O(log n)
+    def totals(self, since: Optional[int] = None, until: Optional[int] = None) -> Tuple[int, float, float]:
+        lo, hi = self.positions(since, until)
+        return (hi - lo, float(self.cum_points[hi] - self.cum_points[lo]),
+                float(self.cum_revenue[hi] - self.cum_revenue[lo]))
+
+    def rows(self, lo: int, hi: int):
+        return slice(lo, hi) if self.order is None else self.order[lo:hi]
+
+
+#Per-member columnar transaction store.
+#With a directory, every append also goes to an append-only log segment (wal-<gen>.log). Every snapshot_every appends,
+#and on close, the columns are written as a snapshot (snapshot-<gen>/) covering all segments up to <gen>, which a restart
+#memory maps instead of replaying the whole history. Only the segments written after the snapshot are replayed.
+#The periodic snapshots are written by a background thread: the append only copies the columns under the lock, reads
+#and writes go on while the copy is written. The segments it covers are removed once it is durably on disk
+class MemberStore:
+
+    def __init__(self, directory: Optional[str] = None, snapshot_every: int = 100000, fsync: bool = False):
+        self.directory = directory
+        self.snapshot_every = snapshot_every
+        self.fsync = fsync
+
+        self.members: Dict[str, MemberColumns] = {}
+        self.type_codes: Dict[str, int] = {}
+        self.type_names: List[str] = []
+
+        self.snapshot_index: Dict[str, int] = {}
+        self.snapshot_columns: Dict[str, np.ndarray] = {}
+        self.snapshot_offsets = None
+
+        self.log = None
+        self.generation = 0
+        self.appends_since_snapshot = 0
+        self.snapshot_thread: Optional[threading.Thread] = None
+        #Sync routes run in a threadpool: appends, snapshots and reads of the columns hold this lock.
+        #Reentrant, an append may take a snapshot and callers may hold it around several calls
+        self.lock = threading.RLock()
+
+        if directory is not None:
+            self.open()
+
+    #Loads the latest complete snapshot, replays the newer log segments and starts a new segment
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        snapshots = self.generations("snapshot-")
+        snapshot_gen = -1
+        if snapshots:
+            snapshot_gen = snapshots[-1]
+            self.load_snapshot(snapshot_gen)
+
+        replayed = 0
+        for gen in self.generations("wal-"):
+            if gen > snapshot_gen:
+                replayed += self.replay(self.path(f"wal-{gen:08d}.log"))
+            self.generation = max(self.generation, gen)
+        self.generation = max(self.generation, snapshot_gen) + 1
+        self.appends_since_snapshot = replayed
+
+        self.log = open(self.path(f"wal-{self.generation:08d}.log"), "ab")
+        logging.info(f"Member store opened: {len(self)} members, {replayed} transactions replayed from the log")
+
+    def close(self):
+        with self.lock:
+            self.wait_for_snapshot()
+            if self.log is not None:
+                if self.appends_since_snapshot:
+                    self.snapshot()
+                self.log.close()
+                self.log = None
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    #Generations of the complete files or directories with the given prefix, ascending
+    def generations(self, prefix: str) -> List[int]:
+        found = []
+        for name in os.listdir(self.directory):
+            if not name.startswith(prefix) or name.endswith(".tmp"):
+                continue
+            if prefix == "snapshot-" and not os.path.exists(self.path(f"{name}/meta.json")):
+                continue
+            found.append(int(name[len(prefix):].split(".")[0]))
+        return sorted(found)
+
+    def type_code(self, transaction_type: str) -> int:
+        code = self.type_codes.get(transaction_type)
+        if code is None:
+            code = self.type_codes[transaction_type] = len(self.type_names)
+            self.type_names.append(transaction_type)
+        return code
+
+    #ts is in epoch seconds, see parse_timestamp
+    def append(self, member_id: str, ts: int, transaction_type: str, points: float, revenue: float):
+        with self.lock:
+            if self.log is not None:
+                member_bytes = member_id.encode()
+                type_bytes = transaction_type.encode()
+                self.log.write(RECORD_HEAD.pack(len(member_bytes)) + member_bytes
+                               + RECORD_BODY.pack(ts, points, revenue, len(type_bytes)) + type_bytes)
+                self.log.flush()
+                if self.fsync:
+                    os.fsync(self.log.fileno())
+            self.append_columns(member_id, ts, transaction_type, points, revenue)
+
+            if self.log is not None:
+                self.appends_since_snapshot += 1
+                if self.appends_since_snapshot >= self.snapshot_every and not self.snapshot_running():
+                    self.snapshot_in_background()
+
+    def append_columns(self, member_id: str, ts: int, transaction_type: str, points: float, revenue: float):
+        with self.lock:
+            columns = self.get(member_id)
+            if columns is None:
+                columns = self.members[member_id] = MemberColumns()
+            columns.append(points, revenue, ts, self.type_code(transaction_type))
+
+    def get(self, member_id: str) -> Optional[MemberColumns]:
+        with self.lock:
+            columns = self.members.get(member_id)
+            if columns is None and member_id in self.snapshot_index:
+                i = self.snapshot_index[member_id]
+                start, end = self.snapshot_offsets[i], self.snapshot_offsets[i + 1]
+                columns = self.members[member_id] = MemberColumns(
+                    {name: self.snapshot_columns[name][start:end] for name in COLUMNS})
+            return columns
+
+    def __contains__(self, member_id: str) -> bool:
+        return member_id in self.members or member_id in self.snapshot_index
+
+    def __len__(self) -> int:
+        return len(self.member_ids())
+
+    def member_ids(self) -> List[str]:
+        with self.lock:
+            return list(dict.fromkeys([*self.snapshot_index, *self.members]))
+
+    #A member's history as MemberData shaped dicts, in insertion order. With a time range or a limit, the transactions
+    #with since <= ts <= until in timestamp order, only the latest `limit` of them, found by binary search
+    def history(self, member_id: str, since: Optional[int] = None, until: Optional[int] = None,
+                limit: Optional[int] = None) -> Optional[List[dict]]:
+        #The rows are copied under the lock, formatting them does not hold up the appends
+        with self.lock:
+            columns = self.get(member_id)
+            if columns is None:
+                return None
+            rows = slice(None)
+            if since is not None or until is not None or limit is not None:
+                index = columns.time_index()
+                lo, hi = index.positions(since, until)
+                if limit is not None:
+                    lo = max(lo, hi - limit)
+                rows = index.rows(lo, hi)
+            values = zip(columns.ts[rows].tolist(), columns.types[rows].tolist(),
+                         columns.points[rows].tolist(), columns.revenue[rows].tolist())
+        type_names = self.type_names
+        return [
+            {"memberId": member_id, "lastTransactionUtcTs": format_timestamp(ts), "lastTransactionType": type_names[t],
+             "lastTransactionPointsBought": points, "lastTransactionRevenueUsd": revenue}
+            for ts, t, points, revenue in values
+        ]
+
+    #Replays a log segment, a torn record at the end (crash while writing) is ignored
+    def replay(self, log_path: str) -> int:
+        with open(log_path, "rb") as f:
+            data = f.read()
+        count, pos = 0, 0
+        try:
+            while pos < len(data):
+                (member_len,) = RECORD_HEAD.unpack_from(data, pos)
+                pos += RECORD_HEAD.size
+                member_id = data[pos:pos + member_len].decode()
+                pos += member_len
+                ts, points, revenue, type_len = RECORD_BODY.unpack_from(data, pos)
+                pos += RECORD_BODY.size
+                if pos + type_len > len(data):
+                    raise struct.error("truncated record")
+                transaction_type = data[pos:pos + type_len].decode()
+                pos += type_len
+                self.append_columns(member_id, ts, transaction_type, points, revenue)
+                count += 1
+        except (struct.error, UnicodeDecodeError):
+            logging.warning(f"Ignoring torn record at the end of {log_path}")
+        return count
+
+    def snapshot_running(self) -> bool:
+        return self.snapshot_thread is not None and self.snapshot_thread.is_alive()
+
+    def wait_for_snapshot(self):
+        if self.snapshot_thread is not None:
+            self.snapshot_thread.join()
+            self.snapshot_thread = None
+
+    def snapshot(self):
+        with self.lock:
+            self.wait_for_snapshot()
+            self.write_snapshot(*self.copy_snapshot())
+
+    #One snapshot is written at a time, the appends made while it is written are covered by the next one
+    def snapshot_in_background(self):
+        self.snapshot_thread = threading.Thread(target=self.write_snapshot_logged, args=self.copy_snapshot(),
+                                                name="member-store-snapshot", daemon=True)
+        self.snapshot_thread.start()
+
+    #Moves on to a new log segment and copies all members as concatenated columns plus offsets, under the lock
+    def copy_snapshot(self):
+        with self.lock:
+            snapshot_gen = self.generation
+            self.log.close()
+            self.generation += 1
+            self.log = open(self.path(f"wal-{self.generation:08d}.log"), "ab")
+            self.appends_since_snapshot = 0
+
+            member_ids = self.member_ids()
+            members = [self.get(member_id) for member_id in member_ids]
+            offsets = np.zeros(len(members) + 1, dtype=np.int64)
+            np.cumsum([len(columns) for columns in members], out=offsets[1:])
+            columns = {name: np.concatenate([getattr(member, name) for member in members]) if members else np.empty(0, dtype=dtype)
+                       for name, dtype in COLUMNS.items()}
+            return snapshot_gen, member_ids, list(self.type_names), columns, offsets
+
+    #A failed snapshot leaves its log segments in place, the next one covers them
+    def write_snapshot_logged(self, *snapshot):
+        try:
+            self.write_snapshot(*snapshot)
+        except Exception:
+            logging.exception(f"Member store snapshot {snapshot[0]} failed")
+
+    #Reads nothing of the store, runs without the lock. Every file, then the directory, is fsynced before the log segments
+    #the snapshot covers are removed: a crash right after must find the snapshot on disk
+    def write_snapshot(self, snapshot_gen: int, member_ids: List[str], type_names: List[str], columns: Dict[str, np.ndarray],
+                       offsets: np.ndarray):
+        tmp_dir = self.path(f"snapshot-{snapshot_gen:08d}.tmp")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        for name, column in columns.items():
+            write_durably(os.path.join(tmp_dir, f"{name}.npy"), lambda f: np.save(f, column))
+        write_durably(os.path.join(tmp_dir, "offsets.npy"), lambda f: np.save(f, offsets))
+        write_durably(os.path.join(tmp_dir, "member_ids.txt"), lambda f: f.write("\n".join(member_ids).encode("utf-8")))
+        meta = {"type_names": type_names, "members": len(member_ids), "transactions": int(offsets[-1])}
+        write_durably(os.path.join(tmp_dir, "meta.json"), lambda f: f.write(json.dumps(meta).encode()))
+        fsync_directory(tmp_dir)
+        os.replace(tmp_dir, self.path(f"snapshot-{snapshot_gen:08d}"))
+        fsync_directory(self.directory)
+
+        #Everything up to snapshot_gen is now covered by the snapshot
+        for gen in self.generations("wal-"):
+            if gen <= snapshot_gen:
+                os.remove(self.path(f"wal-{gen:08d}.log"))
+        for gen in self.generations("snapshot-"):
+            if gen < snapshot_gen:
+                shutil.rmtree(self.path(f"snapshot-{gen:08d}"))
+        logging.info(f"Member store snapshot {snapshot_gen} written: {len(member_ids)} members, {offsets[-1]} transactions")
+
+    def load_snapshot(self, gen: int):
+        snapshot_dir = self.path(f"snapshot-{gen:08d}")
+        with open(os.path.join(snapshot_dir, "meta.json")) as f:
+            meta = json.load(f)
+        for transaction_type in meta["type_names"]:
+            self.type_code(transaction_type)
+        with open(os.path.join(snapshot_dir, "member_ids.txt"), encoding="utf-8") as f:
+            member_ids = f.read().split("\n") if meta["members"] else []
+        self.snapshot_index = {member_id: i for i, member_id in enumerate(member_ids)}
+        self.snapshot_offsets = np.load(os.path.join(snapshot_dir, "offsets.npy"))
+        self.snapshot_columns = {name: np.load(os.path.join(snapshot_dir, f"{name}.npy"), mmap_mode="r") for name in COLUMNS}
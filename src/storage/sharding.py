@@ -0,0 +1,36 @@
+import zlib
+from typing import Any, Dict, List, Optional
+
+
+#Shard owning a member. crc32 is stable across processes and restarts, unlike hash() on strings
+def shard_for(member_id: str, shards: int) -> int:
+    return zlib.crc32(member_id.encode()) % shards
+
+
+#Base urls of the member_data shards, in shard order. A member always goes to the same shard, so the order of its
+#transactions is the order in which they are sent to that shard
+class ShardMap:
+
+    def __init__(self, urls: List[str]):
+        if not urls:
+            raise ValueError("A shard map needs at least one shard url")
+        self.urls = [url.rstrip("/") for url in urls]
+
+    #Comma separated urls, e.g. MEMBER_DATA_SHARD_URLS=http://localhost:6101,http://localhost:6102
+    @classmethod
+    def from_env(cls, value: Optional[str]) -> Optional["ShardMap"]:
+        urls = [url.strip() for url in (value or "").split(",") if url.strip()]
+        return cls(urls) if urls else None
+
+    def __len__(self):
+        return len(self.urls)
+
+    def url_for(self, member_id: str) -> str:
+        return self.urls[shard_for(member_id, len(self.urls))]
+
+    #Transactions grouped by shard url, keeping their relative order within each shard
+    def split(self, transactions: List[Dict[str, Any]]) -> Dict[str, List[Dict[str, Any]]]:
+        groups: Dict[str, List[Dict[str, Any]]] = {}
+        for transaction in transactions:
+            groups.setdefault(self.url_for(transaction["memberId"]), []).append(transaction)
+        return groups
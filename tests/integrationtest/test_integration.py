@@ -7,6 +7,11 @@ from unittest.mock import patch, MagicMock, AsyncMock
 from myapp.perk_app import calculate_member_features, get_ats_resp, offer_request,calculate_offer
 from src.applications.prediction import MemberFeatures 
 from src.applications.offer_engine import OfferRequest 
+from myapp.transport import HttpTransport
+
+
+def http_transport(client):
+    return HttpTransport(client, client, client, "http://localhost:6001", "http://localhost:6002", "http://localhost:6003")
 
 
 
@@ -24,8 +29,8 @@ async def test_caluclate_offer():
     mock_client = AsyncMock()
     mock_client.get.return_value.status_code = 404
 
-    with patch("myapp.perk_app.incoming_client_request", mock_client), \
-         patch("myapp.perk_app.calculate_member_features") as fake_features, \
+    with patch("myapp.perk_app.transport", http_transport(mock_client)), \
+         patch("myapp.perk_app.calculate_aggregate_features") as fake_features, \
          patch("myapp.perk_app.get_ats_resp", new_callable=AsyncMock) as fake_ats_resp, \
          patch("myapp.perk_app.offer_request", new_callable=AsyncMock) as fake_offer:
         
@@ -46,4 +51,343 @@ async def test_caluclate_offer():
         result = await calculate_offer("member1", member_data, logs)
 
     assert result["memberId"] == "member1"
-    assert result["offer"] == "35% bonus"
\ No newline at end of file
+    assert result["offer"] == "35% bonus"
+
+def dependency_client(client):
+    from myapp.dependency_client import DependencyClient, DependencyConfig
+    return DependencyClient(DependencyConfig("TEST"), client=client)
+
+
+#Downstream services served in process through ASGI transports
+def in_process_client():
+    from httpx import AsyncClient, ASGITransport
+    from src.applications import member_data, prediction, offer_engine
+
+    return AsyncClient(mounts={
+        "http://localhost:6001": ASGITransport(app=member_data.app),
+        "http://localhost:6002": ASGITransport(app=prediction.app),
+        "http://localhost:6003": ASGITransport(app=offer_engine.app),
+    })
+
+
+@pytest.mark.asyncio
+async def test_batch_request_matches_single_requests():
+    from myapp.perk_app import handle_request, handle_batch_request
+
+    def transaction(member, ts, t_type, points, revenue):
+        return {"memberId": member, "lastTransactionUtcTs": ts, "lastTransactionType": t_type,
+                "lastTransactionPointsBought": points, "lastTransactionRevenueUsd": revenue}
+
+    transactions = [
+        transaction("batch-A", "2025-12-14 10:00:00", "buy", 9000, 90),
+        transaction("batch-B", "2025-12-14 11:00:00", "gift", 500, 2.5),
+        transaction("batch-A", "2025-12-15 10:00:00", "redeem", -900, 0),
+        transaction("batch-A", "2025-12-16 10:00:00", "buy", 6000, 60),
+    ]
+    single_transactions = [dict(t, memberId="single-" + t["memberId"]) for t in transactions]
+
+    async with in_process_client() as client:
+        with patch("myapp.perk_app.transport", http_transport(dependency_client(client))), patch("myapp.perk_app.record_logs"):
+            batch_offers = await handle_batch_request(transactions)
+            single_offers = [await handle_request(t) for t in single_transactions]
+            history = await client.get("http://localhost:6001/member_data/batch-A")
+
+    assert [o["memberId"] for o in batch_offers] == ["batch-A", "batch-B", "batch-A", "batch-A"]
+    assert [o["offer"] for o in batch_offers] == [o["offer"] for o in single_offers]
+    assert len(history.json()) == 3
+
+
+@pytest.mark.asyncio
+async def test_embedded_transport_matches_http_transport():
+    from myapp.perk_app import handle_request
+    from myapp.transport import EmbeddedTransport
+
+    transactions = [
+        {"memberId": "transport-member", "lastTransactionUtcTs": "2025-12-14 10:00:00", "lastTransactionType": "buy",
+         "lastTransactionPointsBought": 9000, "lastTransactionRevenueUsd": 90},
+        {"memberId": "transport-member", "lastTransactionUtcTs": "2025-12-15 10:00:00", "lastTransactionType": "redeem",
+         "lastTransactionPointsBought": -900, "lastTransactionRevenueUsd": 0},
+    ]
+
+    with patch("myapp.perk_app.transport", EmbeddedTransport()), patch("myapp.perk_app.record_logs"):
+        embedded_offers = [await handle_request(dict(t, memberId="embedded-member")) for t in transactions]
+
+    async with in_process_client() as client:
+        with patch("myapp.perk_app.transport", http_transport(dependency_client(client))), patch("myapp.perk_app.record_logs"):
+            http_offers = [await handle_request(dict(t, memberId="http-member")) for t in transactions]
+
+    assert [o["offer"] for o in embedded_offers] == [o["offer"] for o in http_offers]
+
+
+@pytest.mark.asyncio
+async def test_msgpack_transport_matches_json_transport():
+    from myapp.perk_app import handle_request, handle_batch_request
+    from src.applications.wire_format import JSON, MSGPACK
+
+    transactions = [
+        {"memberId": "wire-member", "lastTransactionUtcTs": "2025-12-14 10:00:00", "lastTransactionType": "buy",
+         "lastTransactionPointsBought": 9000, "lastTransactionRevenueUsd": 90},
+        {"memberId": "wire-member", "lastTransactionUtcTs": "2025-12-15 10:00:00", "lastTransactionType": "gift",
+         "lastTransactionPointsBought": 500, "lastTransactionRevenueUsd": 2.5},
+    ]
+
+    offers = {}
+    async with in_process_client() as client:
+        for name, content_type in (("json", JSON), ("msgpack", MSGPACK)):
+            transport = HttpTransport(dependency_client(client), dependency_client(client), dependency_client(client),
+                                      "http://localhost:6001", "http://localhost:6002", "http://localhost:6003",
+                                      content_type=content_type)
+            member = f"wire-{name}"
+            with patch("myapp.perk_app.transport", transport), patch("myapp.perk_app.record_logs"):
+                single = [await handle_request(dict(t, memberId=member)) for t in transactions]
+                batch = await handle_batch_request([dict(t, memberId=member + "-batch") for t in transactions])
+            offers[content_type] = [o["offer"] for o in single + batch]
+            assert await transport.get_member_aggregate(member) is not None
+
+    assert offers[MSGPACK] == offers[JSON]
+
+
+@pytest.mark.asyncio
+async def test_micro_batched_requests_match_single_requests():
+    import asyncio
+    from myapp import perk_app
+
+    transactions = [{"memberId": f"micro-{i % 5}", "lastTransactionUtcTs": f"2025-12-{10 + i // 5} 10:00:00",
+                     "lastTransactionType": ("buy", "gift", "redeem")[i % 3], "lastTransactionPointsBought": 1000 * (i + 1),
+                     "lastTransactionRevenueUsd": 10 * (i + 1)} for i in range(5)]
+
+    async with in_process_client() as client:
+        downstream = dependency_client(client)
+        with patch("myapp.perk_app.transport", http_transport(downstream)), patch("myapp.perk_app.record_logs"):
+            single = [await perk_app.handle_request(dict(t, memberId="single-" + t["memberId"])) for t in transactions]
+            with patch("myapp.perk_app.MICRO_BATCH", True), patch.object(client, "request", wraps=client.request) as requests:
+                batched = await asyncio.gather(*(perk_app.handle_request(t) for t in transactions))
+
+    assert [o["offer"] for o in batched] == [o["offer"] for o in single]
+    #One aggregates, one prediction and one offer call for the five requests, plus their five saves
+    urls = [str(c.args[1]) for c in requests.call_args_list]
+    assert sum(url.endswith("/member_data/aggregates") for url in urls) == 1
+    assert sum(url.endswith("/ml/batch/predict") for url in urls) == 1
+    assert sum(url.endswith("/offer/batch/assign") for url in urls) == 1
+
+
+@pytest.mark.asyncio
+async def test_concurrent_requests_of_a_member_run_in_order_on_one_fetch():
+    import asyncio
+    from myapp import perk_app
+
+    transactions = [{"memberId": "hot-member", "lastTransactionUtcTs": f"2025-12-1{i} 10:00:00",
+                     "lastTransactionType": ("buy", "gift", "redeem")[i % 3], "lastTransactionPointsBought": 3000 * (i + 1),
+                     "lastTransactionRevenueUsd": 30 * (i + 1)} for i in range(6)]
+
+    async with in_process_client() as client:
+        with patch("myapp.perk_app.transport", http_transport(dependency_client(client))), patch("myapp.perk_app.record_logs"):
+            sequential = [await perk_app.handle_request(dict(t, memberId="hot-sequential")) for t in transactions]
+            with patch.object(client, "request", wraps=client.request) as requests:
+                concurrent = await asyncio.gather(*(perk_app.handle_request(t) for t in transactions))
+            history = await client.get("http://localhost:6001/member_data/hot-member")
+
+    assert [o["offer"] for o in concurrent] == [o["offer"] for o in sequential]
+    assert sum(str(c.args[1]).endswith("/aggregate") for c in requests.call_args_list) == 1
+    assert [h["lastTransactionUtcTs"] for h in history.json()] == [t["lastTransactionUtcTs"] for t in transactions]
+    assert len(perk_app.member_coordinator) == 0
+
+
+@pytest.mark.asyncio
+async def test_write_behind_saves_after_responding_and_reads_its_writes():
+    from myapp import perk_app
+    from myapp.write_behind import WriteBehindQueue
+
+    transactions = [
+        {"memberId": "write-behind", "lastTransactionUtcTs": "2025-12-14 10:00:00", "lastTransactionType": "buy",
+         "lastTransactionPointsBought": 9000, "lastTransactionRevenueUsd": 90},
+        {"memberId": "write-behind", "lastTransactionUtcTs": "2025-12-15 10:00:00", "lastTransactionType": "redeem",
+         "lastTransactionPointsBought": -900, "lastTransactionRevenueUsd": 0},
+    ]
+
+    async with in_process_client() as client:
+        with patch("myapp.perk_app.transport", http_transport(dependency_client(client))), patch("myapp.perk_app.record_logs"):
+            expected = [await perk_app.handle_request(dict(t, memberId="write-through")) for t in transactions]
+
+            #The queue is only drained after the responses, the second offer must still see the first transaction
+            queue = WriteBehindQueue(perk_app.persist_member_data_batch, flush_interval=0)
+            with patch("myapp.perk_app.write_behind", queue):
+                offers = [await perk_app.handle_request(t) for t in transactions]
+                assert (await client.get("http://localhost:6001/member_data/write-behind")).status_code == 404
+                assert len(queue.pending("write-behind")) == 2
+                queue.start()
+                await queue.stop()
+
+            history = await client.get("http://localhost:6001/member_data/write-behind")
+
+    assert [o["offer"] for o in offers] == [o["offer"] for o in expected]
+    assert [h["lastTransactionType"] for h in history.json()] == ["buy", "redeem"]
+
+
+@pytest.mark.asyncio
+async def test_perk_app_metrics_cover_stages_offers_and_downstream_calls():
+    from httpx import AsyncClient, ASGITransport
+    from myapp import perk_app
+    from myapp.dependency_client import DependencyClient, DependencyConfig
+
+    transaction = {"memberId": "metrics-member", "lastTransactionUtcTs": "2025-12-14 10:00:00", "lastTransactionType": "buy",
+                   "lastTransactionPointsBought": 9000, "lastTransactionRevenueUsd": 90}
+
+    async with in_process_client() as client:
+        downstream = DependencyClient(DependencyConfig("MEMBER_DATA"), client=client, latency=perk_app.downstream_latency)
+        transport = HttpTransport(downstream, downstream, downstream, "http://localhost:6001", "http://localhost:6002", "http://localhost:6003")
+        with patch("myapp.perk_app.transport", transport), patch("myapp.perk_app.record_logs"):
+            offer = await perk_app.handle_request(transaction)
+
+    async with AsyncClient(transport=ASGITransport(app=perk_app.app), base_url="http://perk") as perk_client:
+        text = (await perk_client.get("/metrics")).text
+
+    assert f'perk_offers_total{{offer="{offer["offer"]}"}}' in text
+    for stage in ("fetch_member_data", "calculate_features", "get_predictions", "assign_offer", "total"):
+        assert f'perk_stage_latency_seconds_count{{stage="{stage}"}}' in text
+    assert 'perk_downstream_request_duration_seconds_count{dependency="member_data",method="GET",outcome="4xx"} 1' in text
+
+
+@pytest.mark.asyncio
+async def test_slow_perk_requests_keep_their_stage_breakdown():
+    from httpx import AsyncClient, ASGITransport
+    from myapp import perk_app
+
+    transaction = {"memberId": "slow-member", "lastTransactionUtcTs": "2025-12-14 10:00:00", "lastTransactionType": "buy",
+                   "lastTransactionPointsBought": 9000, "lastTransactionRevenueUsd": 90}
+
+    async with in_process_client() as client, AsyncClient(transport=ASGITransport(app=perk_app.app), base_url="http://perk") as perk_client:
+        with patch("myapp.perk_app.transport", http_transport(dependency_client(client))), patch("myapp.perk_app.record_logs"), \
+                patch.object(perk_app.slow_requests, "threshold", 0):
+            perk_app.slow_requests.requests.clear()
+            assert (await perk_client.post("/api/requests/v1", json=transaction)).status_code == 200
+
+    request = perk_app.slow_requests.requests[-1]
+    spans = [s["name"] for s in request["spans"]]
+    assert request["path"] == "/api/requests/v1"
+    for stage in ("fetch_member_data", "calculate_features", "get_predictions", "assign_offer", "endpoint"):
+        assert stage in spans
+    assert "test GET 4xx" in spans and "test POST 2xx" in spans
+
+
+@pytest.mark.asyncio
+async def test_sharded_member_data_routes_members_to_their_shard(tmp_path):
+    import time
+    import socket
+    import httpx
+    from src.applications import member_data_shards
+    from src.storage.sharding import ShardMap
+
+    def free_port():
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            return s.getsockname()[1]
+
+    base_port, router_port = free_port(), free_port()
+    while base_port + 1 == router_port:
+        router_port = free_port()
+    processes, urls = member_data_shards.start(2, base_port, router_port, 1, str(tmp_path / "store"))
+    try:
+        router = f"http://127.0.0.1:{router_port}"
+        for url in urls + [router]:
+            deadline = time.monotonic() + 30
+            while True:
+                try:
+                    if httpx.get(f"{url}/health").status_code == 200:
+                        break
+                except httpx.TransportError:
+                    assert time.monotonic() < deadline, f"{url} did not start"
+                    assert all(p.poll() is None for p in processes), "a shard process exited"
+                    time.sleep(0.1)
+
+        shards = ShardMap(urls)
+        members = [f"shard-member-{i}" for i in range(8)]
+        assert len({shards.url_for(m) for m in members}) == 2
+
+        def transaction(member, day, points):
+            return {"memberId": member, "lastTransactionUtcTs": f"2025-12-{day:02d} 10:00:00", "lastTransactionType": "buy",
+                    "lastTransactionPointsBought": points, "lastTransactionRevenueUsd": 1}
+
+        async with httpx.AsyncClient() as client:
+            #Half the members through the router, half straight to their shard like the perk app does
+            routed = [transaction(m, day, day * 100) for day in (1, 2) for m in members[:4]]
+            assert (await client.post(f"{router}/member_data/batch", json=routed)).json() == {"stored": 8}
+            transport = http_transport(dependency_client(client))
+            transport.member_data_shards = shards
+            await transport.save_member_data_batch([transaction(m, day, day * 100) for day in (1, 2) for m in members[4:]])
+
+            for member in members:
+                history = (await client.get(f"{router}/member_data/{member}")).json()
+                assert [h["lastTransactionPointsBought"] for h in history] == [100, 200]
+                assert (await transport.get_member_aggregate(member)).transactionCount == 2
+                other_shard = next(url for url in urls if url != shards.url_for(member))
+                assert (await client.get(f"{other_shard}/member_data/{member}")).status_code == 421
+    finally:
+        member_data_shards.stop(processes)
+
+    assert sorted(p.name for p in (tmp_path / "store").iterdir()) == ["shard-0", "shard-1", "shards.json"]
+
+
+@pytest.mark.asyncio
+async def test_backfill_matches_the_perk_app(tmp_path):
+    import csv
+    from myapp import perk_app
+    from myapp.backfill import backfill
+    from myapp.transport import EmbeddedTransport
+
+    with open("data/member_data.csv", encoding="utf-8") as f:
+        rows = [dict(row, memberId="backfill-" + row["memberId"]) for _, row in zip(range(400), csv.DictReader(f))]
+    input_path = tmp_path / "member_data.csv"
+    with open(input_path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+
+    live = []
+    with patch("myapp.perk_app.transport", EmbeddedTransport()), patch("myapp.perk_app.record_logs", side_effect=live.append):
+        for row in rows:
+            if any(value == "" for value in row.values()):
+                continue
+            await perk_app.handle_request({"memberId": row["memberId"], "lastTransactionUtcTs": row["lastTransactionUtcTs"],
+                                           "lastTransactionType": row["lastTransactionType"],
+                                           "lastTransactionPointsBought": float(row["lastTransactionPointsBought"]),
+                                           "lastTransactionRevenueUsd": float(row["lastTransactionRevenueUSD"])})
+
+    output_path = tmp_path / "transactions.csv"
+    assert backfill(str(input_path), str(output_path), workers=2, chunk_size=64) == len(live)
+    with open(output_path, encoding="utf-8") as f:
+        scored = list(csv.DictReader(f))
+
+    columns = [c for c in perk_app.csv_columns if not c.endswith("latency")]
+    assert [[row[c] for c in columns] for row in scored] == [[str(log[c]) for c in columns] for log in live]
+
+
+@pytest.mark.asyncio
+async def test_member_filter_skips_history_lookups_of_new_members_only():
+    from myapp import perk_app
+    from myapp.member_filter import KnownMemberFilter
+
+    transaction = {"memberId": "filter-known", "lastTransactionUtcTs": "2025-12-14 10:00:00", "lastTransactionType": "buy",
+                   "lastTransactionPointsBought": 9000, "lastTransactionRevenueUsd": 90}
+
+    async with in_process_client() as client:
+        with patch("myapp.perk_app.transport", http_transport(dependency_client(client))), patch("myapp.perk_app.record_logs"):
+            for m_id in ("filter-known", "filter-reference"):
+                await perk_app.handle_request(dict(transaction, memberId=m_id))
+            expected = [await perk_app.handle_request(dict(transaction, memberId=m_id)) for m_id in ("filter-reference", "filter-reference-new")]
+
+            member_filter = KnownMemberFilter(capacity=1000)
+            with patch("myapp.perk_app.member_filter", member_filter), patch("myapp.perk_app.write_behind", None):
+                assert await perk_app.seed_member_filter()
+                assert "filter-known" in member_filter and "filter-new" not in member_filter
+
+                with patch.object(perk_app.transport, "get_member_aggregate", wraps=perk_app.transport.get_member_aggregate) as lookups:
+                    offers = [await perk_app.handle_request(dict(transaction, memberId=m_id)) for m_id in ("filter-known", "filter-new")]
+                    assert [call.args[0] for call in lookups.call_args_list] == ["filter-known"]
+                    #Saved members are added right away, their next request looks them up
+                    assert "filter-new" in member_filter
+                    await perk_app.handle_request(dict(transaction, memberId="filter-new"))
+                    assert [call.args[0] for call in lookups.call_args_list] == ["filter-known", "filter-new"]
+
+    assert [o["offer"] for o in offers] == [o["offer"] for o in expected]
+    assert member_filter.skipped == 1 and member_filter.false_positives == 0
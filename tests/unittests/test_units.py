@@ -1,4 +1,5 @@
 import os
+import json
 import sys
 import pytest
 import datetime
@@ -7,6 +8,11 @@ from unittest.mock import patch, MagicMock, AsyncMock
 from myapp.perk_app import calculate_member_features, get_ats_resp, offer_request
 from src.applications.prediction import MemberFeatures
 from src.applications.offer_engine import OfferRequest
+from myapp.transport import HttpTransport
+
+
+def http_transport(client):
+    return HttpTransport(client, client, client, "http://localhost:6001", "http://localhost:6002", "http://localhost:6003")
 
 
 #Features calculations tests
@@ -123,7 +129,7 @@ async def test_ats_resp_fetching():
                     status_code=200
                 )]
         
-    with patch("myapp.perk_app.incoming_client_request", mock_client):
+    with patch("myapp.perk_app.transport", http_transport(mock_client)):
         ats_resp_results = await get_ats_resp(memb_features,logs)
 
     assert ats_resp_results["ats"] == 5
@@ -143,7 +149,1224 @@ async def test_offer_request():
             status_code=200,
         )
 
-    with patch("myapp.perk_app.incoming_client_request", mock_client):
+    with patch("myapp.perk_app.transport", http_transport(mock_client)):
         my_offer = await offer_request(target_offer)
 
     assert my_offer == {"offer": "50% discount"}
+
+
+#Running aggregates tests
+
+def test_aggregate_features_match_history_features():
+    from src.applications.member_data import MemberAggregate, apply_member_transaction, member_aggregate_features
+    from src.storage.member_store import parse_timestamp
+
+    transactions = [
+        {"lastTransactionPointsBought": 100, "lastTransactionRevenueUsd": 50, "lastTransactionType": "buy", "lastTransactionUtcTs": "2025-12-14 10:00:00"},
+        {"lastTransactionPointsBought": 150, "lastTransactionRevenueUsd": 100, "lastTransactionType": "redeem", "lastTransactionUtcTs": "2025-12-15 11:00:00"},
+        {"lastTransactionPointsBought": 200, "lastTransactionRevenueUsd": 150, "lastTransactionType": "buy", "lastTransactionUtcTs": "2025-12-16 12:00:00"},
+        {"lastTransactionPointsBought": 250, "lastTransactionRevenueUsd": 200, "lastTransactionType": "gift", "lastTransactionUtcTs": "2025-12-17 13:00:00"},
+        {"lastTransactionPointsBought": 300, "lastTransactionRevenueUsd": 250, "lastTransactionType": "redeem", "lastTransactionUtcTs": "2025-12-18 14:00:00"}
+    ]
+
+    aggregate = MemberAggregate()
+    for t in transactions:
+        apply_member_transaction(aggregate, t["lastTransactionPointsBought"], t["lastTransactionRevenueUsd"],
+                                 t["lastTransactionType"], parse_timestamp(t["lastTransactionUtcTs"]))
+
+    assert aggregate.transactionCount == 5
+    assert aggregate.last3PointsBought == [200, 250, 300]
+    assert member_aggregate_features(aggregate) == calculate_member_features(transactions, {})
+
+
+def test_member_data_features_endpoint():
+    from fastapi.testclient import TestClient
+    from src.applications.member_data import app
+
+    client = TestClient(app)
+    first = {"memberId": "aggregate-member", "lastTransactionUtcTs": "2025-12-14 10:00:00", "lastTransactionType": "buy",
+             "lastTransactionPointsBought": 100, "lastTransactionRevenueUsd": 50}
+    second = dict(first, lastTransactionType="gift", lastTransactionPointsBought=300, lastTransactionRevenueUsd=150)
+
+    assert client.get("/member_data/aggregate-member/aggregate").status_code == 404
+    client.post("/member_data", json=first)
+
+    features = client.post("/member_data/aggregate-member/features", json=second).json()
+    assert features["AVG_POINTS_BOUGHT"] == 200
+    assert features["PCT_GIFT_TRANSACTIONS"] == pytest.approx(0.5)
+    assert client.get("/member_data/aggregate-member/aggregate").json()["transactionCount"] == 1
+
+
+def test_concurrent_stores_keep_aggregates_in_step_with_history():
+    from concurrent.futures import ThreadPoolExecutor
+    from src.applications.member_data import store_member_data, load_member_aggregate, member_data_store
+    from src.models.member_data import MemberData
+
+    def store_all(thread):
+        for i in range(300):
+            store_member_data(MemberData(memberId=f"concurrent-{thread % 2}", lastTransactionUtcTs="2025-12-14 10:00:00",
+                                         lastTransactionType="buy", lastTransactionPointsBought=1, lastTransactionRevenueUsd=1))
+
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(store_all, range(8)))
+    for m_id in ("concurrent-0", "concurrent-1"):
+        aggregate = load_member_aggregate(m_id)
+        assert aggregate.transactionCount == len(member_data_store.history(m_id)) == 1200
+        #Callers get their own copy, changing it leaves the stored aggregate alone
+        aggregate.transactionCount = 0
+        assert load_member_aggregate(m_id).transactionCount == 1200
+
+
+@pytest.mark.asyncio
+async def test_embedded_transport_keeps_the_event_loop_running_while_the_store_is_busy():
+    import asyncio
+    import threading
+    from myapp.transport import EmbeddedTransport
+    from src.applications.member_data import member_data_store
+
+    transport = EmbeddedTransport()
+    data = {"memberId": "embedded-busy", "lastTransactionUtcTs": "2025-12-14 10:00:00", "lastTransactionType": "buy",
+            "lastTransactionPointsBought": 1, "lastTransactionRevenueUsd": 1}
+    #Another thread holds the store lock, like a snapshot being written
+    release = threading.Event()
+    held = threading.Event()
+
+    def snapshot():
+        with member_data_store.lock:
+            held.set()
+            release.wait(5)
+
+    thread = threading.Thread(target=snapshot)
+    thread.start()
+    held.wait(5)
+    save = asyncio.create_task(transport.save_member_data(data))
+    ticks = 0
+    for _ in range(5):
+        await asyncio.sleep(0.01)
+        ticks += 1
+    assert ticks == 5 and not save.done()
+    release.set()
+    await save
+    thread.join()
+    assert (await transport.get_member_aggregate("embedded-busy")).transactionCount == 1
+
+
+#Combined prediction tests
+
+def test_combined_prediction_matches_single_models():
+    from src.applications.prediction import predict, predict_ats, predict_resp
+
+    memb_features = MemberFeatures(AVG_POINTS_BOUGHT=200, AVG_REVENUE_USD=150,
+                                   LAST_3_TRANSACTIONS_AVG_POINTS_BOUGHT=250, LAST_3_TRANSACTIONS_AVG_REVENUE_USD=200,
+                                   PCT_BUY_TRANSACTIONS=0.4, PCT_GIFT_TRANSACTIONS=0.2,
+                                   PCT_REDEEM_TRANSACTIONS=0.4, DAYS_SINCE_LAST_TRANSACTION=3)
+
+    result = predict(memb_features)
+    assert result["ats"] == predict_ats(memb_features)["prediction"]
+    assert result["resp"] == predict_resp(memb_features)["prediction"]
+
+
+@pytest.mark.asyncio
+async def test_ats_resp_fetching_failure():
+    memb_features = MemberFeatures(AVG_POINTS_BOUGHT=20, AVG_REVENUE_USD=50,
+                                   LAST_3_TRANSACTIONS_AVG_POINTS_BOUGHT=10, LAST_3_TRANSACTIONS_AVG_REVENUE_USD=20,
+                                   PCT_BUY_TRANSACTIONS=2, PCT_GIFT_TRANSACTIONS=3,
+                                   PCT_REDEEM_TRANSACTIONS=4, DAYS_SINCE_LAST_TRANSACTION=5)
+
+    async def fake_post(url, json, **kwargs):
+        if url.endswith("/ml/resp/predict"):
+            raise RuntimeError("resp service down")
+        return MagicMock(json=lambda: {"prediction": 5}, raise_for_status=lambda: None, status_code=200)
+
+    mock_client = AsyncMock()
+    mock_client.post.side_effect = fake_post
+
+    with patch("myapp.perk_app.transport", http_transport(mock_client)):
+        with pytest.raises(RuntimeError):
+            await get_ats_resp(memb_features, {})
+
+    assert mock_client.post.call_count == 2
+
+
+#Batch prediction tests
+
+def test_batch_prediction_matches_scalar_predictions():
+    from src.applications.prediction import predict_batch, predict_ats, predict_resp
+    from src.models.member_features import MemberFeaturesBatch
+
+    rows = [
+        MemberFeatures(AVG_POINTS_BOUGHT=200, AVG_REVENUE_USD=150, LAST_3_TRANSACTIONS_AVG_POINTS_BOUGHT=250,
+                       LAST_3_TRANSACTIONS_AVG_REVENUE_USD=200, PCT_BUY_TRANSACTIONS=0.4, PCT_GIFT_TRANSACTIONS=0.2,
+                       PCT_REDEEM_TRANSACTIONS=0.4, DAYS_SINCE_LAST_TRANSACTION=3),
+        #Negative weight gets clamped to 0
+        MemberFeatures(AVG_POINTS_BOUGHT=-900, AVG_REVENUE_USD=0, LAST_3_TRANSACTIONS_AVG_POINTS_BOUGHT=-900,
+                       LAST_3_TRANSACTIONS_AVG_REVENUE_USD=0, PCT_BUY_TRANSACTIONS=0, PCT_GIFT_TRANSACTIONS=0,
+                       PCT_REDEEM_TRANSACTIONS=1, DAYS_SINCE_LAST_TRANSACTION=10),
+        #RESP gets capped at 0.9
+        MemberFeatures(AVG_POINTS_BOUGHT=5000, AVG_REVENUE_USD=500, LAST_3_TRANSACTIONS_AVG_POINTS_BOUGHT=6000,
+                       LAST_3_TRANSACTIONS_AVG_REVENUE_USD=700, PCT_BUY_TRANSACTIONS=1, PCT_GIFT_TRANSACTIONS=0,
+                       PCT_REDEEM_TRANSACTIONS=0, DAYS_SINCE_LAST_TRANSACTION=0)
+    ]
+
+    result = predict_batch(MemberFeaturesBatch.from_rows(rows))
+
+    assert result["ats"] == [predict_ats(row)["prediction"] for row in rows]
+    assert result["resp"] == [predict_resp(row)["prediction"] for row in rows]
+    assert result["resp"][2] == 0.9
+
+
+def test_batch_prediction_rejects_ragged_columns():
+    from src.models.member_features import MemberFeaturesBatch
+
+    columns = {name: [1.0, 2.0] for name in MemberFeatures.model_fields}
+    columns["DAYS_SINCE_LAST_TRANSACTION"] = [1]
+    with pytest.raises(ValueError):
+        MemberFeaturesBatch(**columns)
+
+
+#Async event streamer tests
+
+def test_async_streamer_keeps_per_member_order(tmp_path):
+    import json
+    import httpx
+    from myapp.events_streamer import EventStreamer
+
+    csv_file = tmp_path / "members.csv"
+    lines = ["memberId,lastTransactionUtcTs,lastTransactionType,lastTransactionPointsBought,lastTransactionRevenueUSD"]
+    for i in range(60):
+        lines.append(f"M{i % 4},2025-12-14 10:00:{i % 60:02d},buy,{i},1.5")
+    lines.append("M1,,buy,1,1.5")
+    csv_file.write_text("\n".join(lines))
+
+    received = []
+
+    def handler(request):
+        row = json.loads(request.content)
+        received.append(row)
+        return httpx.Response(500 if row["lastTransactionPointsBought"] == 7 else 200, json={})
+
+    streamer = EventStreamer(str(csv_file), url="http://perk/api/requests/v1", concurrency=3,
+                             transport=httpx.MockTransport(handler))
+    streamer.requests_manager("async")
+
+    for member in ["M0", "M1", "M2", "M3"]:
+        points = [r["lastTransactionPointsBought"] for r in received if r["memberId"] == member]
+        assert points == sorted(points)
+    assert streamer.sent_count == 59
+    assert streamer.failed_count == 1
+    assert streamer.skipped_count == 1
+
+
+#Background log writer tests
+
+def test_log_writer_batches_rotates_and_samples(tmp_path):
+    import logging
+    from myapp.log_writer import BufferedLogWriter
+
+    writer = BufferedLogWriter(csv_path=str(tmp_path / "transactions.csv"), csv_columns=["memberId", "offer"],
+                               log_path=str(tmp_path / "processed.log"), log_format="%(levelname)s - %(message)s",
+                               batch_size=10, flush_interval=0.05, max_bytes=200, backup_count=2, info_sample_rate=0)
+    logger = logging.getLogger("log-writer-test")
+    logger.addHandler(writer.handler)
+    logger.setLevel(logging.INFO)
+
+    writer.start()
+    for i in range(30):
+        writer.write_row({"memberId": f"member{i}", "offer": "35% Bonus"})
+    logger.info("sampled out")
+    logger.warning("always kept")
+    writer.stop()
+    logger.removeHandler(writer.handler)
+
+    csv_files = [tmp_path / "transactions.csv", tmp_path / "transactions.csv.1", tmp_path / "transactions.csv.2"]
+    assert all(f.exists() for f in csv_files)
+    assert all(f.read_text().startswith("memberId,offer") for f in csv_files)
+    assert "member29" in csv_files[0].read_text()
+    assert (tmp_path / "processed.log").read_text() == "WARNING - always kept\n"
+
+
+def test_log_writer_drops_when_full_and_reports_failed_flushes(tmp_path):
+    import logging
+    from myapp import log_writer
+    from myapp.log_writer import BufferedLogWriter
+
+    #Not started, nothing drains the queue
+    writer = BufferedLogWriter(csv_path=str(tmp_path / "transactions.csv"), csv_columns=["memberId", "offer"],
+                               log_path=str(tmp_path / "processed.log"), log_format="%(message)s", max_pending=3)
+    logger = logging.getLogger("log-writer-full-test")
+    logger.addHandler(writer.handler)
+    logger.setLevel(logging.INFO)
+    for i in range(5):
+        writer.write_row({"memberId": f"member{i}", "offer": "35% Bonus"})
+    logger.warning("dropped")
+    logger.removeHandler(writer.handler)
+    assert (writer.queue.qsize(), writer.dropped_rows, writer.dropped_records) == (3, 2, 1)
+
+    #The csv path is a directory, the flush fails and is logged instead of raising
+    broken = BufferedLogWriter(csv_path=str(tmp_path), csv_columns=["memberId", "offer"],
+                               log_path=str(tmp_path / "processed.log"), log_format="%(message)s")
+    with patch.object(log_writer.logger, "exception") as exception:
+        broken.flush([{"memberId": "member", "offer": "35% Bonus"}], [])
+    exception.assert_called_once()
+    assert broken.failed_rows == 1
+
+
+#Durable member store tests
+
+def test_member_store_restores_from_snapshot_and_log(tmp_path):
+    from src.storage.member_store import MemberStore, parse_timestamp
+
+    store = MemberStore(str(tmp_path), snapshot_every=5)
+    for i in range(12):
+        store.append(f"member{i % 3}", parse_timestamp(f"2025-12-{10 + i} 10:00:00"), ["buy", "gift", "redeem"][i % 2], i * 100.0, i * 1.5)
+    expected = {m: store.history(m) for m in ["member0", "member1", "member2"]}
+
+    #No close: the last transactions only live in the log, as after a crash
+    store.wait_for_snapshot()
+    store.log.close()
+    with open(store.path(f"wal-{store.generation:08d}.log"), "ab") as f:
+        f.write(b"\x07\x00torn")
+
+    restored = MemberStore(str(tmp_path), snapshot_every=5)
+    assert {m: restored.history(m) for m in expected} == expected
+    assert expected["member1"][0] == {"memberId": "member1", "lastTransactionUtcTs": "2025-12-11 10:00:00",
+                                      "lastTransactionType": "gift", "lastTransactionPointsBought": 100.0,
+                                      "lastTransactionRevenueUsd": 1.5}
+
+    restored.append("member0", parse_timestamp("2025-12-30 10:00:00"), "buy", 1.0, 1.0)
+    restored.close()
+    assert len(MemberStore(str(tmp_path)).history("member0")) == 5
+
+
+def test_member_store_concurrent_appends_survive_snapshots(tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+    from src.storage.member_store import MemberStore
+
+    store = MemberStore(str(tmp_path), snapshot_every=50)
+
+    def append_all(thread):
+        for i in range(500):
+            store.append(f"member{thread}", 1765000000 + i, "buy", float(i), 1.0)
+
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(append_all, range(8)))
+    assert [len(store.history(f"member{t}")) for t in range(8)] == [500] * 8
+    store.close()
+
+    restored = MemberStore(str(tmp_path))
+    assert all([h["lastTransactionPointsBought"] for h in restored.history(f"member{t}")] == [float(i) for i in range(500)]
+               for t in range(8))
+
+
+def test_member_store_writes_snapshots_in_the_background_and_durably(tmp_path):
+    import os
+    import threading
+    from src.storage.member_store import MemberStore
+
+    store = MemberStore(str(tmp_path), snapshot_every=5)
+    release = threading.Event()
+    write_snapshot = store.write_snapshot
+    def slow_write(*snapshot):
+        release.wait(5)
+        write_snapshot(*snapshot)
+    store.write_snapshot = slow_write
+
+    #The snapshot is being written, appends and reads go on meanwhile
+    for i in range(12):
+        store.append("member0", 1765000000 + i, "buy", float(i), 1.0)
+    assert store.snapshot_running() and len(store.history("member0")) == 12
+    assert not any(name.startswith("snapshot-") and not name.endswith(".tmp") for name in os.listdir(tmp_path))
+
+    #Every file and directory is on disk before the first log segment is removed
+    events = []
+    fsync, remove = os.fsync, os.remove
+    def record_fsync(fd):
+        events.append("fsync")
+        fsync(fd)
+    def record_remove(path):
+        events.append("remove")
+        remove(path)
+    with patch("os.fsync", record_fsync), patch("os.remove", record_remove):
+        release.set()
+        store.wait_for_snapshot()
+    assert events.index("remove") >= 8 and "fsync" not in events[events.index("remove"):]
+
+    store.close()
+    assert [h["lastTransactionPointsBought"] for h in MemberStore(str(tmp_path)).history("member0")] == [float(i) for i in range(12)]
+
+
+#Dependency client tests
+
+def make_dependency_client(handler, **settings):
+    import httpx
+    from myapp.dependency_client import DependencyClient, DependencyConfig
+
+    config = DependencyConfig("TEST")
+    for name, value in settings.items():
+        setattr(config, name, value)
+    return DependencyClient(config, client=httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+
+
+@pytest.mark.asyncio
+async def test_circuit_breaker_fails_fast_then_recovers():
+    import httpx
+    import asyncio
+    from myapp.dependency_client import CircuitOpenError
+
+    statuses = [500, 500, 200]
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(statuses[len(calls) - 1])
+
+    client = make_dependency_client(handler, breaker_failures=2, breaker_reset_timeout=0.05)
+    for _ in range(2):
+        assert (await client.get("http://ml/ml/ats/predict")).status_code == 500
+    with pytest.raises(CircuitOpenError):
+        await client.get("http://ml/ml/ats/predict")
+    assert len(calls) == 2 and client.breaker.state == "open"
+
+    await asyncio.sleep(0.06)
+    assert (await client.get("http://ml/ml/ats/predict")).status_code == 200
+    assert client.breaker.state == "closed"
+
+
+@pytest.mark.asyncio
+async def test_slow_read_is_hedged():
+    import httpx
+    import asyncio
+
+    calls = []
+
+    async def handler(request):
+        calls.append(request)
+        if len(calls) == 1:
+            await asyncio.sleep(1)
+        return httpx.Response(200, json={"prediction": len(calls)})
+
+    client = make_dependency_client(handler, hedge_percentile=50)
+    for _ in range(100):
+        client.latencies.record(0.01)
+
+    response = await client.post("http://ml/ml/ats/predict", json={}, hedge=True)
+    assert response.json() == {"prediction": 2}
+    assert client.hedged_requests == 1
+
+
+@pytest.mark.asyncio
+async def test_fast_5xx_does_not_win_over_the_hedge():
+    import httpx
+    import asyncio
+
+    calls = []
+
+    #The first request fails after the hedge was sent but before the hedge answers
+    async def handler(request):
+        calls.append(request)
+        if len(calls) == 1:
+            await asyncio.sleep(0.05)
+            return httpx.Response(500)
+        await asyncio.sleep(0.1)
+        return httpx.Response(200, json={"prediction": 2})
+
+    client = make_dependency_client(handler, hedge_percentile=50)
+    for _ in range(100):
+        client.latencies.record(0.01)
+
+    response = await client.post("http://ml/ml/ats/predict", json={}, hedge=True)
+    assert response.status_code == 200 and client.hedged_requests == 1
+
+
+@pytest.mark.asyncio
+async def test_cancelled_trial_call_reopens_the_half_open_circuit():
+    import httpx
+    import asyncio
+
+    async def handler(request):
+        await asyncio.sleep(1)
+        return httpx.Response(200)
+
+    client = make_dependency_client(handler, breaker_failures=1, breaker_reset_timeout=0)
+    client.breaker.record_failure()
+    trial = asyncio.create_task(client.get("http://ml/ml/version"))
+    await asyncio.sleep(0.01)
+    assert client.breaker.state == "half_open"
+    trial.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await trial
+    #The next call is let through as the new trial instead of being short-circuited forever
+    assert not client.breaker.trial_in_flight
+    client.breaker.before_call()
+
+
+@pytest.mark.asyncio
+async def test_open_circuit_returns_fallback_offer():
+    from myapp.perk_app import handle_request, FALLBACK_OFFER
+    from myapp.dependency_client import CircuitOpenError
+
+    fake_transport = AsyncMock()
+    fake_transport.get_member_aggregate.side_effect = CircuitOpenError("Circuit open for member_data")
+
+    with patch("myapp.perk_app.transport", fake_transport), patch("myapp.perk_app.record_logs"):
+        result = await handle_request({"memberId": "member1", "lastTransactionPointsBought": 300,
+                                       "lastTransactionRevenueUsd": 100, "lastTransactionType": "buy",
+                                       "lastTransactionUtcTs": "2025-12-17 14:00:00"})
+
+    assert result == {"memberId": "member1", "offer": FALLBACK_OFFER}
+
+
+#Offer rules tests
+
+def test_default_offer_rules_match_original_threshold():
+    from src.applications.offer_rules import OfferRuleTable
+
+    table = OfferRuleTable()
+    pairs = [(1000, 0.2), (1000, 0.19999), (0, 0.9), (300, 0.9), (-50, -10)]
+
+    assert [table.evaluate(a, r) for a, r in pairs] == ["50% Discount" if a * r >= 200 else "35% Bonus" for a, r in pairs]
+    assert table.evaluate_batch([a for a, _ in pairs], [r for _, r in pairs]) == [table.evaluate(a, r) for a, r in pairs]
+
+
+def test_offer_rules_priorities_segments_and_hot_reload(tmp_path):
+    import json
+    import os
+    from src.applications.offer_rules import OfferRuleTable
+
+    rules_file = tmp_path / "rules.json"
+    rules_file.write_text(json.dumps({"default_offer": "none", "rules": [
+        {"name": "tier1", "offer": "10% Bonus", "min_score": 10, "priority": 1},
+        {"name": "tier2", "offer": "20% Bonus", "min_score": 100, "priority": 1},
+        {"name": "vip", "offer": "VIP", "min_score": 50, "priority": 5, "segment": {"min_resp": 0.5}},
+    ]}))
+    table = OfferRuleTable(str(rules_file), check_interval=0)
+
+    ats = [5, 100, 1000, 400, 1000]
+    resp = [1, 0.2, 0.2, 0.6, 0.05]
+    expected = ["none", "10% Bonus", "20% Bonus", "VIP", "10% Bonus"]
+    assert [table.evaluate(a, r) for a, r in zip(ats, resp)] == expected
+    assert table.evaluate_batch(ats, resp) == expected
+
+    rules_file.write_text(json.dumps({"default_offer": "reloaded", "rules": []}))
+    os.utime(rules_file, ns=(0, 1))
+    assert table.evaluate(400, 0.6) == "reloaded"
+
+    rules_file.write_text("{broken")
+    os.utime(rules_file, ns=(0, 2))
+    assert table.evaluate(400, 0.6) == "reloaded"
+
+
+#Feature engine tests
+
+def test_feature_engine_windowed_and_recency_features():
+    from src.features.engine import compute_stats, compute_features, registry, SECONDS_PER_DAY
+
+    now = 1_700_000_000
+    rows = [(100.0, 10.0, "buy", now - 100 * SECONDS_PER_DAY),
+            (200.0, 20.0, "gift", now - 40 * SECONDS_PER_DAY),
+            (300.0, 30.0, "buy", now - 20 * SECONDS_PER_DAY),
+            (400.0, 40.0, "redeem", now - 5 * SECONDS_PER_DAY)]
+
+    accumulators = registry.accumulators()
+    assert len(accumulators) == len({acc.key for acc in accumulators})
+
+    features = compute_features(compute_stats(iter(rows), accumulators, now), now)
+    assert features["AVG_POINTS_BOUGHT"] == 250
+    assert features["DAYS_SINCE_LAST_TRANSACTION"] == 5
+    assert features["TRANSACTIONS_7D"] == 1
+    assert features["AVG_POINTS_BOUGHT_30D"] == 350
+    assert features["AVG_REVENUE_USD_90D"] == 30
+    assert features["TRANSACTIONS_90D"] == 3
+    assert features["RECENCY_WEIGHTED_POINTS_BOUGHT"] == pytest.approx(
+        sum(p * 0.5 ** ((now - ts) / (30 * SECONDS_PER_DAY)) for p, _, _, ts in rows))
+
+    #Without accumulators (e.g. from a running aggregate) only the core features are available
+    assert set(compute_features(compute_stats(iter(rows), now=now), now)) == set(MemberFeatures.model_fields)
+
+
+def test_registered_feature_shares_the_single_pass():
+    from src.features.engine import FeatureRegistry, WindowSum, compute_stats, SECONDS_PER_DAY
+
+    custom = FeatureRegistry()
+    custom.register("POINTS_30D", lambda stats, now: stats.extra["window:points:30"]["sum"], (WindowSum("points", 30),))
+    custom.register("COUNT_30D", lambda stats, now: stats.extra["window:points:30"]["count"], (WindowSum("points", 30),))
+    with pytest.raises(ValueError):
+        custom.register("BAD_CORE", lambda stats, now: 0, (WindowSum("points", 30),), core=True)
+
+    now = 1_700_000_000
+    stats = compute_stats(iter([(5.0, 1.0, "buy", now), (7.0, 1.0, "buy", now - 40 * SECONDS_PER_DAY)]),
+                          custom.accumulators(), now)
+    assert len(custom.accumulators()) == 1
+    assert {name: f.compute(stats, now) for name, f in custom.features.items()} == {"POINTS_30D": 5.0, "COUNT_30D": 1}
+
+
+#Prediction cache tests
+
+def cache_features(points):
+    return MemberFeatures(AVG_POINTS_BOUGHT=points, AVG_REVENUE_USD=50, LAST_3_TRANSACTIONS_AVG_POINTS_BOUGHT=points,
+                          LAST_3_TRANSACTIONS_AVG_REVENUE_USD=20, PCT_BUY_TRANSACTIONS=1, PCT_GIFT_TRANSACTIONS=0,
+                          PCT_REDEEM_TRANSACTIONS=0, DAYS_SINCE_LAST_TRANSACTION=0)
+
+
+def test_prediction_cache_quantizes_evicts_and_invalidates():
+    from myapp.prediction_cache import PredictionCache
+
+    cache = PredictionCache(max_size=2, ttl=0, precision=2)
+    cache.set_version("1")
+    cache.put(cache_features(100), 100, 0.5)
+    assert cache.get(cache_features(100.001)) == (100, 0.5)
+    assert cache.get(cache_features(100.1)) is None
+
+    cache.put(cache_features(200), 200, 0.6)
+    cache.put(cache_features(300), 300, 0.7)
+    assert cache.get(cache_features(100)) is None
+    assert cache.get(cache_features(300)) == (300, 0.7)
+
+    cache.set_version("2")
+    assert cache.get(cache_features(300)) is None
+    assert cache.stats() | {"hit_rate": None} == {"size": 0, "max_size": 2, "model_version": "2", "hits": 2, "misses": 3,
+                                                   "hit_rate": None, "evictions": 1, "expirations": 0, "invalidations": 1}
+
+
+def test_prediction_cache_keeps_colliding_feature_vectors_apart():
+    from myapp.prediction_cache import PredictionCache
+
+    #hash(-1) == hash(-2) in CPython, so are the hashes of vectors that only differ there
+    cache = PredictionCache(max_size=10, ttl=0)
+    assert hash(cache.key(cache_features(-1))) == hash(cache.key(cache_features(-2)))
+    cache.put(cache_features(-1), 1, 0.1)
+    assert cache.get(cache_features(-2)) is None
+
+
+@pytest.mark.asyncio
+async def test_cached_features_skip_the_prediction_calls():
+    from myapp.prediction_cache import PredictionCache
+    from myapp.perk_app import get_ats_resp_batch
+
+    fake_transport = AsyncMock()
+    fake_transport.predict.side_effect = lambda model, features: {"ats": 10, "resp": 0.5}[model]
+    fake_transport.predict_batch.side_effect = lambda batch: {"ats": [20] * len(batch.AVG_POINTS_BOUGHT),
+                                                              "resp": [0.6] * len(batch.AVG_POINTS_BOUGHT)}
+
+    with patch("myapp.perk_app.transport", fake_transport), \
+         patch("myapp.perk_app.prediction_cache", PredictionCache(max_size=10)):
+        assert await get_ats_resp(cache_features(100), {}) == {"ats": 10, "resp": 0.5}
+        assert await get_ats_resp(cache_features(100), {}) == {"ats": 10, "resp": 0.5}
+        assert fake_transport.predict.await_count == 2
+
+        logs = [{}, {}]
+        predictions = await get_ats_resp_batch([cache_features(100), cache_features(200)], logs)
+        assert predictions == {"ats": [10, 20], "resp": [0.5, 0.6]}
+        assert len(fake_transport.predict_batch.await_args.args[0].AVG_POINTS_BOUGHT) == 1
+        assert logs[1] == {"ats": 20, "resp": 0.6}
+
+
+#Write-behind queue tests
+
+@pytest.mark.asyncio
+async def test_write_behind_retries_failed_batches_in_order():
+    from myapp.write_behind import WriteBehindQueue
+
+    saved, failures = [], [1]
+    async def flaky_save(batch):
+        if failures:
+            failures.pop()
+            raise RuntimeError("member_data unavailable")
+        saved.extend(d["seq"] for d in batch)
+
+    queue = WriteBehindQueue(flaky_save, batch_size=2, flush_interval=0, retry_backoff=0)
+    queue.start()
+    for seq in range(5):
+        await queue.enqueue({"memberId": f"m{seq % 2}", "seq": seq})
+    await queue.stop()
+
+    assert saved == [0, 1, 2, 3, 4]
+    assert queue.pending("m0") == [] and queue.dropped == 0
+
+
+@pytest.mark.asyncio
+async def test_write_behind_keeps_retrying_through_an_outage():
+    import time
+    from myapp.write_behind import WriteBehindQueue
+
+    saved, attempts = [], []
+    outage_end = time.monotonic() + 0.2
+    async def save(batch):
+        attempts.append(time.monotonic())
+        if time.monotonic() < outage_end:
+            raise RuntimeError("member_data unavailable")
+        saved.extend(d["seq"] for d in batch)
+
+    #Far more attempts than max_retries, no wait longer than max_backoff
+    queue = WriteBehindQueue(save, flush_interval=0, max_retries=1, retry_backoff=0.01, retry_for=0.5, max_backoff=0.02)
+    await queue.enqueue({"memberId": "m0", "seq": 0})
+    queue.start()
+    await queue.stop()
+    assert saved == [0] and queue.dropped == 0 and len(attempts) > 3
+
+    #Past retry_for the batch is dropped
+    outage_end = time.monotonic() + 10
+    queue = WriteBehindQueue(save, flush_interval=0, max_retries=1, retry_backoff=0.01, retry_for=0.05, max_backoff=0.02)
+    await queue.enqueue({"memberId": "m0", "seq": 1})
+    queue.start()
+    await queue.stop()
+    assert saved == [0] and queue.dropped == 1
+
+
+@pytest.mark.asyncio
+async def test_write_behind_sets_rejected_rows_aside_without_retrying():
+    from fastapi import HTTPException
+    from myapp.write_behind import WriteBehindQueue
+
+    saved, attempts = [], []
+    async def save(batch):
+        attempts.append([d["seq"] for d in batch])
+        if any(d["seq"] == 1 for d in batch):
+            raise HTTPException(status_code=422, detail="lastTransactionUtcTs must be formatted as YYYY-MM-DD HH:MM:SS")
+        saved.extend(d["seq"] for d in batch)
+
+    queue = WriteBehindQueue(save, flush_interval=0, max_retries=3, retry_backoff=0)
+    for seq in range(3):
+        await queue.enqueue({"memberId": "rejected-member", "seq": seq})
+    queue.start()
+    await queue.stop()
+
+    assert saved == [0, 2] and attempts == [[0, 1, 2], [0], [1], [2]]
+    assert queue.dropped == 1 and [d["seq"] for d, _ in queue.dead_letters] == [1]
+    #Nothing is kept for members with nothing left to save
+    assert queue.flushed == {} and queue.in_flight == {} and queue.pending_by_member == {}
+
+
+def test_member_data_batch_with_an_invalid_row_stores_nothing():
+    from fastapi.testclient import TestClient
+    from src.applications.member_data import app
+
+    client = TestClient(app)
+    good = {"memberId": "invalid-batch", "lastTransactionUtcTs": "2025-12-14 10:00:00", "lastTransactionType": "buy",
+            "lastTransactionPointsBought": 100, "lastTransactionRevenueUsd": 50}
+
+    assert client.post("/member_data/batch", json=[good, dict(good, lastTransactionUtcTs="yesterday"), good]).status_code == 422
+    assert client.get("/member_data/invalid-batch").status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_invalid_transactions_are_not_queued():
+    from myapp import perk_app
+    from myapp.write_behind import WriteBehindQueue
+
+    queue = WriteBehindQueue(AsyncMock())
+    good = {"memberId": "queued-member", "lastTransactionUtcTs": "2025-12-14 10:00:00", "lastTransactionType": "buy",
+            "lastTransactionPointsBought": 100, "lastTransactionRevenueUsd": 50}
+    with patch("myapp.perk_app.write_behind", queue):
+        await perk_app.save_member_data("queued-member", dict(good, lastTransactionUtcTs="yesterday"))
+        await perk_app.save_member_data_batch([good, dict(good, lastTransactionPointsBought="many")])
+    assert queue.pending("queued-member") == [good]
+
+
+#Metrics tests
+
+def test_histogram_buckets_quantiles_and_text_format():
+    from src.observability.metrics import MetricsRegistry
+
+    registry = MetricsRegistry()
+    latency = registry.histogram("stage_seconds", "Stage latency", ("stage",), buckets=(0.01, 0.1, 1))
+    for value in [0.005] * 50 + [0.05] * 49 + [5]:
+        latency.labels("predict").observe(value)
+    registry.counter("offers_total", "Offers", ("offer",)).labels("35% Bonus").inc()
+    hits = [3]
+    registry.counter("cache_hits_total", "Hits").set_function(lambda: hits[0])
+
+    predict = latency.labels("predict")
+    assert predict.quantile(0.5) == pytest.approx(0.01)
+    assert 0.01 < predict.quantile(0.99) <= 1
+    text = registry.render()
+    assert 'stage_seconds_bucket{stage="predict",le="0.01"} 50' in text
+    assert 'stage_seconds_bucket{stage="predict",le="+Inf"} 100' in text
+    assert 'stage_seconds_count{stage="predict"} 100' in text
+    assert 'offers_total{offer="35% Bonus"} 1' in text
+    assert "# TYPE cache_hits_total counter\ncache_hits_total 3" in text
+
+
+def test_applications_serve_request_metrics():
+    from fastapi.testclient import TestClient
+    from src.applications import prediction
+
+    client = TestClient(prediction.app)
+    client.get("/ml/version")
+    client.get("/ml/version")
+    client.get("/does-not-exist")
+    text = client.get("/metrics").text
+
+    assert 'http_requests_total{method="GET",route="/ml/version",status="200"} 2' in text
+    assert 'http_requests_total{method="GET",route="unmatched",status="404"} 1' in text
+    assert 'http_request_duration_seconds_count{method="GET",route="/ml/version"} 2' in text
+
+
+#Benchmark harness tests
+
+@pytest.mark.asyncio
+async def test_standin_injects_latency_and_errors():
+    import time
+    from httpx import AsyncClient, ASGITransport
+    from benchmarks.standins import InjectedFaults
+    from src.applications import offer_engine
+
+    payload = {"ats_prediction": 1000, "resp_prediction": 0.9}
+    async with AsyncClient(transport=ASGITransport(app=InjectedFaults(offer_engine.app, latency_ms=20)), base_url="http://standin") as client:
+        start = time.perf_counter()
+        assert (await client.post("/offer/assign", json=payload)).status_code == 200
+        assert time.perf_counter() - start >= 0.02
+
+    async with AsyncClient(transport=ASGITransport(app=InjectedFaults(offer_engine.app, error_rate=1)), base_url="http://standin") as client:
+        assert (await client.post("/offer/assign", json=payload)).status_code == 503
+        assert (await client.get("/health")).status_code == 200
+
+
+@pytest.mark.asyncio
+async def test_load_generator_and_scraped_stage_percentiles():
+    from httpx import ASGITransport
+    from fastapi import FastAPI
+    from benchmarks.load import LoadGenerator, synthetic_transactions
+    from benchmarks.run import parse_histogram, histogram_report
+    from src.observability.metrics import MetricsRegistry
+
+    app = FastAPI()
+    seen = []
+    @app.post("/api/requests/v1")
+    async def handle(data: dict):
+        seen.append((data["memberId"], data["lastTransactionUtcTs"]))
+        return {"offer": "35% Bonus"}
+
+    transactions = synthetic_transactions(60, members=5)
+    report = await LoadGenerator("http://perk/api/requests/v1", transactions, "closed", concurrency=4,
+                                 transport=ASGITransport(app=app)).run()
+    assert report["ok"] == 60 and report["errors"] == 0
+    assert report["latency_ms"]["p50"] <= report["latency_ms"]["p99"]
+    for member in {t["memberId"] for t in transactions}:
+        times = [ts for m, ts in seen if m == member]
+        assert times == sorted(times)
+
+    registry = MetricsRegistry()
+    stages = registry.histogram("perk_stage_latency_seconds", "Stages", ("stage",))
+    stages.labels("total").observe(0.003)
+    before = registry.render()
+    for _ in range(10):
+        stages.labels("total").observe(0.2)
+    after = registry.render()
+
+    assert parse_histogram(after, "perk_stage_latency_seconds")[("total",)].count == 11
+    assert histogram_report(before, after, "perk_stage_latency_seconds")["total"]["count"] == 10
+    assert 100 < histogram_report(before, after, "perk_stage_latency_seconds")["total"]["p50"] <= 250
+
+
+@pytest.mark.asyncio
+async def test_write_behind_retries_only_the_failing_partition():
+    from myapp.write_behind import WriteBehindQueue
+    from src.storage.sharding import ShardMap
+
+    shards = ShardMap(["http://shard-0", "http://shard-1"])
+    saved, failures = {url: [] for url in shards.urls}, ["http://shard-1"]
+    async def save(batch):
+        url = shards.url_for(batch[0]["memberId"])
+        if url in failures:
+            failures.remove(url)
+            raise RuntimeError(f"{url} unavailable")
+        saved[url].extend(d["seq"] for d in batch)
+
+    queue = WriteBehindQueue(save, flush_interval=0, retry_backoff=0, partition=lambda d: shards.url_for(d["memberId"]))
+    transactions = [{"memberId": f"member-{i % 6}", "seq": i} for i in range(30)]
+    for d in transactions:
+        await queue.enqueue(d)
+    queue.start()
+    await queue.stop()
+
+    for url in shards.urls:
+        assert saved[url] == [d["seq"] for d in transactions if shards.url_for(d["memberId"]) == url]
+
+
+@pytest.mark.asyncio
+async def test_write_behind_through_the_router_never_stores_a_shard_part_twice():
+    import httpx
+    from src.applications import member_data_router
+    from src.storage.sharding import ShardMap
+    from myapp.write_behind import WriteBehindQueue
+
+    shards = ShardMap(["http://shard-0", "http://shard-1"])
+    stored = {url: [] for url in shards.urls}
+    outages = ["http://shard-1"]
+    #shard-1 is down for the first batch, then rejects any batch holding the invalid transaction, storing nothing of it
+    def shard(request):
+        url = f"{request.url.scheme}://{request.url.host}"
+        batch = json.loads(request.content)
+        if url in outages:
+            outages.remove(url)
+            return httpx.Response(503)
+        if any(d["seq"] == 7 for d in batch):
+            return httpx.Response(422, json={"detail": "invalid transaction"})
+        stored[url].extend(d["seq"] for d in batch)
+        return httpx.Response(200, json={"stored": len(batch)})
+
+    router = httpx.AsyncClient(transport=httpx.ASGITransport(app=member_data_router.app), base_url="http://router")
+    async def save(batch):
+        (await router.post("/member_data/batch", json=batch)).raise_for_status()
+
+    transactions = [{"memberId": f"member-{i % 6}", "seq": i} for i in range(30)]
+    queue = WriteBehindQueue(save, flush_interval=0, retry_backoff=0)
+    with patch.object(member_data_router, "shard_map", shards), \
+         patch.object(member_data_router, "client", httpx.AsyncClient(transport=httpx.MockTransport(shard))):
+        for d in transactions:
+            await queue.enqueue(d)
+        queue.start()
+        await queue.stop()
+
+    for url in shards.urls:
+        assert stored[url] == [d["seq"] for d in transactions if shards.url_for(d["memberId"]) == url and d["seq"] != 7]
+    assert [d["seq"] for d, _ in queue.dead_letters] == [7]
+
+
+def test_applications_negotiate_msgpack_and_skip_history_revalidation():
+    msgpack = pytest.importorskip("msgpack")
+    from fastapi.testclient import TestClient
+    from src.applications.member_data import app
+
+    client = TestClient(app)
+    transaction = {"memberId": "msgpack-member", "lastTransactionUtcTs": "2025-12-14 10:00:00", "lastTransactionType": "buy",
+                   "lastTransactionPointsBought": 100.0, "lastTransactionRevenueUsd": 50.0}
+
+    stored = client.post("/member_data", content=msgpack.packb(transaction),
+                         headers={"content-type": "application/msgpack", "accept": "application/msgpack"})
+    assert stored.headers["content-type"] == "application/msgpack"
+    assert msgpack.unpackb(stored.content) == transaction
+
+    history = client.get("/member_data/msgpack-member", headers={"accept": "application/msgpack"})
+    assert history.headers["content-type"] == "application/msgpack"
+    assert msgpack.unpackb(history.content) == [transaction]
+
+    #Callers that do not ask for msgpack keep getting JSON
+    assert client.get("/member_data/msgpack-member").json() == [transaction]
+    assert client.get("/member_data/msgpack-member/aggregate").json()["transactionCount"] == 1
+    assert client.post("/member_data", content=b"\xc1", headers={"content-type": "application/msgpack"}).status_code == 422
+
+
+@pytest.mark.asyncio
+async def test_micro_batcher_groups_concurrent_calls_and_fails_whole_batches():
+    import asyncio
+    from myapp.micro_batcher import MicroBatcher
+
+    batches = []
+    async def double(items):
+        batches.append(list(items))
+        await asyncio.sleep(0.01)
+        if "fail" in items:
+            raise RuntimeError("downstream failed")
+        return [2 * i for i in items]
+
+    batcher = MicroBatcher(double, max_batch_size=4, max_delay=1)
+    assert await asyncio.gather(*(batcher.submit(i) for i in range(10))) == [2 * i for i in range(10)]
+    assert batches == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+
+    #Calls made while a batch is out leave together once it returns, long before max_delay
+    batches.clear()
+    first = asyncio.create_task(batcher.submit(1))
+    await asyncio.sleep(0)
+    rest = [asyncio.create_task(batcher.submit(i)) for i in (2, 3)]
+    assert await asyncio.wait_for(asyncio.gather(first, *rest), 0.5) == [2, 4, 6]
+    assert batches == [[1], [2, 3]]
+
+    results = await asyncio.gather(batcher.submit("fail"), batcher.submit(5), return_exceptions=True)
+    assert all(isinstance(r, RuntimeError) for r in results)
+
+
+@pytest.mark.asyncio
+async def test_member_coordinator_serializes_runs_and_shares_one_fetch():
+    import asyncio
+    from myapp.member_coordinator import MemberCoordinator
+    from src.applications.member_data import MemberAggregate
+
+    fetches = []
+    async def fetch(m_id):
+        fetches.append(m_id)
+        await asyncio.sleep(0.01)
+        if m_id == "broken" and fetches.count("broken") == 1:
+            raise RuntimeError("member_data down")
+        return MemberAggregate(transactionCount=1, totalPointsBought=100)
+
+    coordinator = MemberCoordinator(fetch)
+    seen = []
+    async def run(m_id, points):
+        async with coordinator.members([m_id]):
+            aggregate = await coordinator.aggregate(m_id)
+            seen.append((m_id, aggregate.transactionCount))
+            await asyncio.sleep(0.001)
+            coordinator.record({"memberId": m_id, "lastTransactionPointsBought": points, "lastTransactionRevenueUsd": 1,
+                                "lastTransactionType": "buy", "lastTransactionUtcTs": "2025-12-14 10:00:00"})
+
+    await asyncio.gather(*(run("hot", i) for i in range(5)), run("cold", 0))
+    assert fetches.count("hot") == 1
+    assert [count for m_id, count in seen if m_id == "hot"] == [1, 2, 3, 4, 5]
+    assert len(coordinator) == 0
+
+    #A failed fetch is not shared with the runs after it
+    results = await asyncio.gather(run("broken", 0), run("broken", 1), return_exceptions=True)
+    assert isinstance(results[0], RuntimeError) and results[1] is None
+    assert fetches.count("broken") == 2
+
+
+def test_member_history_time_queries_and_windowed_features():
+    from fastapi.testclient import TestClient
+    from src.applications.member_data import app, member_data_store, WINDOWED_FEATURES
+    from src.features.engine import compute_stats, compute_features, registry
+    from src.storage.member_store import parse_timestamp
+
+    client = TestClient(app)
+    timestamps = ["2026-01-01 12:00:00", "2026-01-03 12:00:00", "2026-01-10 12:00:00", "2026-01-20 12:00:00",
+                  "2026-02-14 12:00:00", "2026-03-01 12:00:00", "2026-04-10 12:00:00", "2026-01-02 12:00:00"]
+    transactions = [{"memberId": "window-member", "lastTransactionUtcTs": ts, "lastTransactionType": ("buy", "gift", "redeem")[i % 3],
+                     "lastTransactionPointsBought": 100.0 * (i + 1), "lastTransactionRevenueUsd": 10.0 * (i + 1)}
+                    for i, ts in enumerate(timestamps)]
+    for t in transactions:
+        client.post("/member_data", json=t)
+    #The last transaction arrived late, the time index is rebuilt around it
+    by_time = sorted(transactions, key=lambda t: t["lastTransactionUtcTs"])
+
+    assert client.get("/member_data/window-member").json() == transactions
+    assert client.get("/member_data/window-member", params={"limit": 3}).json() == by_time[-3:]
+    ranged = client.get("/member_data/window-member", params={"since": "2026-01-02 00:00:00", "until": "2026-02-14 12:00:00"})
+    assert ranged.json() == [t for t in by_time if "2026-01-02" <= t["lastTransactionUtcTs"] <= "2026-02-14 12:00:00"]
+    assert client.get("/member_data/window-member", params={"since": "2026-01-02"}).status_code == 422
+
+    client.post("/member_data", json=dict(transactions[0], lastTransactionUtcTs="2026-04-11 08:00:00"))
+    at = "2026-04-12 00:00:00"
+    windowed = client.get("/member_data/window-member/windowed_features", params={"at": at}).json()
+    history = client.get("/member_data/window-member").json()
+    rows = [(h["lastTransactionPointsBought"], h["lastTransactionRevenueUsd"], h["lastTransactionType"], h["lastTransactionUtcTs"]) for h in history]
+    now = parse_timestamp(at)
+    expected = compute_features(compute_stats(rows, registry.accumulators(WINDOWED_FEATURES), now), now, WINDOWED_FEATURES)
+    assert windowed == pytest.approx(expected)
+    assert windowed["TRANSACTIONS_7D"] == 2 and windowed["TRANSACTIONS_90D"] == 5
+    assert member_data_store.get("window-member").time_index().order is not None
+
+    #Transactions after at are outside the windows, like they are for the offline computation
+    at = "2026-01-11 00:00:00"
+    windowed = client.get("/member_data/window-member/windowed_features", params={"at": at}).json()
+    now = parse_timestamp(at)
+    expected = compute_features(compute_stats(rows, registry.accumulators(WINDOWED_FEATURES), now), now, WINDOWED_FEATURES)
+    assert windowed == pytest.approx(expected)
+    assert windowed["TRANSACTIONS_7D"] == 1 and windowed["TRANSACTIONS_30D"] == 4
+
+
+def test_windowed_features_while_transactions_are_stored():
+    from concurrent.futures import ThreadPoolExecutor
+    from src.applications.member_data import store_member_data, get_member_windowed_features
+    from src.models.member_data import MemberData
+
+    #Every transaction is older than the previous one, so every read rebuilds the time index
+    def transaction(i):
+        i = 5000 - i
+        return MemberData(memberId="window-busy", lastTransactionUtcTs=f"2026-01-01 {i // 3600 % 24:02d}:{i // 60 % 60:02d}:{i % 60:02d}",
+                          lastTransactionType="buy", lastTransactionPointsBought=1, lastTransactionRevenueUsd=1)
+
+    store_member_data(transaction(0))
+    def store_all():
+        for i in range(1, 2001):
+            store_member_data(transaction(i))
+    def read_all():
+        return [get_member_windowed_features("window-busy", "2026-01-02 00:00:00")["TRANSACTIONS_7D"] for _ in range(200)]
+
+    #Threads switch as often as possible to interleave the reads with the appends
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        with ThreadPoolExecutor(2) as pool:
+            stored, counts = pool.submit(store_all), pool.submit(read_all)
+            stored.result()
+            counts = counts.result()
+    finally:
+        sys.setswitchinterval(switch_interval)
+    assert counts == sorted(counts) and 1 <= counts[0] and counts[-1] <= 2001
+    assert get_member_windowed_features("window-busy", "2026-01-02 00:00:00")["TRANSACTIONS_7D"] == 2001
+
+
+@pytest.mark.asyncio
+async def test_diagnostics_trace_slow_requests_profile_and_report_loop_lag():
+    import asyncio
+    from httpx import AsyncClient, ASGITransport
+    from src.applications import prediction
+
+    features = {"AVG_POINTS_BOUGHT": 200, "AVG_REVENUE_USD": 150, "LAST_3_TRANSACTIONS_AVG_POINTS_BOUGHT": 250,
+                "LAST_3_TRANSACTIONS_AVG_REVENUE_USD": 200, "PCT_BUY_TRANSACTIONS": 0.4, "PCT_GIFT_TRANSACTIONS": 0.2,
+                "PCT_REDEEM_TRANSACTIONS": 0.4, "DAYS_SINCE_LAST_TRANSACTION": 3}
+
+    async with AsyncClient(transport=ASGITransport(app=prediction.app), base_url="http://prediction") as client:
+        await client.post("/admin/slow_requests", params={"threshold_ms": 0, "clear": True})
+        await client.post("/ml/predict", json=features)
+        slow = (await client.get("/admin/slow_requests")).json()
+        assert slow["threshold_ms"] == 0
+        assert [r["path"] for r in slow["requests"]] == ["/ml/predict"]
+        assert {"decode", "endpoint", "serialization"} <= {s["name"] for s in slow["requests"][0]["spans"]}
+        await client.post("/admin/slow_requests", params={"threshold_ms": 500, "clear": True})
+
+        profile = await client.get("/admin/profile", params={"seconds": 0.3, "interval_ms": 5})
+        assert int(profile.headers["x-profile-samples"]) > 0
+        assert all(line.rsplit(" ", 1)[1].isdigit() for line in profile.text.splitlines())
+        assert any(line.startswith("MainThread;") for line in profile.text.splitlines())
+        assert (await client.get("/admin/profile", params={"seconds": 0})).status_code == 422
+
+        await asyncio.sleep(prediction.app.loop_lag.interval * 2)
+        lag = (await client.get("/admin/loop_lag")).json()
+        assert lag["p50_ms"] is not None and lag["last_ms"] >= 0
+
+
+@pytest.mark.asyncio
+async def test_admission_limits_concurrency_and_sheds_requests_that_cannot_finish():
+    import time
+    import asyncio
+    from myapp.admission import AdmissionController, AdmissionRejected
+    from myapp.dependency_client import request_deadline
+    from src.observability.metrics import Counter, Histogram
+
+    shed = Counter("shed", "", ("reason",))
+    admission = AdmissionController(max_concurrency=2, max_queue=1, timeout=1.0, shed=shed, queue_time=Histogram())
+    release = asyncio.Event()
+    order = []
+
+    async def run(name, timeout=None):
+        async with admission.admit(timeout) as deadline:
+            assert request_deadline.get() == deadline
+            order.append(name)
+            await release.wait()
+
+    running = [asyncio.create_task(run(name)) for name in ("a", "b")]
+    queued = asyncio.create_task(run("c"))
+    await asyncio.sleep(0.01)
+    assert order == ["a", "b"] and admission.in_flight == 2 and len(admission) == 1
+
+    with pytest.raises(AdmissionRejected, match="queue_full"):
+        await run("d")
+    with pytest.raises(AdmissionRejected, match="deadline"):
+        await run("e", timeout=0)
+
+    release.set()
+    await asyncio.gather(*running, queued)
+    assert order == ["a", "b", "c"] and admission.in_flight == 0 and len(admission) == 0
+    assert shed.labels("queue_full").value == 1 and shed.labels("deadline").value == 1
+    assert request_deadline.get() is None
+
+    #A queued request whose deadline passes before a slot frees up is rejected instead of being started late
+    admission = AdmissionController(max_concurrency=1, timeout=1.0)
+    release.clear()
+    running = asyncio.create_task(run("f"))
+    await asyncio.sleep(0)
+    start = time.perf_counter()
+    with pytest.raises(AdmissionRejected, match="deadline"):
+        await run("g", timeout=0.05)
+    assert time.perf_counter() - start < 0.5 and len(admission) == 0
+    release.set()
+    await running
+    assert admission.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_downstream_calls_get_the_time_left_of_the_request():
+    import time
+    import httpx
+    from myapp.dependency_client import request_deadline, DeadlineExceeded
+
+    calls = []
+
+    #The mock transport does not time out by itself, it fails the way httpx does once the read timeout is over
+    def handler(request):
+        calls.append(request.extensions["timeout"]["read"])
+        raise httpx.ReadTimeout("Timed out", request=request)
+
+    client = make_dependency_client(handler, breaker_failures=1)
+    token = request_deadline.set(time.perf_counter() - 0.01)
+    try:
+        with pytest.raises(DeadlineExceeded):
+            await client.get("http://ml/ml/ats/predict")
+        assert calls == []
+        request_deadline.set(time.perf_counter() + 0.05)
+        with pytest.raises(DeadlineExceeded):
+            await client.get("http://ml/ml/ats/predict")
+    finally:
+        request_deadline.reset(token)
+    assert calls[0] <= 0.05
+    #Running out of time says nothing about the dependency, the circuit stays closed
+    assert client.breaker.state == "closed"
+
+
+@pytest.mark.asyncio
+async def test_hung_dependency_opens_the_circuit_under_admission_deadlines():
+    import asyncio
+    import httpx
+    from myapp.admission import AdmissionController
+    from myapp.dependency_client import DeadlineExceeded
+
+    #Never answers: the call lasts until the deadline caps its read timeout
+    async def handler(request):
+        await asyncio.sleep(request.extensions["timeout"]["read"])
+        raise httpx.ReadTimeout("Timed out", request=request)
+
+    client = make_dependency_client(handler, breaker_failures=3, breaker_slow_call=0.02)
+    admission = AdmissionController(timeout=0.05)
+    for _ in range(3):
+        async with admission.admit():
+            with pytest.raises(DeadlineExceeded):
+                await client.get("http://member_data/member_data/m1/aggregate")
+    assert client.breaker.state == "open" and client.breaker.failures == 3
+
+
+@pytest.mark.asyncio
+async def test_request_shed_by_admission_gets_fallback_offer_and_is_saved():
+    from fastapi import HTTPException
+    from myapp import perk_app
+
+    fake_transport = AsyncMock()
+    transaction = {"memberId": "member1", "lastTransactionPointsBought": 300, "lastTransactionRevenueUsd": 100,
+                   "lastTransactionType": "buy", "lastTransactionUtcTs": "2025-12-17 14:00:00"}
+
+    with patch("myapp.perk_app.transport", fake_transport), patch("myapp.perk_app.write_behind", None), \
+         patch("myapp.perk_app.record_logs"):
+        result = await perk_app.handle_request(transaction, x_request_timeout_ms=0)
+        assert result == {"memberId": "member1", "offer": perk_app.FALLBACK_OFFER}
+        fake_transport.get_member_aggregate.assert_not_called()
+        fake_transport.save_member_data.assert_awaited_once_with(transaction)
+
+        with patch("myapp.perk_app.ADMISSION_SHED", "reject"):
+            with pytest.raises(HTTPException) as rejected:
+                await perk_app.handle_request(transaction, x_request_timeout_ms=0)
+        assert rejected.value.status_code == 503 and "Retry-After" in rejected.value.headers
+
+        #Batches go through admission too
+        batch = [transaction, dict(transaction, memberId="member2")]
+        offers = await perk_app.handle_batch_request(batch, x_request_timeout_ms=0)
+        assert offers == [{"memberId": m, "offer": perk_app.FALLBACK_OFFER} for m in ("member1", "member2")]
+        fake_transport.get_member_aggregates.assert_not_called()
+        fake_transport.save_member_data_batch.assert_awaited_once_with(batch)
+
+
+def test_known_member_filter_has_no_false_negatives_and_reports_its_error_rate():
+    from myapp.member_filter import KnownMemberFilter
+
+    known = [f"known-{i}" for i in range(5000)]
+    member_filter = KnownMemberFilter(capacity=5000, error_rate=0.01)
+    assert member_filter.may_be_known("anyone") and member_filter.skipped == 0
+
+    member_filter.seed(*member_filter.locate(known[:4000]))
+    for m_id in known[4000:]:
+        member_filter.add(m_id)
+    assert all(member_filter.may_be_known(m_id) for m_id in known)
+
+    #Bits set one member at a time and all at once are the same
+    single = KnownMemberFilter(capacity=5000, error_rate=0.01)
+    for m_id in known[:4000]:
+        single.add(m_id)
+    seeded = KnownMemberFilter(capacity=5000, error_rate=0.01)
+    seeded.add_many(known[:4000])
+    assert single.bits == seeded.bits
+
+    false_positives = sum(member_filter.may_be_known(f"new-{i}") for i in range(20000)) / 20000
+    stats = member_filter.stats()
+    assert false_positives < 0.02 and abs(stats["false_positive_rate"] - 0.01) < 0.005
+    assert stats["skipped_lookups"] == member_filter.skipped > 19000
+    assert abs(stats["estimated_members"] - 5000) < 250 and stats["memory_bytes"] == len(member_filter.bits) < 7000